@@ -3,23 +3,24 @@ import logging
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, NetworkError
 import re
 import subprocess
 import time
 import aiofiles
 import aiofiles.os
 from yt_dlp.utils import DownloadError, ExtractorError
-from urllib.parse import urlparse, urlunparse
 import hashlib
-import yt_dlp
 import uuid
 
 # Импортируем наши модули
 import config
-from downloader import VideoDownloader, data_lock, active_downloads, canonical_url_map
-from database import Database
+from downloader import VideoDownloader, data_lock, active_downloads, canonical_url_map, download_executor, download_key
+from database import Database, AsyncDatabase, shutdown_async_database, pinned_file, pin_file, unpin_file
+from transcoder import transcode_pool
+from format_selector import format_options, best_fitting
 from localization import get_message  # Импортируем функцию локализации
+from canonical_url import canonical_key
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,7 +31,7 @@ logger = logging.getLogger(__name__)
 
 # Инициализация объектов
 downloader = VideoDownloader()
-db = Database()
+db = AsyncDatabase(Database())
 
 # Регулярное выражение для проверки URL
 URL_PATTERN = re.compile(r'https?://\S+')
@@ -40,26 +41,89 @@ PLAYLIST_PATTERN = re.compile(r'[?&]list=([a-zA-Z0-9_-]+)')
 
 # Константа для ключа контекста чата
 CHAT_CONTEXT_KEY = 'video_requests'
+# Спецификации форматов кнопок выбора качества (короткий id -> спецификация для yt-dlp):
+# полная спецификация "видео+аудио" не помещается в лимит callback_data в 64 байта
+QUALITY_FORMATS_KEY = 'quality_formats'
 
 # --- Добавлено: Ключ для плейлистов ---
 PLAYLIST_CONTEXT_KEY = 'playlist_requests'
 # --- Конец добавления ---
 
-# --- Добавлено: Функция нормализации URL ---
 
 
-def normalize_url(url):
-    """Removes query parameters and fragments from a URL."""
-    if not url: return None
+async def _lookup_download_cache(url, video_format):
+    """Ищет уже скачанный файл в общем кэше загрузок (для любого пользователя)."""
+    if not config.CACHE_ENABLED:
+        return None
     try:
-        parsed = urlparse(url)
-        # Reconstruct URL without query and fragment
-        return urlunparse(
-    (parsed.scheme, parsed.netloc, parsed.path, '', '', ''))
+        return await db.get_cached_video(canonical_key(url), video_format)
     except Exception as e:
-        logger.warning(f"Не удалось нормализовать URL '{url}': {e}")
-        return url  # Возвращаем исходный URL в случае ошибки
-# --- Конец добавления ---
+        logger.warning(f"Ошибка при поиске {url} в кэше загрузок: {e}")
+        return None
+
+
+async def _store_download_cache(url, video_format, title, file_path):
+    """Сохраняет скачанный файл в общий кэш загрузок."""
+    if not config.CACHE_ENABLED or not file_path or not os.path.exists(file_path):
+        return
+    try:
+        await db.add_video_to_cache(canonical_key(url), title, file_path, os.path.getsize(file_path), video_format)
+        logger.info(f"Видео {url} ({video_format}) добавлено в кэш: {file_path}")
+    except Exception as e:
+        logger.warning(f"Не удалось добавить {url} в кэш загрузок: {e}")
+
+
+async def _send_by_file_ids(context, chat_id, url, video_format):
+    """Повторно отправляет видео по сохраненным file_id Telegram, без загрузки файла.
+
+    Возвращает (отправлено частей, всего частей): видео отправлено полностью, если числа
+    равны и не нулевые. Если часть не отправилась, первые части уже в чате и загружать
+    нужно только остальные, начиная со следующей за отправленными.
+    """
+    if not url:
+        return 0, 0
+    video_key = canonical_key(url)
+    try:
+        cached_files = await db.get_telegram_files(video_key, video_format)
+    except Exception as e:
+        logger.warning(f"Ошибка при поиске file_id для {url}: {e}")
+        return 0, 0
+    if not cached_files:
+        return 0, 0
+
+    file_ids = cached_files['file_ids']
+    title = cached_files['title'] or 'Видео'
+    total_parts = len(file_ids)
+    for i, telegram_file_id in enumerate(file_ids, 1):
+        caption = f"🎥 {title}" if total_parts == 1 else get_message('split_video_part', part=i, total=total_parts, title=title)
+        try:
+            await context.bot.send_video(
+                chat_id=chat_id,
+                video=telegram_file_id,
+                caption=caption,
+                supports_streaming=True
+            )
+        except BadRequest as e:
+            # file_id мог стать недействительным - забываем только его, остальные части загружаются заново
+            logger.warning(f"Telegram не принял сохраненный file_id части {i}/{total_parts} для {url}: {e}")
+            await db.remove_telegram_file(video_key, video_format, 0 if total_parts == 1 else i)
+            return i - 1, total_parts
+        except NetworkError as e:
+            logger.warning(f"Не удалось отправить часть {i}/{total_parts} по file_id для {url}: {e}")
+            return i - 1, total_parts
+    logger.info(f"Видео {url} ({video_format}) отправлено по сохраненным file_id ({total_parts} шт.)")
+    return total_parts, total_parts
+
+
+async def _remember_file_id(url, video_format, title, message, part_index=0, part_count=1):
+    """Сохраняет file_id отправленного видео (или его части) для повторной отправки."""
+    media = getattr(message, 'video', None) or getattr(message, 'document', None)
+    if not url or not media:
+        return
+    try:
+        await db.add_telegram_file(canonical_key(url), video_format, part_index, media.file_id, title, part_count)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить file_id для {url}: {e}")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -108,7 +172,7 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("quality_"):
         quality = data.split("_")[1]
-        db.update_user_settings(user_id, quality)
+        await db.update_user_settings(user_id, quality)
 
         quality_names = {
             "low": "низкое",
@@ -126,80 +190,84 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-async def update_progress_message(chat_id, message_id, url):
-    """Обновляет сообщение о прогрессе загрузки."""
-    last_update = 0
+async def update_progress_message(bot, chat_id, message_id, key):
+    """Обновляет сообщение о прогрессе загрузки запроса key (download_key)."""
     update_interval = 3  # Минимальный интервал между обновлениями в секундах
+    url = key[2]
 
     while True:
         try:
             current_time = time.time()
 
-            # Получаем информацию о прогрессе
+            # Получаем снимок информации о прогрессе (без await под блокировкой)
             with data_lock:
-                if url not in active_downloads:
+                if key not in active_downloads:
                     logger.debug(f"URL {url} больше не активен")
                     return
 
-                download_info = active_downloads[url]
+                download_info = active_downloads[key]
                 if download_info['cancelled']:
                     logger.info(f"Загрузка {url} была отменена")
                     return
 
                 # Проверяем, нужно ли обновлять сообщение
-                if current_time - \
-                    download_info['last_update'] < update_interval:
-                    await asyncio.sleep(0.5)
-                    continue
-
-                # Формируем текст сообщения
-                status = download_info['status']
-                if status == 'initializing':
-                    text = get_message('download_initializing')
+                if current_time - download_info['last_update'] < update_interval:
+                    snapshot = None
                 else:
-                    # Форматируем информацию о прогрессе
-                    downloaded = format_size(download_info['downloaded_bytes'])
-                    total = format_size(
-    download_info['total_bytes'] or download_info['total_bytes_estimate'])
-                    speed = format_size(download_info['speed']) + '/s'
-                    eta = format_time(
-    download_info['eta']) if download_info['eta'] else 'N/A'
-                    percent = download_info['percent_rounded']
-
-                    text = get_message(
-                        'download_progress',
-                        filename=download_info['filename'] or 'Видео',
-                        downloaded=downloaded,
-                        total=total,
-                        speed=speed,
-                        eta=eta,
-                        percent=percent
-                    )
+                    snapshot = dict(download_info)
+                    download_info['last_update'] = current_time
 
-                # Создаем клавиатуру с кнопкой отмены
-                keyboard = [
-                    [InlineKeyboardButton(
-                        get_message('cancel_download_button'),
-                        callback_data=f'cancel_download_{url}'
-                    )]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            if snapshot is None:
+                await asyncio.sleep(0.5)
+                continue
 
-                try:
-                    await bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=text,
-                        reply_markup=reply_markup
-                    )
-                    download_info['last_update'] = current_time
-                except telegram.error.BadRequest as e:
-                    if "Message is not modified" in str(e):
-                        pass
-                    else:
-                        logger.warning(f"Ошибка при обновлении сообщения: {e}")
-                except Exception as e:
-                    logger.error(
+            # Формируем текст сообщения
+            status = snapshot['status']
+            if status == 'initializing':
+                text = get_message('download_initializing')
+            else:
+                # Форматируем информацию о прогрессе
+                downloaded = format_size(snapshot['downloaded_bytes'])
+                total = format_size(
+                    snapshot['total_bytes'] or snapshot['total_bytes_estimate'])
+                speed = format_size(snapshot['speed']) + '/s'
+                eta = format_time(snapshot['eta']) if snapshot['eta'] else 'N/A'
+                percent = snapshot['percent_rounded']
+
+                text = get_message(
+                    'download_progress',
+                    filename=snapshot['filename'] or 'Видео',
+                    downloaded=downloaded,
+                    total=total,
+                    speed=speed,
+                    eta=eta,
+                    percent=percent
+                )
+
+            # Создаем клавиатуру с кнопкой отмены (короткий хеш URL укладывается в лимит callback_data)
+            url_hash = hashlib.md5(url.encode()).hexdigest()[:10]
+            keyboard = [
+                [InlineKeyboardButton(
+                    get_message('cancel_download_button'),
+                    callback_data=f"cancel_{url_hash}_{snapshot['user_id']}"
+                )]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            try:
+                await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    reply_markup=reply_markup
+                )
+            except BadRequest as e:
+                if "Message is not modified" in str(e):
+                    pass
+                else:
+                    logger.warning(f"Ошибка при обновлении сообщения: {e}")
+            except Exception as e:
+                logger.error(
     f"Неожиданная ошибка при обновлении сообщения: {e}")
 
             await asyncio.sleep(1)
@@ -237,7 +305,7 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Обновляем статистику пользователя
-    db.update_user_stats(user_id, username)
+    await db.update_user_stats(user_id, username)
 
     # --- Изменено: Диспетчеризация на основе типа URL ---
     if is_playlist:
@@ -271,7 +339,7 @@ async def handle_single_video_url(update: Update, context: ContextTypes.DEFAULT_
     
     # Добавляем URL в активные загрузки
     with data_lock:
-        active_downloads[url] = {
+        active_downloads[download_key(user_id, chat_id, url)] = {
             'status': 'initializing',
             'percent': 0,
             'percent_rounded': 0,
@@ -317,107 +385,47 @@ async def handle_single_video_url(update: Update, context: ContextTypes.DEFAULT_
             
             logger.info(f"Формат #{idx}: id={format_id}, note={format_note}, vcodec={vcodec}, acodec={acodec}, resolution={width}x{height}, size={filesize}")
         
-        # Разделяем форматы на видео и аудио
-        video_formats = []
-        audio_formats = []
+        # Отбираем аудио форматы (варианты видео с аудио формирует format_options)
+        audio_formats = [fmt for fmt in formats if fmt.get('vcodec', 'none') == 'none' and fmt.get('acodec', 'none') != 'none']
         
-        # Используем все доступные видео-форматы
-        for fmt in formats:
-            vcodec = fmt.get('vcodec', 'none')
-            acodec = fmt.get('acodec', 'none')
-            height = fmt.get('height', 0)
-            format_id = fmt.get('format_id', '')
-            
-            # Отбираем видео форматы
-            if vcodec != 'none' and height > 0:
-                # Добавляем все форматы с видеокодеком и высотой
-                video_formats.append(fmt)
-            
-            # Отбираем аудио форматы
-            elif vcodec == 'none' and acodec != 'none':
-                audio_formats.append(fmt)
-        
-        # Если нет видео форматов, попробуем найти их другим способом
-        if not video_formats:
-            logger.warning(f"Не найдены видео форматы стандартным методом, пробуем другую фильтрацию")
-            video_formats = [fmt for fmt in formats if fmt.get('height', 0) > 0]
+        # Варианты качества с оценкой итогового размера (видео + аудио)
+        options = format_options(info)
+        logger.info(f"Найдены разрешения: {[(o['height'], o['format_id'], o['size']) for o in options]}")
         
-        logger.info(f"После фильтрации: {len(video_formats)} видео форматов, {len(audio_formats)} аудио форматов")
-        
-        # Группируем форматы по разрешению
-        format_groups = {}
-        for fmt in video_formats:
-            height = fmt.get('height', 0)
-            if height > 0:
-                if height not in format_groups:
-                    format_groups[height] = []
-                format_groups[height].append(fmt)
+        # Создаем клавиатуру с кнопками выбора качества
+        keyboard = []
+        url_hash = hashlib.md5(url.encode()).hexdigest()[:10]  # Уменьшаем размер хеша до 10 символов
         
-        # Сортируем разрешения по убыванию
-        sorted_heights = sorted(format_groups.keys(), reverse=True)
+        quality_formats = {}
+        context.chat_data[chat_id][QUALITY_FORMATS_KEY] = quality_formats
         
-        # Логируем найденные разрешения
-        logger.info(f"Найдены разрешения: {sorted_heights}")
+        def quality_callback_data(format_id):
+            # В callback_data передается только короткий id, спецификация хранится в контексте чата
+            short_id = f"f{len(quality_formats)}"
+            quality_formats[short_id] = format_id
+            return f"download_{url_hash}_{short_id}_{user_id}"
         
-        # Создаем клавиатуру с кнопками выбора качества
-        keyboard = []
+        # Автовыбор: лучшее качество, которое отправится одним сообщением без разделения
+        auto_option = best_fitting(options)
+        if auto_option and auto_option is not options[0]:
+            auto_text = f"⚡ Авто: {auto_option['height']}p (~{format_size(auto_option['size'])}) ✅"
+            keyboard.append([InlineKeyboardButton(auto_text, callback_data=quality_callback_data(auto_option['format_id']))])
         
         # Добавляем кнопки для каждого разрешения
-        for height in sorted_heights:
-            formats_for_height = format_groups[height]
-            # Берем форматы с и без аудио
-            formats_with_audio = [f for f in formats_for_height if f.get('acodec') != 'none']
-            if formats_with_audio:
-                # Предпочитаем форматы с аудио
-                best_format = max(
-                    formats_with_audio,
-                    key=lambda x: x.get('filesize', 0) if x.get('filesize') else 0
-                )
-            else:
-                # Если нет форматов с аудио, используем любой
-                best_format = max(
-                    formats_for_height,
-                    key=lambda x: x.get('filesize', 0) if x.get('filesize') else 0
-                )
-            
-            format_id = best_format.get('format_id')
-            ext = best_format.get('ext', 'mp4')
-            filesize = best_format.get('filesize', 0)
-            
-            # Создаем текст для кнопки
-            if filesize:
-                filesize_str = format_size(filesize)
-                button_text = f"{height}p ({filesize_str})"
+        for option in options:
+            # Создаем текст для кнопки: ✅ - поместится в одно сообщение, ⚠️ - придется делить
+            if option['size']:
+                button_text = f"{option['height']}p (~{format_size(option['size'])}) {'✅' if option['fits'] else '⚠️'}"
             else:
-                # Пытаемся получить другую полезную информацию
-                tbr = best_format.get('tbr', 0)  # битрейт в Kb/s
-                if tbr:
-                    button_text = f"{height}p ({tbr} Kb/s)"
-                else:
-                    # Если нет ни размера, ни битрейта, показываем только разрешение
-                    button_text = f"{height}p"
-                
-                # Добавляем индикатор источника для RuTube
-                if 'rutube' in url.lower():
-                    button_text += " 🇷🇺"
-            
-            # Создаем callback_data с хешем URL
-            url_hash = hashlib.md5(url.encode()).hexdigest()[:10]  # Уменьшаем размер хеша до 10 символов
-            
-            # Ограничиваем размер format_id, если он слишком длинный
-            format_id_short = format_id
-            if len(format_id) > 20:  # Если format_id слишком длинный
-                format_id_short = format_id[:20]  # Берем только первые 20 символов
-            
-            callback_data = f"download_{url_hash}_{format_id_short}_{user_id}"
+                # Если размер оценить не удалось, показываем только разрешение
+                button_text = f"{option['height']}p"
             
-            # Проверяем длину callback_data и при необходимости укорачиваем
-            if len(callback_data.encode('utf-8')) > 60:  # Оставляем небольшой запас от лимита в 64 байта
-                format_id_short = format_id[:10]  # Еще больше сокращаем format_id
-                callback_data = f"download_{url_hash}_{format_id_short}_{user_id}"
+            # Добавляем индикатор источника для RuTube
+            if 'rutube' in url.lower():
+                button_text += " 🇷🇺"
             
             # Добавляем кнопку
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=quality_callback_data(option['format_id']))])
         
         # Добавляем кнопку для аудио
         if audio_formats:
@@ -438,20 +446,7 @@ async def handle_single_video_url(update: Update, context: ContextTypes.DEFAULT_
             if 'rutube' in url.lower():
                 audio_button_text += " 🇷🇺"
             
-            # Уменьшаем размер хеша и format_id для аудио
-            url_hash = hashlib.md5(url.encode()).hexdigest()[:10]
-            
-            # Ограничиваем размер audio_format_id при необходимости
-            audio_format_id_short = audio_format_id
-            if len(audio_format_id) > 20:
-                audio_format_id_short = audio_format_id[:20]
-                
-            audio_callback_data = f"download_{url_hash}_{audio_format_id_short}_{user_id}"
-            
-            # Проверяем длину callback_data
-            if len(audio_callback_data.encode('utf-8')) > 60:
-                audio_format_id_short = audio_format_id[:10]
-                audio_callback_data = f"download_{url_hash}_{audio_format_id_short}_{user_id}"
+            audio_callback_data = quality_callback_data(audio_format_id)
             
             keyboard.append([InlineKeyboardButton(audio_button_text, callback_data=audio_callback_data)])
         
@@ -474,7 +469,7 @@ async def handle_single_video_url(update: Update, context: ContextTypes.DEFAULT_
         await message.edit_text(get_message('video_info_error'))
         
         # Очищаем состояние загрузки
-        _cleanup_download_state(url, None, None)
+        _cleanup_download_state(download_key(user_id, chat_id, url), None, None)
 
 # --- Новая функция для обработки URL ПЛЕЙЛИСТА ---
 
@@ -546,290 +541,117 @@ async def handle_playlist_url(update: Update, context: ContextTypes.DEFAULT_TYPE
 # --- Конец новой функции ---
 
 
-async def _initialize_download(context, url, chat_id, message_id, user_id, ydl_opts=None):
-    """Инициализирует процесс загрузки видео."""
-    bot = context.bot
-    start_time = time.time()
+async def _send_parts_pipelined(context: ContextTypes.DEFAULT_TYPE, chat_id: int, file_path: str, title: str, url: str | None, video_format: str | None, first_part: int = 1):
+    """
+    Нарезает большое видео и отправляет части конвейером (начиная с first_part:
+    предыдущие части уже отправлены по file_id).
 
-    try:
-        # Создаем или обновляем сообщение о загрузке
-        progress_text = get_message('download_started')
-
-        if message_id:
-            try:
-                progress_message = await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=progress_text
-                )
-            except Exception as e:
-                logger.warning(
-    f"Не удалось обновить сообщение {message_id}: {e}")
-                progress_message = await bot.send_message(chat_id=chat_id, text=progress_text)
-                message_id = progress_message.message_id
-        else:
-            progress_message = await bot.send_message(chat_id=chat_id, text=progress_text)
-            message_id = progress_message.message_id
+    Часть i+1 начинает нарезаться только после того, как часть i взята в отправку,
+    и загружается в Telegram, пока нарезается следующая. Каждая часть удаляется сразу
+    после отправки, поэтому на диске одновременно не больше двух частей.
+    Возвращает (число отправленных частей, всего частей).
+    """
+    parts = downloader.iter_split_parts(file_path, first_part=first_part)
 
-        # Запускаем процесс скачивания
-        logger.info(f"Начало загрузки для URL: {url} с options: {ydl_opts}")
+    async def cut_next_part():
+        return await anext(parts, None)
 
-        # Добавляем URL в активные загрузки
-        with data_lock:
-            active_downloads[url] = {
-                'status': 'initializing',
-                'percent': 0,
-                'percent_rounded': 0,
-                'downloaded_bytes': 0,
-                'total_bytes': 0,
-                'total_bytes_estimate': 0,
-                'speed': 0,
-                'eta': 0,
-                'filename': '',
-                'last_update': time.time(),
-                'cancelled': False,
-                'user_id': user_id,
-                'chat_id': chat_id,
-                'message_id': message_id
-            }
-
-        # Запускаем задачу обновления сообщения о прогрессе
-        progress_task = asyncio.create_task(
-            update_progress_message(chat_id, message_id, url)
-        )
-
-        # Выполняем скачивание
-        result = await asyncio.to_thread(
-            download_video, url, ydl_opts, context, user_id
-        )
-
-        # Отправляем результат
-        if result:
-            # Останавливаем задачу обновления прогресса
-            if progress_task:
-                progress_task.cancel()
-                try:
-                    await progress_task
-                except asyncio.CancelledError:
-                    pass
-
-            # Обновляем сообщение о завершении загрузки
+    next_part = asyncio.create_task(cut_next_part())
+    sent_parts = 0
+    total_parts = 0
+    try:
+        while True:
+            part = await next_part
+            if part is None:
+                break
+            part_index, total_parts, part_path = part
+            # Следующая часть нарезается, пока отправляется текущая
+            next_part = asyncio.create_task(cut_next_part())
+            logger.info(f"Отправка части {part_index}/{total_parts}: {part_path}")
             try:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=get_message('download_complete_preparing')
-                )
-            except Exception as e:
-                logger.warning(
-    f"Не удалось обновить сообщение о завершении загрузки: {e}")
-
-            # Отправляем видео или аудио
-            file_path = result.get('filepath')
-            thumbnail_path = result.get('thumbnail')
-            duration = result.get('duration', 0)
-            title = result.get('title', 'Видео')
-
-            if file_path and os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
-                file_extension = os.path.splitext(file_path)[1].lower()
-
-                try:
-                    caption = get_message('download_complete',
-                                        title=title,
-                                        size=round(
-                                            file_size / (1024 * 1024), 1),
-                                        time=round(time.time() - start_time, 1))
-
-                    if file_extension in ['.mp4', '.mkv', '.webm', '.avi']:
-                        # Отправляем видео
-                        await bot.send_video(
-                            chat_id=chat_id,
-                            video=open(file_path, 'rb'),
-                            caption=caption,
-                            duration=int(duration) if duration else None,
-                            thumb=open(thumbnail_path, 'rb') if thumbnail_path and os.path.exists(
-                                thumbnail_path) else None,
-                            supports_streaming=True
-                        )
-                    elif file_extension in ['.mp3', '.m4a', '.ogg', '.opus']:
-                        # Отправляем аудио
-                        await bot.send_audio(
-                            chat_id=chat_id,
-                            audio=open(file_path, 'rb'),
-                            caption=caption,
-                            duration=int(duration) if duration else None,
-                            thumb=open(thumbnail_path, 'rb') if thumbnail_path and os.path.exists(
-                                thumbnail_path) else None,
-                            title=title
-                        )
-                    else:
-                        # Отправляем как документ
-                        await bot.send_document(
-                            chat_id=chat_id,
-                            document=open(file_path, 'rb'),
-                            caption=caption,
-                            thumb=open(thumbnail_path, 'rb') if thumbnail_path and os.path.exists(
-                                thumbnail_path) else None
-                        )
-
-                    # Удаляем файлы после отправки
-                    try:
-                        os.remove(file_path)
-                        if thumbnail_path and os.path.exists(thumbnail_path):
-                            os.remove(thumbnail_path)
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить файлы после отправки: {e}")
-                        
-                    # Удаляем сообщение о прогрессе
-                    try:
-                        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить сообщение о прогрессе: {e}")
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке результата: {e}")
-                    await bot.edit_message_text(
+                with open(part_path, 'rb') as part_file:
+                    sent_message = await context.bot.send_video(
                         chat_id=chat_id,
-                        message_id=message_id,
-                        text=get_message('download_complete_but_error', error=str(e))
+                        video=part_file,
+                        caption=get_message('split_video_part', part=part_index, total=total_parts, title=title),
+                        supports_streaming=True,
+                        read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
                     )
-            else:
-                logger.error(f"Файл не найден: {file_path}")
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=get_message('download_complete_but_error', error="Файл не найден")
-                )
-        
-        return result
-        
-    except Exception as e:
-        logger.error(f"Ошибка при инициализации загрузки: {e}")
-        if message_id:
-            try:
-                await bot.edit_message_text(
+                await _remember_file_id(url, video_format, title, sent_message, part_index=part_index, part_count=total_parts)
+                sent_parts += 1
+            except Exception as send_err:
+                logger.error(f"Ошибка при отправке части {part_index}: {send_err}")
+                await context.bot.send_message(
                     chat_id=chat_id,
-                    message_id=message_id,
-                    text=get_message('download_error', url=url, error=str(e))
+                    text=f"❌ Ошибка при отправке части {part_index}: {str(send_err)}"
                 )
-            except Exception:
-                pass
-        raise
-
-def download_video(url, ydl_opts, context, user_id):
-    """Синхронная функция для скачивания видео (запускается в отдельном потоке)."""
-    temp_dir = os.path.join(config.DOWNLOAD_DIR, f"user_{user_id}")
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Базовые опции
-    base_opts = {
-        'outtmpl': os.path.join(temp_dir, '%(title)s-%(id)s.%(ext)s'),
-        'quiet': True,
-        'no_warnings': True,
-        'progress_hooks': [lambda d: progress_hook(d, context, url)],
-        'restrictfilenames': True,
-        'no_color': True,
-        'user_id': user_id  # Добавляем ID пользователя в опции
-    }
-    
-    # Объединяем базовые опции с переданными
-    final_opts = {**base_opts, **(ydl_opts or {})}
-    
-    try:
-        with yt_dlp.YoutubeDL(final_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            if info:
-                result = {
-                    'filepath': ydl.prepare_filename(info),
-                    'title': info.get('title', 'Видео'),
-                    'thumbnail': info.get('thumbnail'),
-                    'duration': info.get('duration'),
-                    'size': info.get('filesize', 0)
-                }
-                
-                # Если расширение не соответствует формату, исправляем путь
-                if 'ext' in info and not result['filepath'].endswith(f".{info['ext']}"):
-                    result['filepath'] = f"{os.path.splitext(result['filepath'])[0]}.{info['ext']}"
-                
-                return result
-            else:
-                raise ValueError("Не удалось получить информацию о видео")
-    except Exception as e:
-        logger.error(f"Ошибка при скачивании видео {url}: {e}")
-        raise
-    
-    return None
-
-def progress_hook(d, context, url):
-    """Хук для отслеживания прогресса скачивания."""
-    if not hasattr(context.bot_data, 'progress_data') or url not in context.bot_data['progress_data']:
-        return
-    
-    progress_data = context.bot_data['progress_data'][url]
-    
-    # Обновляем данные о прогрессе
-    if d['status'] == 'downloading':
-        if 'downloaded_bytes' in d:
-            progress_data['downloaded_bytes'] = d['downloaded_bytes']
-        if 'total_bytes' in d:
-            progress_data['total_bytes'] = d['total_bytes']
-        elif 'total_bytes_estimate' in d:
-            progress_data['total_bytes'] = d['total_bytes_estimate']
-        
-        if 'speed' in d and d['speed']:
-            progress_data['speed'] = d['speed']
-        if 'eta' in d:
-            progress_data['eta'] = d['eta']
-        
-        if progress_data['total_bytes'] > 0:
-            progress_data['percent'] = (progress_data['downloaded_bytes'] / progress_data['total_bytes']) * 100
-        
-        progress_data['status'] = 'downloading'
-        progress_data['filename'] = d.get('filename')
-        
-        # Сохраняем ID пользователя, если он есть в данных
-        if 'user_id' in d:
-            progress_data['user_id'] = d['user_id']
-    
-    elif d['status'] == 'finished':
-        progress_data['status'] = 'finished'
-        progress_data['percent'] = 100
-        
-    context.bot_data['progress_data'][url] = progress_data
-
-async def _run_actual_download(context: ContextTypes.DEFAULT_TYPE, url: str, actual_format_id: str, user_id: int, chat_id: int | None, message_id: int | None):
-    """Запускает фоновую задачу обновления прогресса (если нужно) и саму загрузку."""
-    progress_task = None
-    if chat_id and message_id:
-        progress_task = context.application.create_task(
-            update_progress_message(context, chat_id, message_id, url)
-        )
-    
-    try:
-        result = await downloader.download_video(url, actual_format_id, user_id, chat_id, message_id)
-        return result, progress_task
-    except Exception:
-         if progress_task and not progress_task.done():
-              progress_task.cancel()
-         raise
+            finally:
+                # Удаляем отправленную часть
+                try:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                        logger.debug(f"Удалена часть видео после отправки: {part_path}")
+                except OSError as rm_err:
+                    logger.warning(f"Не удалось удалить часть видео {part_path}: {rm_err}")
+    finally:
+        # Нарезка, прерванная ошибкой или отменой: генератор сам удаляет недорезанную часть,
+        # а нарезанная, но не взятая в отправку часть удаляется здесь
+        if not next_part.done():
+            next_part.cancel()
+        try:
+            leftover = await next_part
+        except (asyncio.CancelledError, Exception):
+            leftover = None
+        if leftover and os.path.exists(leftover[2]):
+            os.remove(leftover[2])
+        await parts.aclose()
+    return sent_parts, total_parts
+
+def _large_file_keyboard(file_id: str, allow_fit: bool) -> InlineKeyboardMarkup:
+    """Клавиатура выбора способа получения большого файла: части, прямая ссылка и сжатие."""
+    keyboard = [
+        [
+            InlineKeyboardButton(get_message('split_video_button'), callback_data=f"split_{file_id}"),
+            InlineKeyboardButton(get_message('direct_link_button'), callback_data=f"link_{file_id}")
+        ]
+    ]
+    if allow_fit:
+        keyboard.append([InlineKeyboardButton(get_message('fit_video_button'), callback_data=f"fit_{file_id}")])
+    return InlineKeyboardMarkup(keyboard)
 
 async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, chat_id: int, message_id: int | None, progress_message: Update | None):
     """Обрабатывает результат скачивания, отправляет видео (возможно, по частям)."""
-    video_parts = []
+    keep_source = False
     file_path = result['file_path']
     file_size = result['size']
     title = result.get('title', 'Видео')
+    url = result.get('url')
+    video_format = result.get('format')
+
+    # Видео, уже отправленное ранее, пересылается по file_id без загрузки
+    sent_parts = result.get('sent_parts', 0)
+    if not sent_parts:
+        sent_parts, total_parts = await _send_by_file_ids(context, chat_id, url, video_format)
+        if total_parts and sent_parts == total_parts:
+            if progress_message and message_id:
+                try:
+                    await progress_message.delete()
+                except Exception as del_err:
+                    logger.warning(f"Не удалось удалить сообщение о прогрессе {message_id}: {del_err}")
+            return
 
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Файл не найден после скачивания: {file_path}")
     if file_size == 0:
         raise ValueError(f"Файл после скачивания пустой: {file_path}")
 
+    # Файл кэша закреплен на время отправки, чтобы его не удалила очистка
+    pin_file(file_path)
     try:
         if file_size > config.MAX_TELEGRAM_SIZE:
             # --- Изменено: Предлагаем выбор между разделением и прямой ссылкой, если включено ---
-            if config.DIRECT_LINK_ENABLED:
+            # (если первые части уже отправлены по file_id, дослать остальные - продолжение разделения)
+            if config.DIRECT_LINK_ENABLED and not sent_parts:
                 # Создаем уникальный идентификатор для файла
                 file_id = hashlib.md5(file_path.encode()).hexdigest()[:12]
                 
@@ -840,17 +662,16 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
                 context.bot_data['large_files'][file_id] = {
                     'file_path': file_path,
                     'title': title,
-                    'size': file_size
+                    'size': file_size,
+                    'url': url,
+                    'format': video_format
                 }
                 
-                # Создаем клавиатуру для выбора с коротким идентификатором
-                keyboard = [
-                    [
-                        InlineKeyboardButton(get_message('split_video_button'), callback_data=f"split_{file_id}"),
-                        InlineKeyboardButton(get_message('direct_link_button'), callback_data=f"link_{file_id}")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                # Создаем клавиатуру для выбора с коротким идентификатором.
+                # Немного превышающее лимит видео можно пережать в один файл
+                reply_markup = _large_file_keyboard(
+                    file_id, allow_fit=file_size <= config.MAX_TELEGRAM_SIZE * config.FIT_MAX_SIZE_RATIO
+                )
                 
                 # Отправляем сообщение с выбором
                 size_mb = round(file_size / (1024 * 1024), 1)
@@ -872,6 +693,7 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
                     )
                     
                 # Файл будет обработан позже после выбора пользователя
+                keep_source = True
                 return
             # --- Конец изменения ---
             
@@ -884,21 +706,11 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
             else: 
                  await context.bot.send_message(chat_id=chat_id, text=get_message('split_video_started_no_progress', title=title))
                  
-            video_parts = await downloader.split_large_video(file_path)
-            if not video_parts:
-                raise ValueError(f"Не удалось разделить видео: {file_path}")
-
-            total_parts = len(video_parts)
-            for i, part_path in enumerate(video_parts, 1):
-                logger.info(f"Отправка части {i}/{total_parts}: {part_path}")
-                with open(part_path, 'rb') as part_file:
-                    await context.bot.send_video(
-                        chat_id=chat_id,
-                        video=part_file,
-                        caption=get_message('split_video_part', part=i, total=total_parts, title=title),
-                        supports_streaming=True,
-                        read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
-                    )
+            uploaded_parts, _ = await _send_parts_pipelined(
+                context, chat_id, file_path, title, url, video_format, first_part=sent_parts + 1
+            )
+            if not uploaded_parts:
+                raise ValueError(f"Не удалось разделить и отправить видео: {file_path}")
             if progress_message and message_id:
                  try:
                      await progress_message.edit_text(get_message('split_video_completed'))
@@ -907,13 +719,14 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
         else:
             logger.info(f"Отправка целого файла: {file_path}")
             with open(file_path, 'rb') as video_file:
-                await context.bot.send_video(
+                sent_message = await context.bot.send_video(
                     chat_id=chat_id,
                     video=video_file,
                     caption=f"🎥 {title}",
                     supports_streaming=True,
                     read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
                 )
+            await _remember_file_id(url, video_format, title, sent_message)
             if progress_message and message_id:
                 try:
                     await progress_message.delete()
@@ -921,15 +734,8 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
                     logger.warning(f"Не удалось удалить сообщение о прогрессе {message_id}: {del_err}")
 
     finally:
-        for part_f in video_parts:
-            try:
-                if os.path.exists(part_f):
-                    os.remove(part_f)
-                    logger.info(f"Удалена часть видео: {part_f}")
-            except OSError as rm_err:
-                 logger.warning(f"Не удалось удалить часть видео {part_f}: {rm_err}")
-        
-        if not video_parts and not config.CACHE_ENABLED:
+        unpin_file(file_path)
+        if not keep_source and not config.CACHE_ENABLED:
             try:
                 if os.path.exists(file_path):
                     os.remove(file_path)
@@ -937,45 +743,46 @@ async def _send_video_result(context: ContextTypes.DEFAULT_TYPE, result: dict, c
             except OSError as rm_err:
                 logger.warning(f"Не удалось удалить исходный файл {file_path}: {rm_err}")
 
-def _cleanup_download_state(url: str, canonical_url: str | None, progress_task):
-    """Отменяет задачу прогресса и очищает словари (используя нормализованный ключ карты)."""
+def _cleanup_download_state(key: tuple, canonical_url: str | None, progress_task):
+    """Отменяет задачу прогресса и очищает словари для запроса key (download_key), не трогая другие запросы того же видео."""
     if progress_task and not progress_task.done():
         progress_task.cancel()
-        logger.debug(f"Задача обновления прогресса для URL '{url}' отменена в _cleanup_download_state.")
+        logger.debug(f"Задача обновления прогресса для '{key}' отменена в _cleanup_download_state.")
     
     with data_lock:
-        download_info = active_downloads.pop(url, None) # Удаляем из active_downloads по оригинальному URL
+        download_info = active_downloads.pop(key, None) # Удаляем из active_downloads по ключу запроса
         if download_info:
-            logger.debug(f"Очистка active_downloads для {url} в _cleanup_download_state.")
+            logger.debug(f"Очистка active_downloads для {key} в _cleanup_download_state.")
             # --- Изменено: Удаляем из карты по нормализованному каноническому URL ---
             stored_canonical_url = download_info.get('canonical_url') # Получаем сохраненный канонический URL
             if stored_canonical_url:
-                normalized_canonical_to_remove = normalize_url(stored_canonical_url)
+                normalized_canonical_to_remove = canonical_key(stored_canonical_url)
                 if normalized_canonical_to_remove and normalized_canonical_to_remove in canonical_url_map:
-                    # Доп. проверка: убедимся, что значение в карте соответствует удаляемому original_url
-                    if canonical_url_map[normalized_canonical_to_remove] == url:
+                    # Доп. проверка: убедимся, что значение в карте соответствует удаляемому запросу
+                    if canonical_url_map[normalized_canonical_to_remove] == key:
                         del canonical_url_map[normalized_canonical_to_remove]
                         logger.debug(f"Removed mapping for normalized {normalized_canonical_to_remove}. Current map keys: {list(canonical_url_map.keys())}")
                     else:
                         # Этого не должно происходить, но логируем на всякий случай
-                        logger.warning(f"Map value mismatch during cleanup for normalized key {normalized_canonical_to_remove}. Expected value '{url}', found '{canonical_url_map[normalized_canonical_to_remove]}'. Map not modified.")
+                        logger.warning(f"Map value mismatch during cleanup for normalized key {normalized_canonical_to_remove}. Expected value '{key}', found '{canonical_url_map[normalized_canonical_to_remove]}'. Map not modified.")
             # --- Конец изменений ---
-        elif url in canonical_url_map:
+        elif key in canonical_url_map.values():
              # Попытка очистить карту, даже если active_downloads уже удален
-             logger.warning(f"active_downloads для '{url}' не найден, но пытаемся очистить карту.")
-             normalized_original = normalize_url(url)
+             logger.warning(f"active_downloads для '{key}' не найден, но пытаемся очистить карту.")
              found_key_to_remove = None
              for k, v in canonical_url_map.items():
-                 if v == url: # Ищем ключ, значение которого равно нашему original_url
+                 if v == key: # Ищем ключ, значение которого равно нашему запросу
                      found_key_to_remove = k
                      break
              if found_key_to_remove:
                  del canonical_url_map[found_key_to_remove]
-                 logger.debug(f"Removed mapping with value '{url}' (key: {found_key_to_remove}) during fallback cleanup.")
+                 logger.debug(f"Removed mapping with value '{key}' (key: {found_key_to_remove}) during fallback cleanup.")
 
 # --- Основная функция-оркестратор для одиночного скачивания --- 
 async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TYPE, url, format_id):
     """Загружает видео с выбранным качеством."""
+    progress_task = None
+    key = download_key(update.effective_user.id, update.effective_chat.id, url)
     try:
         # Отправляем сообщение о начале загрузки
         message = await update.callback_query.edit_message_text(
@@ -990,7 +797,7 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Добавляем URL в активные загрузки
         with data_lock:
-            active_downloads[url] = {
+            active_downloads[key] = {
                 'status': 'initializing',
                 'percent': 0,
                 'percent_rounded': 0,
@@ -1036,87 +843,106 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
                 'format': format_id
             }
             
-        # Запускаем загрузку с увеличенным таймаутом
-        try:
-            # Устанавливаем таймаут в 10 минут (600 секунд)
-            result = await asyncio.wait_for(
-                downloader.download_video(
+        # Видео, уже отправленное ранее, пересылается по file_id без скачивания и загрузки
+        sent_parts, total_parts = await _send_by_file_ids(context, chat_id, url, format_id)
+        if total_parts and sent_parts == total_parts:
+            await db.log_download(user_id, url, "success_file_id")
+            await update.callback_query.edit_message_text(
+                text=f"✅ Видео успешно загружено и отправлено!"
+            )
+            return
+        
+        # Готовый файл из общего кэша загрузок отправляется без обращения к yt-dlp
+        result = None
+        from_cache = False
+        cached_video = await _lookup_download_cache(url, format_id)
+        if cached_video:
+            logger.info(f"Видео {url} ({format_id}) найдено в кэше: {cached_video['file_path']}")
+            await db.log_download(user_id, url, "success_cache")
+            from_cache = True
+            result = {
+                'success': True,
+                'filename': cached_video['file_path'],
+                'title': cached_video['title'] or 'Видео'
+            }
+        
+        if result is None:
+            # Запускаем обновление прогресса на время загрузки
+            progress_task = asyncio.create_task(
+                update_progress_message(context.bot, chat_id, message_id, key)
+            )
+        
+            # Запускаем загрузку в пуле загрузок (таймаут прерывает само скачивание)
+            try:
+                result = await downloader.download_video(
                     url=url,
                     format_id=format_id,
                     user_id=user_id,
                     chat_id=chat_id,
                     message_id=message_id,
-                    ydl_opts=ydl_opts  # Передаем дополнительные опции
-                ),
-                timeout=600
-            )
-        except asyncio.TimeoutError:
-            logger.error(f"Таймаут при загрузке видео: {url}")
-            await update.callback_query.edit_message_text(
-                text="❌ Ошибка: превышено время ожидания при загрузке видео. Попробуйте еще раз или выберите другое качество.",
-                reply_markup=None
-            )
-            return
-        except Exception as e:
-            error_str = str(e)
-            logger.error(f"Ошибка при загрузке видео: {e}")
+                    ydl_opts=ydl_opts,  # Передаем дополнительные опции
+                    timeout=config.DOWNLOAD_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"Таймаут при загрузке видео: {url}")
+                await update.callback_query.edit_message_text(
+                    text="❌ Ошибка: превышено время ожидания при загрузке видео. Попробуйте еще раз или выберите другое качество.",
+                    reply_markup=None
+                )
+                return
+            except Exception as e:
+                error_str = str(e)
+                logger.error(f"Ошибка при загрузке видео: {e}")
             
-            # Обработка ошибки недоступного формата
-            if "Requested format is not available" in error_str:
-                # Пробуем скачать с автоматическим выбором формата
-                try:
-                    logger.info(f"Пробуем скачать с автоматическим выбором формата: {url}")
-                    await update.callback_query.edit_message_text(
-                        text="⚠️ Выбранный формат недоступен. Пробуем скачать в наилучшем доступном качестве...",
-                        reply_markup=None
-                    )
+                # Обработка ошибки недоступного формата
+                if "Requested format is not available" in error_str:
+                    # Пробуем скачать с автоматическим выбором формата
+                    try:
+                        logger.info(f"Пробуем скачать с автоматическим выбором формата: {url}")
+                        await update.callback_query.edit_message_text(
+                            text="⚠️ Выбранный формат недоступен. Пробуем скачать в наилучшем доступном качестве...",
+                            reply_markup=None
+                        )
                     
-                    # Используем 'best' для автоматического выбора лучшего формата
-                    auto_opts = {'format': 'best'}
-                    result = await asyncio.wait_for(
-                        downloader.download_video(
+                        # Используем 'best' для автоматического выбора лучшего формата
+                        auto_opts = {'format': 'best'}
+                        result = await downloader.download_video(
                             url=url,
                             format_id='best', # Используем 'best' вместо выбранного формата
                             user_id=user_id,
                             chat_id=chat_id,
                             message_id=message_id,
-                            ydl_opts=auto_opts
-                        ),
-                        timeout=600
-                    )
-                except Exception as retry_error:
-                    logger.error(f"Не удалось скачать даже с автоматическим выбором формата: {retry_error}")
+                            ydl_opts=auto_opts,
+                            timeout=config.DOWNLOAD_TIMEOUT
+                        )
+                    except Exception as retry_error:
+                        logger.error(f"Не удалось скачать даже с автоматическим выбором формата: {retry_error}")
+                        await update.callback_query.edit_message_text(
+                            text=f"❌ Не удалось скачать видео даже с автоматическим выбором формата. Возможно, видео защищено от скачивания.",
+                            reply_markup=None
+                        )
+                        return
+                else:
+                    # Для других ошибок показываем сообщение об ошибке
                     await update.callback_query.edit_message_text(
-                        text=f"❌ Не удалось скачать видео даже с автоматическим выбором формата. Возможно, видео защищено от скачивания.",
+                        text=f"❌ Ошибка при загрузке видео: {error_str}",
                         reply_markup=None
                     )
                     return
-            else:
-                # Для других ошибок показываем сообщение об ошибке
+        
+            # Загрузка завершена - останавливаем обновление прогресса
+            progress_task.cancel()
+        
+            # Проверяем результат загрузки
+            if not result or not result.get('success', False):
+                error_message = result.get('error', 'Неизвестная ошибка') if result else 'Неизвестная ошибка'
+                logger.error(f"Ошибка при загрузке видео: {error_message}")
                 await update.callback_query.edit_message_text(
-                    text=f"❌ Ошибка при загрузке видео: {error_str}",
+                    text=f"❌ Ошибка при загрузке видео: {error_message}",
                     reply_markup=None
                 )
                 return
         
-        # Запускаем обновление прогресса
-        progress_task = asyncio.create_task(
-            update_progress_message(chat_id, message_id, url)
-        )
-        
-        # Отменяем задачу обновления прогресса
-        progress_task.cancel()
-        
-        # Проверяем результат загрузки
-        if not result or not result.get('success', False):
-            error_message = result.get('error', 'Неизвестная ошибка') if result else 'Неизвестная ошибка'
-            logger.error(f"Ошибка при загрузке видео: {error_message}")
-            await update.callback_query.edit_message_text(
-                text=f"❌ Ошибка при загрузке видео: {error_message}",
-                reply_markup=None
-            )
-            return
-        
         # Получаем информацию о загруженном файле
         file_path = result.get('filename')
         title = result.get('title', 'Видео')
@@ -1129,6 +955,9 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return
         
+        if not from_cache:
+            await _store_download_cache(url, format_id, title, file_path)
+        
         # Получаем размер файла
         file_size = os.path.getsize(file_path)
         
@@ -1150,7 +979,11 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
             context.bot_data['large_files'][file_id] = {
                 'file_path': file_path,
                 'title': title,
-                'size': file_size_mb
+                'size': file_size_mb,
+                'url': url,
+                'format': format_id,
+                # Части, уже отправленные по file_id: при разделении отправляются только остальные
+                'sent_parts': sent_parts
             }
             
             # Создаем клавиатуру с опциями
@@ -1160,6 +993,8 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
                     InlineKeyboardButton("Создать прямую ссылку", callback_data=f"link_{file_id}")
                 ]
             ]
+            if file_size <= config.MAX_TELEGRAM_SIZE * config.FIT_MAX_SIZE_RATIO:
+                keyboard.append([InlineKeyboardButton("Сжать до 50 МБ", callback_data=f"fit_{file_id}")])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             # Отправляем сообщение с опциями
@@ -1171,14 +1006,15 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Если файл не слишком большой, отправляем его напрямую
         logger.info(f"Отправка файла: {file_path}")
-        with open(file_path, 'rb') as video_file:
-            await context.bot.send_video(
+        with pinned_file(file_path), open(file_path, 'rb') as video_file:
+            sent_message = await context.bot.send_video(
                 chat_id=chat_id,
                 video=video_file,
                 caption=f"🎥 {title}",
                 supports_streaming=True,
                 read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
             )
+        await _remember_file_id(url, format_id, title, sent_message)
         
         # Отправляем сообщение об успешной загрузке
         await update.callback_query.edit_message_text(
@@ -1197,7 +1033,7 @@ async def download_with_quality(update: Update, context: ContextTypes.DEFAULT_TY
             logger.error(f"Не удалось отправить сообщение об ошибке: {edit_err}")
     finally:
         # Очищаем состояние загрузки
-        _cleanup_download_state(url, None, None)
+        _cleanup_download_state(key, None, progress_task)
 
 # --- Новая функция-воркер для скачивания видео из плейлиста --- 
 async def _download_playlist_video(context: ContextTypes.DEFAULT_TYPE, video_url: str, user_id: int, chat_id: int, quality: str, semaphore: asyncio.Semaphore):
@@ -1210,30 +1046,44 @@ async def _download_playlist_video(context: ContextTypes.DEFAULT_TYPE, video_url
         progress_task_placeholder = None 
         
         try:
-            actual_format_id, canonical_url, start_time, _ = await _initialize_download(
-                context, video_url, quality, user_id, chat_id, None 
-            )
+            # Видео, уже отправленное ранее, пересылается по file_id без скачивания
+            sent_parts, total_parts = await _send_by_file_ids(context, chat_id, video_url, quality)
+            if total_parts and sent_parts == total_parts:
+                if user_id:
+                    await db.log_download(user_id, video_url, "success_file_id_playlist")
+                return
 
-            cached_video = db.get_cached_video(video_url, actual_format_id)
+            cached_video = await _lookup_download_cache(video_url, quality)
             if cached_video:
                 logger.info(f"(Плейлист) Видео {video_url} найдено в кэше: {cached_video['file_path']}")
-                if os.path.exists(cached_video['file_path']):
-                    if user_id:
-                        db.log_download(user_id, video_url, "success_cache_playlist")
-                    await _send_video_result(context, cached_video, chat_id, None, None) 
-                    return 
-                else:
-                    db.remove_from_cache(video_url)
+                if user_id:
+                    await db.log_download(user_id, video_url, "success_cache_playlist")
+                await _send_video_result(context, {**cached_video, 'url': video_url, 'format': quality, 'sent_parts': sent_parts}, chat_id, None, None)
+                return
 
-            result, _ = await _run_actual_download(
-                context, video_url, actual_format_id, user_id, None, None 
+            start_time = time.time()
+            ydl_opts = {'format': config.VIDEO_FORMATS.get(quality, config.DEFAULT_VIDEO_FORMAT)}
+            result = await downloader.download_video(
+                video_url, quality, user_id, chat_id, None,
+                ydl_opts=ydl_opts, timeout=config.DOWNLOAD_TIMEOUT
             )
+            if not result.get('success'):
+                raise ValueError(result.get('error', 'Неизвестная ошибка'))
+
+            file_path = result['filename']
+            title = result.get('title') or 'Видео'
+            await _store_download_cache(video_url, quality, title, file_path)
 
-            if result:
-                if start_time:
-                    download_duration = round(time.time() - start_time, 1)
-                    logger.info(f"(Плейлист) Видео '{result['title']}' скачано за {download_duration} сек.")
-                await _send_video_result(context, result, chat_id, None, None) 
+            download_duration = round(time.time() - start_time, 1)
+            logger.info(f"(Плейлист) Видео '{title}' скачано за {download_duration} сек.")
+            await _send_video_result(context, {
+                'file_path': file_path,
+                'title': title,
+                'size': os.path.getsize(file_path),
+                'url': video_url,
+                'format': quality,
+                'sent_parts': sent_parts
+            }, chat_id, None, None)
 
         except Exception as e:
             logger.error(f"(Плейлист) Ошибка при обработке видео {video_url}: {e}")
@@ -1243,7 +1093,7 @@ async def _download_playlist_video(context: ContextTypes.DEFAULT_TYPE, video_url
             )
         finally:
             # Передаем оригинальный video_url и полученный canonical_url для очистки
-            _cleanup_download_state(video_url, canonical_url, progress_task_placeholder)
+            _cleanup_download_state(download_key(user_id, chat_id, video_url), canonical_url, progress_task_placeholder)
 
 # --- Конец функции-воркера ---
 
@@ -1329,7 +1179,7 @@ async def playlist_confirm_callback(update: Update, context: ContextTypes.DEFAUL
     except Exception as e:
          logger.warning(f"Не удалось обновить сообщение о начале загрузки плейлиста: {e}")
 
-    user_quality = db.get_user_settings(user_id)
+    user_quality = await db.get_user_settings(user_id)
     if user_quality == 'auto':
          logger.info(f"(Плейлист) Качество пользователя 'auto', используем 'high'.")
          user_quality = 'high' 
@@ -1354,7 +1204,7 @@ async def playlist_confirm_callback(update: Update, context: ContextTypes.DEFAUL
             logger.info(f"Загрузка плейлиста {original_message_id} была отменена. Пропуск оставшихся видео.")
             break
             
-        if not db.check_download_limit(user_id):
+        if not await db.check_download_limit(user_id):
             logger.warning(f"(Плейлист) Достигнут лимит для user {user_id}. Пропуск оставшихся {len(video_urls) - started_count} видео.")
             await context.bot.send_message(
                  chat_id=chat_id, 
@@ -1362,7 +1212,7 @@ async def playlist_confirm_callback(update: Update, context: ContextTypes.DEFAUL
             )
             break 
         
-        db.update_user_stats(user_id, update.effective_user.username)
+        await db.update_user_stats(user_id, update.effective_user.username)
         started_count += 1
         
         download_task = context.application.create_task(
@@ -1543,7 +1393,7 @@ async def playlist_cancel_callback(update: Update, context: ContextTypes.DEFAULT
 async def send_notification(context: ContextTypes.DEFAULT_TYPE, user_id: int, notification_type: str, **kwargs):
     """Отправляет уведомление пользователю, если оно включено в настройках."""
     try:
-        settings = db.get_notification_settings(user_id)
+        settings = await db.get_notification_settings(user_id)
         if settings.get(notification_type, False): # Проверяем, включен ли этот тип уведомлений
             message_key = f"{notification_type}_notification" # Формируем ключ для локализации
             message_text = get_message(message_key, **kwargs)
@@ -1560,7 +1410,7 @@ async def send_notification(context: ContextTypes.DEFAULT_TYPE, user_id: int, no
 async def notifications_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /notifications"""
     user_id = update.effective_user.id
-    settings = db.get_notification_settings(user_id)
+    settings = await db.get_notification_settings(user_id)
     
     keyboard = []
     # Словарь с названиями уведомлений (можно вынести в локализацию)
@@ -1615,9 +1465,9 @@ async def notification_callback(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     # Переключаем настройку в БД
-    if db.toggle_notification(user_id, notification_type):
+    if await db.toggle_notification(user_id, notification_type):
         # Обновляем клавиатуру
-        settings = db.get_notification_settings(user_id)
+        settings = await db.get_notification_settings(user_id)
         keyboard = []
         notification_names = {
              "download_complete": "Завершение загрузки",
@@ -1715,7 +1565,7 @@ def main():
     # if not os.path.exists(config.DOWNLOAD_DIR):
     #     os.makedirs(config.DOWNLOAD_DIR)
     
-    application = Application.builder().token(config.TOKEN).build()
+    application = Application.builder().token(config.TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -1740,25 +1590,22 @@ def main():
     application.add_handler(CallbackQueryHandler(quality_callback, pattern=r'^download_'))
     # --- Регистрируем обработчик колбэков для больших файлов ---
     if config.DIRECT_LINK_ENABLED:
-        application.add_handler(CallbackQueryHandler(large_file_callback, pattern=r'^(split|link)_'))
+        application.add_handler(CallbackQueryHandler(large_file_callback, pattern=r'^(split|link|fit)_'))
     # --- Конец добавления ---
     
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url))
     
-    # --- Добавляем планировщик задач для очистки устаревших ссылок ---
-    if config.DIRECT_LINK_ENABLED:
-        # Создаем планировщик для периодической очистки устаревших ссылок
-        job_queue = application.job_queue
-        job_queue.run_repeating(
-            cleanup_expired_links, 
-            interval=config.DIRECT_LINK_CLEANUP_INTERVAL,  # Интервал из конфига
-            first=10  # Первый запуск через 10 секунд после старта бота
-        )
-        logger.info(f"Настроена периодическая очистка устаревших ссылок (интервал: {config.DIRECT_LINK_CLEANUP_INTERVAL} сек)")
-    # --- Конец добавления ---
+    if config.CACHE_ENABLED:
+        # Просроченные файлы кэша загрузок удаляются раз в сутки
+        application.job_queue.run_repeating(cleanup_expired_cache, interval=24 * 60 * 60, first=60)
     
     application.run_polling()
 
+    # Останавливаем пул загрузок (в процессном режиме - и дочерние процессы)
+    download_executor.shutdown()
+    # Дожидаемся записей, поставленных в очередь потока базы данных
+    shutdown_async_database()
+
 # --- Восстановленная функция format_callback --- 
 async def format_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора формата/категории для одиночного видео."""
@@ -1833,15 +1680,46 @@ async def format_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Выбран формат: {format_id} для URL: {url}")
 
     # Обновляем статистику перед началом загрузки
-    db.update_user_stats(update.effective_user.id, update.effective_user.username)
+    await db.update_user_stats(update.effective_user.id, update.effective_user.username)
     
     # Запускаем скачивание одиночного видео
     await download_with_quality(update, context, url, format_id)
 # --- Конец восстановленной функции --- 
 
 # --- Новая функция обработки колбэков для выбора способа получения больших файлов ---
+async def _fit_and_send(context: ContextTypes.DEFAULT_TYPE, query, chat_id: int, file_info: dict, fit_format: str):
+    """Пережимает большое видео под лимит Telegram и отправляет одним файлом, показывая прогресс сжатия."""
+    title = file_info['title']
+    await query.edit_message_text(get_message('fit_video_started', title=title))
+
+    async def report_progress(percent):
+        try:
+            await query.edit_message_text(get_message('fit_video_progress', title=title, percent=percent))
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                logger.warning(f"Не удалось обновить прогресс сжатия: {e}")
+
+    fit_path = await transcode_pool.fit_to_size(file_info['file_path'], config.SPLIT_PART_TARGET, on_progress=report_progress)
+    try:
+        with open(fit_path, 'rb') as video_file:
+            sent_message = await context.bot.send_video(
+                chat_id=chat_id,
+                video=video_file,
+                caption=f"🎥 {title}",
+                supports_streaming=True,
+                read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
+            )
+    finally:
+        if os.path.exists(fit_path):
+            os.remove(fit_path)
+    await _remember_file_id(file_info.get('url'), fit_format, title, sent_message)
+    try:
+        await query.message.delete()
+    except Exception as del_err:
+        logger.warning(f"Не удалось удалить сообщение о прогрессе сжатия: {del_err}")
+
 async def large_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает выбор пользователя при работе с большими файлами (разделение или прямая ссылка)"""
+    """Обрабатывает выбор пользователя при работе с большими файлами (разделение, прямая ссылка или сжатие)"""
     query = update.callback_query
     data = query.data
     
@@ -1853,6 +1731,9 @@ async def large_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         elif data.startswith("link_"):
             action = "link"
             file_id = data[len("link_"):]
+        elif data.startswith("fit_"):
+            action = "fit"
+            file_id = data[len("fit_"):]
         else:
             logger.error(f"Неверный формат callback_data: {data}")
             await query.answer("Произошла ошибка.")
@@ -1898,117 +1779,132 @@ async def large_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     title = file_info['title']
     file_size = file_info['size']
     
-    if action == "split":
-        # Разделяем видео на части
-        await query.edit_message_text(get_message('split_video_started'))
+    # Файл кэша закреплен, пока из него нарезаются части или создается ссылка
+    pin_file(file_path)
+    # После неудачного сжатия пользователь выбирает другой способ, данные файла нужны снова
+    keep_file_info = False
+    try:
+        if action == "split":
+            # Разделяем видео на части
+            await query.edit_message_text(get_message('split_video_started'))
         
-        try:
-            video_parts = await downloader.split_large_video(file_path)
-            if not video_parts:
+            try:
+                # Части, уже отправленные ранее, пересылаются по file_id без нарезки и загрузки;
+                # если отправились не все, нарезаются и загружаются только оставшиеся
+                sent_parts = file_info.get('sent_parts', 0)
+                total_parts = 0
+                if not sent_parts:
+                    sent_parts, total_parts = await _send_by_file_ids(context, chat_id, file_info.get('url'), file_info.get('format'))
+                if not total_parts or sent_parts < total_parts:
+                    sent_parts, _ = await _send_parts_pipelined(
+                        context, chat_id, file_path, title, file_info.get('url'), file_info.get('format'),
+                        first_part=sent_parts + 1
+                    )
+                    if not sent_parts:
+                        await context.bot.send_message(
+                            chat_id=chat_id,
+                            text=get_message('download_error')
+                        )
+                        return
+            
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=get_message('split_video_completed')
+                )
+            
+            except Exception as e:
+                logger.error(f"Ошибка при разделении файла {file_path}: {e}")
+                import traceback
+                logger.error(traceback.format_exc())
                 await context.bot.send_message(
                     chat_id=chat_id,
                     text=get_message('download_error')
                 )
-                return
             
-            total_parts = len(video_parts)
-            for i, part_path in enumerate(video_parts, 1):
-                logger.info(f"Отправка части {i}/{total_parts}: {part_path}")
+        elif action == "fit":
+            # Пережимаем видео в один файл под лимит Telegram
+            fit_format = f"{file_info.get('format')}+fit"
+            try:
+                sent_parts, total_parts = await _send_by_file_ids(context, chat_id, file_info.get('url'), fit_format)
+                if total_parts and sent_parts == total_parts:
+                    await query.message.delete()
+                else:
+                    await _fit_and_send(context, query, chat_id, file_info, fit_format)
+            except Exception as e:
+                logger.error(f"Ошибка при сжатии файла {file_path}: {e}")
+                keep_file_info = True
+                # Повторно предлагаем разделение и прямую ссылку, о которых говорит сообщение об ошибке
+                reply_markup = _large_file_keyboard(file_id, allow_fit=False)
                 try:
-                    with open(part_path, 'rb') as part_file:
-                        await context.bot.send_video(
-                            chat_id=chat_id,
-                            video=part_file,
-                            caption=get_message('split_video_part', part=i, total=total_parts, title=title),
-                            supports_streaming=True,
-                            read_timeout=120, write_timeout=120, connect_timeout=60, pool_timeout=120
-                        )
-                except Exception as send_err:
-                    logger.error(f"Ошибка при отправке части {i}: {send_err}")
+                    await query.edit_message_text(get_message('fit_video_error'), reply_markup=reply_markup)
+                except Exception:
+                    await context.bot.send_message(chat_id=chat_id, text=get_message('fit_video_error'), reply_markup=reply_markup)
+            
+        elif action == "link":
+            # Генерируем прямую ссылку с правильным именем файла
+            await query.edit_message_text(get_message('direct_link_generating'))
+        
+            try:
+                # Импортируем здесь для избежания циклических зависимостей
+                from link_generator import LinkGenerator
+                link_gen = LinkGenerator()
+            
+                # Получаем оригинальное имя файла с расширением
+                original_filename = os.path.basename(file_path)
+                # Добавляем название видео к имени файла, если оно не является просто номером
+                if title and not title.isdigit() and title != "Видео" and title != original_filename:
+                    name_parts = os.path.splitext(original_filename)
+                    original_filename = f"{title}{name_parts[1]}" if len(name_parts) > 1 else f"{title}.mp4"
+                
+                # Одно и то же видео в одном формате публикуется один раз: повторный запрос продлевает ссылку
+                content_key = None
+                if file_info.get('url') and file_info.get('format'):
+                    content_key = f"{canonical_key(file_info['url'])}|{file_info['format']}"
+                
+                # Генерируем ссылку с названием видео в имени файла
+                link_info = await link_gen.generate_link(file_path, original_filename, content_key=content_key)
+            
+                if not link_info:
                     await context.bot.send_message(
                         chat_id=chat_id,
-                        text=f"❌ Ошибка при отправке части {i}: {str(send_err)}"
+                        text=get_message('direct_link_error')
                     )
-                    
-                # Удаляем отправленную часть
-                try:
-                    if os.path.exists(part_path):
-                        os.remove(part_path)
-                        logger.debug(f"Удалена часть видео после отправки: {part_path}")
-                except OSError as rm_err:
-                    logger.warning(f"Не удалось удалить часть видео {part_path}: {rm_err}")
-            
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=get_message('split_video_completed')
-            )
+                    return
             
-        except Exception as e:
-            logger.error(f"Ошибка при разделении файла {file_path}: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=get_message('download_error')
-            )
+                # Форматируем дату истечения для локализации
+                expires_str = link_info['expires'].strftime("%d.%m.%Y %H:%M")
             
-    elif action == "link":
-        # Генерируем прямую ссылку с правильным именем файла
-        await query.edit_message_text(get_message('direct_link_generating'))
-        
-        try:
-            # Импортируем здесь для избежания циклических зависимостей
-            from link_generator import LinkGenerator
-            link_gen = LinkGenerator()
+                # Отправляем сообщение с прямой ссылкой
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=get_message('direct_link_ready', 
+                        title=title,
+                        url=link_info['url'],
+                        size=link_info['size_mb'],
+                        expires=expires_str
+                    ),
+                    parse_mode='HTML',
+                    disable_web_page_preview=False
+                )
             
-            # Получаем оригинальное имя файла с расширением
-            original_filename = os.path.basename(file_path)
-            # Добавляем название видео к имени файла, если оно не является просто номером
-            if title and not title.isdigit() and title != "Видео" and title != original_filename:
-                name_parts = os.path.splitext(original_filename)
-                original_filename = f"{title}{name_parts[1]}" if len(name_parts) > 1 else f"{title}.mp4"
-                
-            # Генерируем ссылку с названием видео в имени файла
-            link_info = await link_gen.generate_link(file_path, original_filename)
+                logger.info(f"Создана прямая ссылка для {title}: {link_info['url']}")
             
-            if not link_info:
+            except Exception as e:
+                logger.error(f"Ошибка при создании прямой ссылки для {file_path}: {e}")
+                import traceback
+                logger.error(traceback.format_exc())
                 await context.bot.send_message(
                     chat_id=chat_id,
                     text=get_message('direct_link_error')
                 )
-                return
-            
-            # Форматируем дату истечения для локализации
-            expires_str = link_info['expires'].strftime("%d.%m.%Y %H:%M")
-            
-            # Отправляем сообщение с прямой ссылкой
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=get_message('direct_link_ready', 
-                    title=title,
-                    url=link_info['url'],
-                    size=link_info['size_mb'],
-                    expires=expires_str
-                ),
-                parse_mode='HTML',
-                disable_web_page_preview=False
-            )
-            
-            logger.info(f"Создана прямая ссылка для {title}: {link_info['url']}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при создании прямой ссылки для {file_path}: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=get_message('direct_link_error')
-            )
-    
-    # Удаляем файл из контекста
-    del context.bot_data['large_files'][file_id]
-    if not context.bot_data['large_files']:
-        del context.bot_data['large_files']
+    finally:
+        unpin_file(file_path)
+        # Удаляем файл из контекста (в том числе при досрочном выходе из обработчика)
+        if not keep_file_info:
+            large_files = context.bot_data.get('large_files', {})
+            large_files.pop(file_id, None)
+            if not large_files:
+                context.bot_data.pop('large_files', None)
 
 # --- Новая команда для статистики прямых ссылок ---
 async def directlinks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2033,17 +1929,32 @@ async def directlinks_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 # --- Функция для периодической очистки устаревших ссылок ---
-async def cleanup_expired_links(context: ContextTypes.DEFAULT_TYPE):
-    """Периодически очищает устаревшие прямые ссылки"""
+async def post_init(application: Application):
+    """Переносит старые .meta файлы, запускает планировщик удаления прямых ссылок и встроенный файловый сервер"""
+    if config.DIRECT_LINK_ENABLED:
+        from link_generator import LinkGenerator, expiry_scheduler
+        # Переносим старые .meta файлы в индекс прямых ссылок (до загрузки сроков планировщиком)
+        await LinkGenerator().import_meta_files()
+        await expiry_scheduler.start()
+        if config.DIRECT_LINK_SERVER_ENABLED:
+            from file_server import LinkFileServer
+            application.bot_data['link_file_server'] = LinkFileServer()
+            await application.bot_data['link_file_server'].start()
+
+async def post_shutdown(application: Application):
+    """Останавливает планировщик удаления прямых ссылок и файловый сервер"""
+    if config.DIRECT_LINK_ENABLED:
+        from link_generator import expiry_scheduler
+        expiry_scheduler.stop()
+        if 'link_file_server' in application.bot_data:
+            await application.bot_data.pop('link_file_server').stop()
+
+async def cleanup_expired_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически удаляет просроченные файлы кэша загрузок"""
     try:
-        from link_generator import LinkGenerator
-        link_gen = LinkGenerator()
-        count = await link_gen.cleanup_expired_links()
-        
-        if count > 0:
-            logger.info(f"Удалено {count} устаревших файлов прямых ссылок")
+        await db.clean_expired_cache()
     except Exception as e:
-        logger.error(f"Ошибка при очистке устаревших ссылок: {e}")
+        logger.error(f"Ошибка при очистке кэша загрузок: {e}")
 # --- Конец новых функций ---
 
 # --- Новый обработчик для кнопки отмены загрузки --- 
@@ -2090,8 +2001,8 @@ async def cancel_download_callback(update: Update, context: ContextTypes.DEFAULT
             await query.answer("Вы не можете отменить чужую загрузку", show_alert=True)
             return
         
-        # Отменяем загрузку
-        success = downloader.cancel_download(url)
+        # Отменяем загрузку этого пользователя в этом чате (чужие запросы того же видео продолжаются)
+        success = downloader.cancel_download(download_key(user_id, update.effective_chat.id, url))
         
         if success:
             # Обновляем сообщение
@@ -2158,27 +2069,34 @@ async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Вы не можете отменить чужую загрузку")
             return
             
-        # Получаем оригинальный URL из контекста чата
+        # Находим загрузку этого пользователя в этом чате по хешу URL из кнопки
         chat_id = update.effective_chat.id
-        if chat_id not in context.chat_data or CHAT_CONTEXT_KEY not in context.chat_data[chat_id]:
-            logger.error(f"URL не найден в контексте чата {chat_id}")
-            await query.edit_message_text("❌ Ошибка: URL не найден в контексте")
-            return
-            
-        url = context.chat_data[chat_id][CHAT_CONTEXT_KEY]
+        with data_lock:
+            key = next((
+                key for key in active_downloads
+                if key[:2] == (user_id, chat_id) and hashlib.md5(key[2].encode()).hexdigest()[:10] == url_hash
+            ), None)
+        if key is None:
+            # Загрузка уже завершена - используем URL из контекста чата
+            if chat_id not in context.chat_data or CHAT_CONTEXT_KEY not in context.chat_data[chat_id]:
+                logger.error(f"URL не найден в контексте чата {chat_id}")
+                await query.edit_message_text("❌ Ошибка: URL не найден в контексте")
+                return
+            key = download_key(user_id, chat_id, context.chat_data[chat_id][CHAT_CONTEXT_KEY])
         
-        # Отменяем загрузку
+        # Отменяем загрузку (прерывание скачивания в пуле - только если ее не ждут другие запросы)
+        downloader.cancel_download(key)
         with data_lock:
-            if url in active_downloads:
-                active_downloads[url]['cancelled'] = True
-                logger.info(f"Загрузка {url} отменена пользователем {user_id}")
+            if key in active_downloads:
+                active_downloads[key]['cancelled'] = True
+                logger.info(f"Загрузка {key[2]} отменена пользователем {user_id}")
                 
                 # Отменяем задачу обновления прогресса, если она существует
-                if 'progress_task' in active_downloads[url]:
-                    progress_task = active_downloads[url]['progress_task']
+                if 'progress_task' in active_downloads[key]:
+                    progress_task = active_downloads[key]['progress_task']
                     if progress_task and not progress_task.done():
                         progress_task.cancel()
-                        logger.debug(f"Задача обновления прогресса для URL '{url}' отменена.")
+                        logger.debug(f"Задача обновления прогресса для URL '{key[2]}' отменена.")
         
         # Отправляем сообщение об отмене
         await query.edit_message_text("❌ Загрузка отменена")
@@ -2260,7 +2178,15 @@ async def quality_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Ошибка: неверный формат данных")
             return
         
-        format_id = data[first_format_underscore_pos+1:last_underscore_pos]
+        short_id = data[first_format_underscore_pos+1:last_underscore_pos]
+        # Короткий id кнопки заменяем полной спецификацией формата из контекста чата.
+        # Неизвестный id - кнопка от старого сообщения (до перезапуска бота или нового запроса)
+        chat_formats = context.chat_data.get(update.effective_chat.id, {}).get(QUALITY_FORMATS_KEY, {})
+        format_id = chat_formats.get(short_id)
+        if format_id is None:
+            logger.warning(f"Формат для кнопки {short_id} не найден в контексте чата: {data}")
+            await query.edit_message_text(get_message('error_callback_too_old'))
+            return
         
         logger.info(f"Разобран callback: action={action}, url_hash={url_hash}, format_id={format_id}, user_id={user_id}")
         
@@ -2295,13 +2221,14 @@ async def user_can_download(user_id, chat_id):
     """Проверяет, может ли пользователь начать новую загрузку."""
     try:
         # Проверяем лимит загрузок
-        if not db.check_download_limit(user_id):
+        if not await db.check_download_limit(user_id):
             logger.warning(f"Пользователь {user_id} превысил лимит загрузок")
             return False
         
         # Проверяем количество активных загрузок
         with data_lock:
-            active_count = sum(1 for url, info in active_downloads.items() if info.get('user_id') == user_id)
+            # Одно и то же видео по разным ссылкам считается одной загрузкой
+            active_count = len({canonical_key(key[2]) for key, info in active_downloads.items() if info.get('user_id') == user_id})
         
         if active_count >= config.MAX_CONCURRENT_DOWNLOADS:
             logger.warning(f"Пользователь {user_id} превысил лимит одновременных загрузок")
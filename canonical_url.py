@@ -0,0 +1,115 @@
+import re
+import logging
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+logger = logging.getLogger(__name__)
+
+# Правила разбора ссылок: домен -> (экстрактор, регулярные выражения для "путь?запрос").
+# Имя экстрактора совпадает с extractor_key yt-dlp в нижнем регистре, поэтому ключи
+# совпадают с ключами кэша информации о видео ("youtube:<id>").
+_YOUTUBE_RULES = ('youtube', (
+    re.compile(r'^/watch\?(?:.*&)?v=([0-9A-Za-z_-]{11})'),
+    re.compile(r'^/(?:shorts|embed|live|v|e)/([0-9A-Za-z_-]{11})'),
+))
+_YOUTU_BE_RULES = ('youtube', (
+    re.compile(r'^/([0-9A-Za-z_-]{11})'),
+))
+_TIKTOK_RULES = ('tiktok', (
+    re.compile(r'^/@[^/]+/(?:video|photo)/(\d+)'),
+    re.compile(r'^/(?:embed(?:/v2)?|v)/(\d+)'),
+))
+_INSTAGRAM_RULES = ('instagram', (
+    re.compile(r'^/(?:[^/]+/)?(?:p|reels?|tv)/([0-9A-Za-z_-]+)'),
+))
+_TWITTER_RULES = ('twitter', (
+    re.compile(r'^/(?:[^/]+|i(?:/web)?)/status/(\d+)'),
+))
+_VIMEO_RULES = ('vimeo', (
+    re.compile(r'^/(?:video/)?(\d+)'),
+))
+_DAILYMOTION_RULES = ('dailymotion', (
+    re.compile(r'^/(?:embed/)?video/([0-9a-zA-Z]+)'),
+))
+_RUTUBE_RULES = ('rutube', (
+    re.compile(r'^/(?:video|shorts|play/embed)/([0-9a-f]{32})'),
+))
+_VK_RULES = ('vk', (
+    re.compile(r'^/(?:video|clip)(-?\d+_\d+)'),
+    re.compile(r'^/.*[?&]z=(?:video|clip)(-?\d+_\d+)'),
+))
+
+_HOST_RULES = {
+    'youtube.com': _YOUTUBE_RULES,
+    'm.youtube.com': _YOUTUBE_RULES,
+    'music.youtube.com': _YOUTUBE_RULES,
+    'youtube-nocookie.com': _YOUTUBE_RULES,
+    'youtu.be': _YOUTU_BE_RULES,
+    'tiktok.com': _TIKTOK_RULES,
+    'm.tiktok.com': _TIKTOK_RULES,
+    'instagram.com': _INSTAGRAM_RULES,
+    'twitter.com': _TWITTER_RULES,
+    'mobile.twitter.com': _TWITTER_RULES,
+    'x.com': _TWITTER_RULES,
+    'vimeo.com': _VIMEO_RULES,
+    'player.vimeo.com': _VIMEO_RULES,
+    'dailymotion.com': _DAILYMOTION_RULES,
+    'rutube.ru': _RUTUBE_RULES,
+    'vk.com': _VK_RULES,
+    'm.vk.com': _VK_RULES,
+    'vkvideo.ru': _VK_RULES,
+}
+
+# Параметры запроса, которые не влияют на содержимое (метки рекламы и источника)
+_TRACKING_PARAMS = frozenset(('si', 'feature', 'fbclid', 'gclid', 'igshid', 'igsh', 'ref', 'ref_src', 'is_from_webapp', 'sender_device'))
+
+def _split_host(url):
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return parsed, host
+
+def parse_video_url(url):
+    """Возвращает (экстрактор, id видео) для ссылки поддерживаемой платформы или None."""
+    if not url:
+        return None
+    try:
+        parsed, host = _split_host(url)
+    except ValueError:
+        return None
+    rules = _HOST_RULES.get(host)
+    if not rules:
+        return None
+    extractor, patterns = rules
+    target = parsed.path + ('?' + parsed.query if parsed.query else '')
+    for pattern in patterns:
+        match = pattern.match(target)
+        if match:
+            return extractor, match.group(1)
+    return None
+
+def canonical_key(url):
+    """
+    Канонический ключ ссылки для кэшей и сопоставления загрузок.
+
+    Для поддерживаемых платформ ключ имеет вид "<экстрактор>:<id видео>", поэтому
+    youtu.be/ID, /shorts/ID и m.youtube.com/watch?v=ID дают один ключ. Для остальных
+    ссылок используется нормализованный URL (без фрагмента и меток отслеживания,
+    но с остальными параметрами запроса, чтобы разные видео не совпадали).
+    """
+    if not url:
+        return None
+    parsed_video = parse_video_url(url)
+    if parsed_video:
+        return f"{parsed_video[0]}:{parsed_video[1]}"
+    try:
+        parsed, host = _split_host(url)
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+            if key not in _TRACKING_PARAMS and not key.startswith('utm_')
+        )
+        netloc = host + (f":{parsed.port}" if parsed.port else '')
+        return urlunparse((parsed.scheme.lower(), netloc, parsed.path.rstrip('/') or '/', '', urlencode(query), ''))
+    except ValueError as e:
+        logger.warning(f"Не удалось нормализовать URL '{url}': {e}")
+        return url
@@ -14,6 +14,14 @@ DATABASE_PATH = 'video_cache.db'
 # Настройки загрузки видео
 DEFAULT_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo[ext=mp4]/best[ext=mp4]'
 MAX_TELEGRAM_SIZE = 50 * 1024 * 1024  # 50MB в байтах
+SPLIT_PART_TARGET = int(MAX_TELEGRAM_SIZE * 0.95)  # Целевой размер части при разделении (запас на заголовки контейнера)
+
+# Сжатие больших видео до лимита Telegram (двухпроходное кодирование libx264)
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '1'))  # Одновременных перекодирований
+TRANSCODE_NICE = 10  # Приоритет процессов ffmpeg (nice), чтобы перекодирование не мешало боту
+TRANSCODE_AUDIO_BITRATE = 128  # Битрейт аудио в кбит/с
+TRANSCODE_MIN_VIDEO_BITRATE = 150  # Минимальный разумный битрейт видео в кбит/с
+FIT_MAX_SIZE_RATIO = 3  # Кнопка сжатия предлагается для файлов не больше 3x лимита Telegram
 VIDEO_FORMATS = {
     # Худшее mp4 видео <=480p + лучшее m4a аудио, с фоллбэками
     'low': 'worstvideo[ext=mp4][height<=?480]+bestaudio[ext=m4a]/worstvideo[ext=mp4]/worst[ext=mp4]/worst',
@@ -38,7 +46,29 @@ CACHE_DURATION = 30  # дней
 
 # Ограничение загрузок
 MAX_DOWNLOADS_PER_USER = 200  # в день
+
+# Отложенная запись статистики и логов загрузок: пачка пишется одной транзакцией,
+# когда накопится DB_WRITE_BATCH_SIZE событий или пройдет DB_WRITE_BATCH_DELAY секунд
+DB_WRITE_BATCH_SIZE = 100
+DB_WRITE_BATCH_DELAY = 2
+# Кэш настроек и счетчиков загрузок пользователей в памяти (количество пользователей)
+USER_CACHE_SIZE = 1024
 MAX_CONCURRENT_DOWNLOADS = 5
+DOWNLOAD_TIMEOUT = 600  # Максимальное время одной загрузки в секундах
+# Время на остановку загрузки после истечения срока; процесс, не остановившийся за это время, завершается
+DOWNLOAD_STOP_GRACE = 30
+# Режим пула загрузок: 'thread' - потоки бота, 'process' - отдельные процессы (на все ядра, без конкуренции за GIL)
+DOWNLOAD_WORKER_MODE = os.getenv('DOWNLOAD_WORKER_MODE', 'thread')
+
+# Пул извлечения информации о видео (вызовы yt-dlp extract_info вне event loop)
+EXTRACT_WORKERS = 4  # Количество потоков для извлечения информации
+EXTRACT_QUEUE_SIZE = 20  # Максимум запросов, ожидающих свободный поток
+EXTRACT_TIMEOUT = 60  # Таймаут извлечения информации в секундах
+PLAYLIST_EXTRACT_TIMEOUT = 10 * 60  # Таймаут извлечения плейлиста (большие плейлисты и запасные методы - долго)
+
+# Кэш извлеченной информации о видео (общий для выбора качества и скачивания)
+INFO_CACHE_SIZE = 256  # Максимум видео в кэше
+INFO_CACHE_TTL = 30 * 60  # Время жизни записи в секундах (ссылки на форматы со временем истекают)
 
 # Настройки уведомлений
 NOTIFICATION_SETTINGS = {
@@ -53,8 +83,18 @@ DIRECT_LINK_ENABLED = True  # Включить функцию прямых сс
 DIRECT_LINK_DOMAIN = 'dl.rox.su'  # Домен для прямых ссылок
 DIRECT_LINK_EXPIRE_HOURS = 24  # Срок действия ссылки в часах
 DIRECT_LINK_MAX_SIZE_GB = 10  # Максимальный суммарный размер файлов для прямых ссылок в ГБ
-DIRECT_LINK_CLEANUP_INTERVAL = 60 * 60  # Интервал очистки просроченных файлов в секундах (каждый час)
 DIRECT_LINK_STORAGE = os.getenv('DIRECT_LINK_STORAGE', '/var/www/downloads/shared')  # Путь к директории для хранения файлов
+# Секрет nginx secure_link: если задан, ссылки на файлы кэша загрузок подписываются и отдаются без копирования
+DIRECT_LINK_SECRET = os.getenv('DIRECT_LINK_SECRET')
+DIRECT_LINK_SIGNED_PREFIX = '/cache/'  # URI-префикс файлов кэша загрузок в nginx
+# Базовый адрес прямых ссылок (для встроенного сервера без nginx, например http://127.0.0.1:8080)
+DIRECT_LINK_BASE_URL = os.getenv('DIRECT_LINK_BASE_URL', f"https://{DIRECT_LINK_DOMAIN}")
+# Встроенный файловый сервер (aiohttp) для развертывания без nginx
+DIRECT_LINK_SERVER_ENABLED = os.getenv('DIRECT_LINK_SERVER_ENABLED', '').lower() in ('1', 'true', 'yes')
+DIRECT_LINK_SERVER_HOST = os.getenv('DIRECT_LINK_SERVER_HOST', '0.0.0.0')
+DIRECT_LINK_SERVER_PORT = int(os.getenv('DIRECT_LINK_SERVER_PORT', 8080))
+DIRECT_LINK_SERVER_MAX_CONNECTIONS = 32  # Максимум одновременных скачиваний
+DIRECT_LINK_SERVER_RATE_LIMIT_KBPS = int(os.getenv('DIRECT_LINK_SERVER_RATE_LIMIT_KBPS', 0))  # Лимит скорости на соединение (0 - без лимита)
 # --- Конец добавленных настроек ---
 
 # Удаляем словарь MESSAGES
@@ -1,22 +1,98 @@
 import sqlite3
 import os
+import asyncio
+import functools
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 # import time # Больше не нужен напрямую
 from datetime import datetime, timedelta
 import config
 import logging # Добавляем импорт логгера
+from canonical_url import canonical_key
 
 logger = logging.getLogger(__name__) # Инициализируем логгер
 
+# Закрепленные файлы кэша (путь -> число активных отправок). Пока файл отправляется
+# пользователю, он не удаляется ни при инвалидации, ни при очистке кэша.
+_pinned_files = {}
+_pinned_lock = threading.Lock()
+
+def pin_file(file_path):
+    """Закрепляет файл на время отправки."""
+    with _pinned_lock:
+        _pinned_files[file_path] = _pinned_files.get(file_path, 0) + 1
+
+def unpin_file(file_path):
+    """Снимает закрепление файла."""
+    with _pinned_lock:
+        count = _pinned_files.get(file_path, 0) - 1
+        if count > 0:
+            _pinned_files[file_path] = count
+        else:
+            _pinned_files.pop(file_path, None)
+
+def is_pinned(file_path):
+    """Проверяет, отправляется ли файл прямо сейчас."""
+    with _pinned_lock:
+        return file_path in _pinned_files
+
+@contextmanager
+def pinned_file(file_path):
+    """Контекстный менеджер: файл закреплен, пока выполняется блок."""
+    pin_file(file_path)
+    try:
+        yield file_path
+    finally:
+        unpin_file(file_path)
+
+# Постоянные соединения: у каждого потока свое соединение с каждой базой (путь -> соединение).
+# Соединение sqlite3 нельзя использовать из разных потоков, а открывать его на каждый
+# запрос дорого, поэтому соединение создается один раз на поток и переиспользуется.
+_thread_connections = threading.local()
+
+# Настройки соединения: WAL не блокирует читателей на время записи, synchronous=NORMAL
+# в режиме WAL делает fsync только при контрольной точке, кэш страниц 16 МБ, mmap 64 МБ
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA temp_store=MEMORY",
+)
+
 class Database:
     def __init__(self, db_path=config.DATABASE_PATH):
         self.db_path = db_path
         # Включаем автоматическое определение типов при подключении
-        self._conn_kwargs = {'detect_types': sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES}
+        self._conn_kwargs = {'detect_types': sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, 'timeout': 10}
         self.init_db()
 
     def _get_connection(self):
-        """Возвращает соединение с базой данных."""
-        return sqlite3.connect(self.db_path, **self._conn_kwargs)
+        """
+        Возвращает постоянное соединение текущего потока с базой данных.
+
+        Используется как раньше - в блоке with, который фиксирует или откатывает
+        транзакцию, но не закрывает соединение.
+        """
+        connections = getattr(_thread_connections, 'connections', None)
+        if connections is None:
+            connections = _thread_connections.connections = {}
+        conn = connections.get(self.db_path)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, **self._conn_kwargs)
+            for pragma in _CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            connections[self.db_path] = conn
+        return conn
+
+    def close(self):
+        """Закрывает соединение текущего потока (при остановке бота)."""
+        connections = getattr(_thread_connections, 'connections', None)
+        if connections and self.db_path in connections:
+            connections.pop(self.db_path).close()
 
     def init_db(self):
         """Инициализация базы данных и миграция схемы при необходимости."""
@@ -26,17 +102,64 @@ class Database:
         with self._get_connection() as conn:
             cursor = conn.cursor()
 
-            # Таблица для кэширования видео (используем TIMESTAMP)
+            # Старая таблица кэша (url - первичный ключ) переносится в новую схему
+            self._migrate_video_cache(cursor)
+
+            # Таблица для кэширования видео (используем TIMESTAMP).
+            # Ключ - канонический id видео и формат: одно видео может храниться в нескольких качествах
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS video_cache (
-                url TEXT PRIMARY KEY,
+                video_key TEXT,
+                format TEXT,
                 title TEXT,
                 file_path TEXT,
                 size INTEGER,
+                created_at TIMESTAMP,
+                PRIMARY KEY (video_key, format)
+            )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_cache_created ON video_cache (created_at)")
+
+            # Таблица file_id Telegram для повторной отправки без загрузки файла.
+            # part_index = 0 - целый файл, 1..part_count - части разделенного видео
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS telegram_file_cache (
+                video_key TEXT,
                 format TEXT,
-                created_at TIMESTAMP
+                part_index INTEGER,
+                part_count INTEGER,
+                file_id TEXT,
+                title TEXT,
+                created_at TIMESTAMP,
+                PRIMARY KEY (video_key, format, part_index)
+            )
+            ''')
+
+            # Индекс файлов прямых ссылок (вместо .meta файлов рядом с каждым файлом)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS direct_links (
+                file_name TEXT PRIMARY KEY,
+                file_path TEXT,
+                original_filename TEXT,
+                size INTEGER,
+                created_at TIMESTAMP,
+                expires_at TIMESTAMP,
+                source_hash TEXT,
+                last_served_at TIMESTAMP,
+                content_key TEXT
             )
             ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_direct_links_expires ON direct_links (expires_at)")
+            cursor.execute("PRAGMA table_info(direct_links)")
+            if 'last_served_at' not in [info[1] for info in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE direct_links ADD COLUMN last_served_at TIMESTAMP")
+                cursor.execute("UPDATE direct_links SET last_served_at = created_at")
+                logger.info("Добавлена колонка 'last_served_at' в таблицу direct_links.")
+            cursor.execute("PRAGMA table_info(direct_links)")
+            if 'content_key' not in [info[1] for info in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE direct_links ADD COLUMN content_key TEXT")
+                logger.info("Добавлена колонка 'content_key' в таблицу direct_links.")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_direct_links_content_key ON direct_links (content_key)")
 
             # Таблица для статистики пользователей (используем TIMESTAMP)
             cursor.execute('''
@@ -80,6 +203,39 @@ class Database:
 
             conn.commit()
 
+    def _migrate_video_cache(self, cursor):
+        """Перенос video_cache со старым ключом url в схему с ключом (video_key, format) без потери записей."""
+        cursor.execute("PRAGMA table_info(video_cache)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'url' not in columns:
+            return
+        logger.warning("Обнаружена старая схема video_cache (ключ url). Миграция на ключ (video_key, format)...")
+        cursor.execute("ALTER TABLE video_cache RENAME TO video_cache_old")
+        cursor.execute('''
+        CREATE TABLE video_cache (
+            video_key TEXT,
+            format TEXT,
+            title TEXT,
+            file_path TEXT,
+            size INTEGER,
+            created_at TIMESTAMP,
+            PRIMARY KEY (video_key, format)
+        )
+        ''')
+        # Старые записи могли хранить исходный URL - приводим к каноническому ключу.
+        # При совпадении ключей остается самая новая запись
+        cursor.execute("SELECT url, format, title, file_path, size, created_at FROM video_cache_old ORDER BY created_at")
+        rows = [
+            (canonical_key(url) or url, video_format or "high", title, file_path, size, created_at)
+            for url, video_format, title, file_path, size, created_at in cursor.fetchall()
+        ]
+        cursor.executemany(
+            "INSERT OR REPLACE INTO video_cache (video_key, format, title, file_path, size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        cursor.execute("DROP TABLE video_cache_old")
+        logger.info(f"Миграция video_cache завершена: перенесено {len(rows)} записей.")
+
     def _migrate_schema(self):
         """Проверяет типы колонок времени и изменяет их с INTEGER на TIMESTAMP при необходимости."""
         tables_columns = {
@@ -114,18 +270,18 @@ class Database:
             logger.error(f"Ошибка во время проверки/миграции схемы БД: {e}")
 
 
-    def add_video_to_cache(self, url, title, file_path, size, video_format="high"):
+    def add_video_to_cache(self, video_key, title, file_path, size, video_format="high"):
         """Добавление видео в кэш с использованием datetime.now()"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             current_time = datetime.now()
             cursor.execute(
-                "INSERT OR REPLACE INTO video_cache (url, title, file_path, size, format, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (url, title, file_path, size, video_format, current_time)
+                "INSERT OR REPLACE INTO video_cache (video_key, format, title, file_path, size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (video_key, video_format, title, file_path, size, current_time)
             )
             conn.commit()
 
-    def get_cached_video(self, url, video_format="high"):
+    def get_cached_video(self, video_key, video_format="high"):
         """Получение видео из кэша с проверкой срока годности через datetime"""
         if not config.CACHE_ENABLED:
             return None
@@ -134,8 +290,8 @@ class Database:
             cursor = conn.cursor()
             # Получаем объект datetime напрямую благодаря detect_types
             cursor.execute(
-                "SELECT title, file_path, size, created_at FROM video_cache WHERE url = ? AND format = ?",
-                (url, video_format)
+                "SELECT title, file_path, size, created_at FROM video_cache WHERE video_key = ? AND format = ?",
+                (video_key, video_format)
             )
             result = cursor.fetchone()
 
@@ -150,15 +306,15 @@ class Database:
              try:
                  created_at = datetime.fromisoformat(str(created_at))
              except (TypeError, ValueError):
-                 logger.error(f"Не удалось преобразовать created_at ('{created_at}') в datetime для кэша URL {url}")
-                 self.remove_from_cache(url) # Удаляем запись с некорректной датой
+                 logger.error(f"Не удалось преобразовать created_at ('{created_at}') в datetime для кэша {video_key} ({video_format})")
+                 self.remove_from_cache(video_key, video_format) # Удаляем запись с некорректной датой
                  return None
 
         # Проверяем срок хранения и существование файла
         cache_expiry_date = datetime.now() - timedelta(days=config.CACHE_DURATION)
         if created_at < cache_expiry_date or not os.path.exists(file_path):
-            logger.info(f"Кэш для {url} устарел или файл не найден. Удаление из кэша.")
-            self.remove_from_cache(url)
+            logger.info(f"Кэш для {video_key} ({video_format}) устарел или файл не найден. Удаление из кэша.")
+            self.remove_from_cache(video_key, video_format)
             return None
 
         return {
@@ -167,30 +323,35 @@ class Database:
             "size": size
         }
 
-    def remove_from_cache(self, url):
-        """Удаление видео из кэша"""
-        # Сначала получаем путь к файлу
-        file_to_delete = None
+    def remove_from_cache(self, video_key, video_format=None):
+        """Удаление видео из кэша (одного формата или, если формат не указан, всех)"""
+        # Сначала получаем пути к файлам
+        files_to_delete = []
+        if video_format is None:
+            condition, params = "video_key = ?", (video_key,)
+        else:
+            condition, params = "video_key = ? AND format = ?", (video_key, video_format)
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT file_path FROM video_cache WHERE url = ?", (url,))
-                result = cursor.fetchone()
-                if result:
-                    file_to_delete = result[0]
-                # Удаляем запись из БД
-                cursor.execute("DELETE FROM video_cache WHERE url = ?", (url,))
+                cursor.execute(f"SELECT file_path FROM video_cache WHERE {condition}", params)
+                files_to_delete = [row[0] for row in cursor.fetchall()]
+                # Удаляем записи из БД
+                cursor.execute(f"DELETE FROM video_cache WHERE {condition}", params)
                 conn.commit()
         except Exception as e:
-            logger.error(f"Ошибка при удалении записи из кэша для URL {url}: {e}")
+            logger.error(f"Ошибка при удалении записи из кэша для {video_key}: {e}")
 
-        # Удаляем файл, если путь был найден
-        if file_to_delete and os.path.exists(file_to_delete):
-            try:
-                os.remove(file_to_delete)
-                logger.info(f"Удален файл из кэша: {file_to_delete}")
-            except Exception as e:
-                logger.error(f"Не удалось удалить файл кэша {file_to_delete}: {e}")
+        # Удаляем файлы, если путь был найден и файл сейчас не отправляется
+        for file_to_delete in files_to_delete:
+            if file_to_delete and is_pinned(file_to_delete):
+                logger.info(f"Файл кэша {file_to_delete} сейчас отправляется, удаление пропущено")
+            elif file_to_delete and os.path.exists(file_to_delete):
+                try:
+                    os.remove(file_to_delete)
+                    logger.info(f"Удален файл из кэша: {file_to_delete}")
+                except Exception as e:
+                    logger.error(f"Не удалось удалить файл кэша {file_to_delete}: {e}")
 
 
     def clean_expired_cache(self):
@@ -216,7 +377,9 @@ class Database:
         # Удаляем файлы
         deleted_file_count = 0
         for file_path in expired_files:
-            if file_path and os.path.exists(file_path):
+            if file_path and is_pinned(file_path):
+                logger.info(f"Просроченный файл кэша {file_path} сейчас отправляется, удаление пропущено")
+            elif file_path and os.path.exists(file_path):
                 try:
                     os.remove(file_path)
                     deleted_file_count += 1
@@ -226,6 +389,141 @@ class Database:
              logger.info(f"Удалено {deleted_file_count} просроченных файлов кэша.")
 
 
+    def add_telegram_file(self, video_key, video_format, part_index, file_id, title, part_count=1):
+        """Сохранение file_id Telegram для видео (или его части)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO telegram_file_cache (video_key, format, part_index, part_count, file_id, title, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (video_key, video_format, part_index, part_count, file_id, title, datetime.now())
+            )
+            conn.commit()
+
+    def get_telegram_files(self, video_key, video_format):
+        """Получение file_id всех частей видео по порядку (None, если сохранены не все части)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT part_index, part_count, file_id, title FROM telegram_file_cache WHERE video_key = ? AND format = ? ORDER BY part_index",
+                (video_key, video_format)
+            )
+            rows = cursor.fetchall()
+
+        if not rows:
+            return None
+        title = rows[0][3]
+        # Целый файл отправляется одним file_id
+        if rows[0][0] == 0:
+            return {"title": title, "file_ids": [rows[0][2]]}
+        # Части используются, только если сохранен полный набор одного разделения
+        part_count = rows[0][1]
+        parts = [file_id for part_index, count, file_id, _ in rows if count == part_count]
+        if len(parts) != part_count:
+            return None
+        return {"title": title, "file_ids": parts}
+
+    def remove_telegram_file(self, video_key, video_format, part_index):
+        """Удаление сохраненного file_id части видео (например, если Telegram его больше не принимает)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM telegram_file_cache WHERE video_key = ? AND format = ? AND part_index = ?",
+                (video_key, video_format, part_index)
+            )
+            conn.commit()
+
+    def add_direct_link(self, file_name, file_path, original_filename, size, created_at, expires_at, source_hash, content_key=None):
+        """Добавление файла прямой ссылки в индекс"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO direct_links (file_name, file_path, original_filename, size, created_at, expires_at, source_hash, last_served_at, content_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_name, file_path, original_filename, size, created_at, expires_at, source_hash, created_at, content_key)
+            )
+            conn.commit()
+
+    def get_direct_link(self, file_name):
+        """Запись индекса прямой ссылки: (file_path, original_filename, size, expires_at) или None"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_path, original_filename, size, expires_at FROM direct_links WHERE file_name = ?",
+                (file_name,)
+            )
+            return cursor.fetchone()
+
+    def mark_direct_link_served(self, file_name, served_at):
+        """Отметка о скачивании файла по ссылке (для вытеснения давно не скачивавшихся)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE direct_links SET last_served_at = ? WHERE file_name = ?", (served_at, file_name))
+            conn.commit()
+
+    def get_direct_link_by_key(self, content_key):
+        """Опубликованный файл с тем же содержимым: (file_name, file_path, size, expires_at) или None"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_name, file_path, size, expires_at FROM direct_links WHERE content_key = ? ORDER BY expires_at DESC LIMIT 1",
+                (content_key,)
+            )
+            return cursor.fetchone()
+
+    def extend_direct_link(self, file_name, expires_at, served_at):
+        """Продление срока действия ссылки при повторной выдаче"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE direct_links SET expires_at = MAX(expires_at, ?), last_served_at = ? WHERE file_name = ?",
+                (expires_at, served_at, file_name)
+            )
+            conn.commit()
+
+    def get_expired_direct_links(self, now=None):
+        """Файлы прямых ссылок с истекшим сроком (диапазонный поиск по индексу expires_at)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_name, file_path, size FROM direct_links WHERE expires_at <= ? ORDER BY expires_at",
+                (now or datetime.now(),)
+            )
+            return cursor.fetchall()
+
+    def get_direct_link_expirations(self):
+        """Сроки истечения всех файлов прямых ссылок: [(file_name, expires_at)]"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT file_name, expires_at FROM direct_links ORDER BY expires_at")
+            return cursor.fetchall()
+
+    def get_direct_link_eviction_candidates(self, limit):
+        """Кандидаты на вытеснение: сначала истекающие раньше всех, затем давно не выдававшиеся"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_name, file_path, size FROM direct_links ORDER BY expires_at, last_served_at LIMIT ?",
+                (limit,)
+            )
+            return cursor.fetchall()
+
+    def remove_direct_links(self, file_names):
+        """Удаление файлов прямых ссылок из индекса"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM direct_links WHERE file_name = ?", [(name,) for name in file_names])
+            conn.commit()
+
+    def get_direct_links_stats(self, now=None):
+        """Статистика прямых ссылок одним агрегирующим запросом: (активных ссылок, общий размер в байтах)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT COUNT(CASE WHEN expires_at > ? THEN 1 END), COALESCE(SUM(size), 0) FROM direct_links",
+                (now or datetime.now(),)
+            )
+            active_links, total_size = cursor.fetchone()
+        return active_links, total_size
+
     def update_user_stats(self, user_id, username):
         """Обновление статистики пользователя с использованием datetime и проверкой даты"""
         with self._get_connection() as conn:
@@ -285,6 +583,52 @@ class Database:
             conn.commit()
             logger.debug(f"Запись в лог: User={user_id}, URL={url}, Status={status}")
 
+    def write_batch(self, logs, stats):
+        """
+        Запись накопленных логов и статистики загрузок одной транзакцией.
+
+        logs - строки (user_id, url, status, error, created_at) для download_logs,
+        stats - строки (user_id, username, количество загрузок, время последней) в порядке
+        времени: счетчик за день сбрасывается, если предыдущая загрузка была в другой день.
+        """
+        default_settings = '{"download_complete": true, "download_error": true, "download_progress": true, "system_alert": true}'
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if logs:
+                cursor.executemany(
+                    "INSERT INTO download_logs (user_id, url, status, error, created_at) VALUES (?, ?, ?, ?, ?)",
+                    logs
+                )
+            if stats:
+                cursor.executemany(
+                    '''
+                    INSERT INTO user_stats (user_id, username, downloads_today, total_downloads, last_download, video_format, notification_settings)
+                    VALUES (?, ?, ?, ?, ?, 'high', ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        downloads_today = CASE
+                            WHEN date(user_stats.last_download) = date(excluded.last_download)
+                            THEN user_stats.downloads_today + excluded.downloads_today
+                            ELSE excluded.downloads_today
+                        END,
+                        total_downloads = COALESCE(user_stats.total_downloads, 0) + excluded.total_downloads,
+                        last_download = excluded.last_download
+                    ''',
+                    [(user_id, username, count, count, last_time, default_settings) for user_id, username, count, last_time in stats]
+                )
+            conn.commit()
+        logger.debug(f"Записана пачка: {len(logs)} логов, {len(stats)} обновлений статистики")
+
+    def get_user_row(self, user_id):
+        """Настройки и счетчик пользователя одним запросом: (video_format, notification_settings, downloads_today, last_download) или None"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT video_format, notification_settings, downloads_today, last_download FROM user_stats WHERE user_id = ?",
+                (user_id,)
+            )
+            return cursor.fetchone()
+
     def get_user_settings(self, user_id):
         """Получение настроек пользователя (формат видео)"""
         with self._get_connection() as conn:
@@ -379,4 +723,254 @@ class Database:
         settings = self.get_notification_settings(user_id)
         # Переключаем значение, учитывая, что ключа может не быть (по умолчанию True)
         settings[notification_type] = not settings.get(notification_type, True)
-        return self.update_notification_settings(user_id, settings) 
\ No newline at end of file
+        return self.update_notification_settings(user_id, settings) 
+
+
+# Общие для всех асинхронных фасадов потоки: один писатель (записи выполняются строго
+# по очереди и не ждут блокировки базы друг за другом) и пул читателей (в режиме WAL
+# чтения идут параллельно с записью)
+_db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_db_readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db-reader')
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи логов загрузок и статистики пользователей.
+
+    События копятся в памяти и записываются одной транзакцией (executemany), когда их
+    накопится max_batch или пройдет max_delay секунд с первого события пачки. Загрузки
+    одного пользователя за день сворачиваются в одно обновление счетчиков.
+    """
+    def __init__(self, database, max_batch=config.DB_WRITE_BATCH_SIZE, max_delay=config.DB_WRITE_BATCH_DELAY):
+        self._db = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._logs = []
+        # (user_id, дата) -> [username, количество загрузок, время последней]
+        self._stats = {}
+        self._events = 0
+        self._timer = None
+
+    def add_log(self, user_id, url, status, error=None):
+        with self._lock:
+            self._logs.append((user_id, url, status, error, datetime.now()))
+            self._events += 1
+        self._schedule_flush()
+
+    def add_download(self, user_id, username):
+        now = datetime.now()
+        with self._lock:
+            entry = self._stats.get((user_id, now.date()))
+            if entry:
+                entry[0] = username
+                entry[1] += 1
+                entry[2] = now
+            else:
+                self._stats[(user_id, now.date())] = [username, 1, now]
+            self._events += 1
+        self._schedule_flush()
+
+    def pending_today(self, user_id):
+        """Загрузки пользователя за сегодня, еще не записанные в базу."""
+        with self._lock:
+            entry = self._stats.get((user_id, datetime.now().date()))
+            return entry[1] if entry else 0
+
+    def _schedule_flush(self):
+        loop = asyncio.get_running_loop()
+        if self._events >= self.max_batch:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            loop.run_in_executor(_db_writer, self.flush)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._on_timer, loop)
+
+    def _on_timer(self, loop):
+        self._timer = None
+        loop.run_in_executor(_db_writer, self.flush)
+
+    def flush(self):
+        """Записывает накопленное одной транзакцией (выполняется в потоке-писателе)."""
+        with self._lock:
+            logs, self._logs = self._logs, []
+            stats_items, self._stats = self._stats, {}
+            self._events = 0
+        if not logs and not stats_items:
+            return
+        stats = sorted(
+            ((user_id, username, count, last_time) for (user_id, _), (username, count, last_time) in stats_items.items()),
+            key=lambda row: row[3]
+        )
+        try:
+            self._db.write_batch(logs, stats)
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки статистики ({len(logs)} логов, {len(stats)} пользователей): {e}")
+            # Возвращаем события в буфер, чтобы записать их следующей пачкой
+            with self._lock:
+                self._logs[:0] = logs
+                for key, (username, count, last_time) in stats_items.items():
+                    entry = self._stats.get(key)
+                    if entry:
+                        entry[1] += count
+                    else:
+                        self._stats[key] = [username, count, last_time]
+                self._events += len(logs) + len(stats)
+
+class UserCache:
+    """
+    Ограниченный по размеру LRU-кэш строк пользователей: формат видео, разобранные
+    настройки уведомлений и счетчик загрузок за текущий день.
+
+    Используется только из event loop (через AsyncDatabase), поэтому без блокировок.
+    """
+    def __init__(self, max_size=config.USER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def put(self, user_id, entry):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+# Общий для всех фасадов кэш пользователей (бот и загрузчик видят одни и те же настройки)
+_user_cache = UserCache()
+
+# Буферы всех фасадов: при остановке бота записываются до завершения потока-писателя
+_write_buffers = []
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для корутин бота.
+
+    Методы вызываются так же, как у Database, но возвращают корутины: чтения (get_*,
+    check_*, is_*) выполняются в пуле читателей, все остальные методы - в единственном
+    потоке-писателе. Event loop не блокируется ни на запросах, ни на fsync.
+
+    Настройки и дневной счетчик загрузок пользователя читаются из общего LRU-кэша
+    (повторные запросы одного пользователя не обращаются к базе), изменения
+    записываются в базу и сразу в кэш.
+    """
+    _READ_PREFIXES = ('get_', 'check_', 'is_')
+    # Чтения, которые могут писать: get_cached_video удаляет устаревшую запись кэша
+    _WRITING_READS = frozenset(('get_cached_video',))
+
+    def __init__(self, database):
+        self._db = database
+        self._buffer = WriteBehindBuffer(database)
+        _write_buffers.append(self._buffer)
+
+    async def _run(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+    async def _user_entry(self, user_id):
+        """Запись пользователя из кэша; при промахе - один запрос к базе."""
+        entry = _user_cache.get(user_id)
+        if entry is not None:
+            return entry
+        row = await self._run(_db_readers, self._db.get_user_row, user_id)
+        today = datetime.now().date()
+        video_format, notification_json, downloads_today, last_download = row or (None, None, 0, None)
+        try:
+            notifications = json.loads(notification_json) if notification_json else config.NOTIFICATION_SETTINGS.copy()
+        except (json.JSONDecodeError, TypeError):
+            logger.warning(f"Не удалось разобрать JSON настроек уведомлений для пользователя {user_id}. Используем значения по умолчанию.")
+            notifications = config.NOTIFICATION_SETTINGS.copy()
+        downloads = (downloads_today or 0) if isinstance(last_download, datetime) and last_download.date() == today else 0
+        entry = {
+            'video_format': video_format or "high",
+            'notifications': notifications,
+            'quota_date': today,
+            # Загрузки, еще не записанные из буфера, в базе не видны
+            'downloads_today': downloads + sum(buffer.pending_today(user_id) for buffer in _write_buffers)
+        }
+        _user_cache.put(user_id, entry)
+        return entry
+
+    async def get_user_settings(self, user_id):
+        """Формат видео пользователя (из кэша)."""
+        return (await self._user_entry(user_id))['video_format']
+
+    async def update_user_settings(self, user_id, video_format):
+        """Обновление формата видео: запись в базу, затем в кэш."""
+        result = await self._run(_db_writer, self._db.update_user_settings, user_id, video_format)
+        entry = _user_cache.get(user_id)
+        if entry is not None:
+            entry['video_format'] = video_format
+        return result
+
+    async def get_notification_settings(self, user_id):
+        """Настройки уведомлений пользователя (из кэша, копия)."""
+        return dict((await self._user_entry(user_id))['notifications'])
+
+    async def update_notification_settings(self, user_id, settings):
+        """Обновление настроек уведомлений: запись в базу, затем в кэш."""
+        result = await self._run(_db_writer, self._db.update_notification_settings, user_id, settings)
+        entry = _user_cache.get(user_id)
+        if result and entry is not None:
+            entry['notifications'] = dict(settings)
+        return result
+
+    async def toggle_notification(self, user_id, notification_type):
+        """Включение/выключение конкретного типа уведомлений"""
+        settings = await self.get_notification_settings(user_id)
+        settings[notification_type] = not settings.get(notification_type, True)
+        return await self.update_notification_settings(user_id, settings)
+
+    async def check_download_limit(self, user_id):
+        """Проверка дневного лимита загрузок по счетчику в памяти."""
+        entry = await self._user_entry(user_id)
+        today = datetime.now().date()
+        if entry['quota_date'] != today:
+            # Новый день - счетчик сбрасывается, как и в базе
+            entry['quota_date'] = today
+            entry['downloads_today'] = 0
+        return entry['downloads_today'] < config.MAX_DOWNLOADS_PER_USER
+
+    async def log_download(self, user_id, url, status, error=None):
+        """Лог загрузки (записывается отложенно, пачкой)."""
+        self._buffer.add_log(user_id, url, status, error)
+
+    async def update_user_stats(self, user_id, username):
+        """Учет загрузки пользователя: счетчик в кэше сразу, в базе - отложенно, пачкой."""
+        self._buffer.add_download(user_id, username)
+        entry = _user_cache.get(user_id)
+        if entry is not None:
+            today = datetime.now().date()
+            if entry['quota_date'] != today:
+                entry['quota_date'] = today
+                entry['downloads_today'] = 0
+            entry['downloads_today'] += 1
+
+    async def flush(self):
+        """Немедленная запись буфера."""
+        await self._run(_db_writer, self._buffer.flush)
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        is_read = name.startswith(self._READ_PREFIXES) and name not in self._WRITING_READS
+        executor = _db_readers if is_read else _db_writer
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(attr, *args, **kwargs))
+
+        call.__name__ = name
+        return call
+
+def shutdown_async_database():
+    """Записывает буферы и дожидается выполнения поставленных в очередь записей (при остановке бота)."""
+    for buffer in _write_buffers:
+        _db_writer.submit(buffer.flush)
+    _db_writer.shutdown(wait=True)
+    _db_readers.shutdown(wait=True)
@@ -0,0 +1,122 @@
+import logging
+import os
+import time
+import yt_dlp
+
+# Модуль намеренно не импортирует downloader/database: он загружается в дочерних
+# процессах пула загрузок, где не нужны ни база данных, ни пулы event loop.
+
+logger = logging.getLogger(__name__)
+
+# Поля progress hook, которые передаются из рабочего потока/процесса в event loop
+PROGRESS_FIELDS = ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta', 'filename')
+
+def init_worker_process():
+    """Инициализация дочернего процесса пула загрузок."""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+class QueueChannel:
+    """Канал событий прогресса для процессного режима: пишет (job_id, событие) в общую очередь."""
+
+    def __init__(self, queue, job_id):
+        self._queue = queue
+        self._job_id = job_id
+
+    def put(self, event):
+        self._queue.put((self._job_id, event))
+
+def _expected_path(ydl, info):
+    """Итоговый путь файла: после слияния форматов он известен из requested_downloads."""
+    requested = (info or {}).get('requested_downloads') or []
+    if requested and requested[0].get('filepath'):
+        return requested[0]['filepath']
+    return ydl.prepare_filename(info) if info else None
+
+def _downloaded_path(ydl, info):
+    """Путь скачанного файла или None, если файла на диске нет."""
+    path = _expected_path(ydl, info)
+    return path if path and os.path.exists(path) else None
+
+def run_download_job(url, ydl_opts, channel, cancel_event, timeout, info=None):
+    """
+    Полный цикл загрузки одного видео (выполняется в рабочем потоке или процессе пула загрузок).
+
+    Если передан info (ранее извлеченная информация о видео из кэша), страница не
+    запрашивается повторно: формат выбирается и скачивается через process_ie_result.
+    События прогресса отправляются через channel.put(); первое событие 'started' с PID
+    процесса отмечает начало выполнения. Отмена и таймаут проверяются в progress hook:
+    исключение DownloadCancelled прерывает скачивание изнутри yt-dlp (общий срок вне хука
+    ограничивает DownloadExecutor).
+    Возвращает словарь со статусом 'finished', 'cancelled', 'timeout' или 'error'
+    (результат должен сериализоваться для передачи между процессами).
+    """
+    deadline = time.monotonic() + timeout
+    channel.put({'status': 'started', 'pid': os.getpid()})
+
+    def hook(d):
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled('Загрузка была отменена пользователем')
+        if time.monotonic() > deadline:
+            raise yt_dlp.utils.DownloadCancelled('Превышено время ожидания загрузки')
+        channel.put({key: d.get(key) for key in PROGRESS_FIELDS})
+
+    opts = {**ydl_opts, 'progress_hooks': [hook]}
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            extracted_info = None
+            if not info:
+                # Получаем информацию о видео (один раз: скачивание использует ее же)
+                info = ydl.extract_info(url, download=False)
+                if not info:
+                    raise ValueError(f"Не удалось получить информацию о видео {url}")
+                extracted_info = ydl.sanitize_info(info)
+            channel.put({'status': 'extracted', 'webpage_url': info.get('webpage_url')})
+
+            # Проверяем, не отменена ли загрузка и не истекло ли время до начала скачивания
+            if cancel_event.is_set():
+                return {'status': 'cancelled'}
+            if time.monotonic() > deadline:
+                return {'status': 'timeout'}
+
+            logger.info(f"Начинаем загрузку видео с URL {info.get('webpage_url', url)}")
+            try:
+                info = ydl.process_ie_result(info, download=True)
+                # С ignoreerrors yt-dlp сообщает об ошибке скачивания (403, истекшая ссылка)
+                # без исключения, поэтому проверяем, что файл действительно скачан
+                stale_error = None if _downloaded_path(ydl, info) else 'файл не скачан'
+            except yt_dlp.utils.DownloadError as e:
+                if extracted_info is not None:
+                    raise
+                stale_error = e
+            if stale_error and extracted_info is None:
+                # Ссылки на форматы в кэшированной информации могли устареть - извлекаем заново
+                logger.warning(f"Не удалось скачать по кэшированной информации для {url}: {stale_error}. Повторное извлечение.")
+                info = ydl.extract_info(url, download=True)
+                if not info:
+                    raise ValueError(f"Не удалось получить информацию о видео {url}")
+                extracted_info = ydl.sanitize_info(info)
+
+            if not info:
+                raise ValueError(f"Не удалось скачать видео {url}")
+
+            return {
+                'status': 'finished',
+                'filename': _downloaded_path(ydl, info) or _expected_path(ydl, info),
+                'title': info.get('title', ''),
+                'duration': info.get('duration', 0),
+                'thumbnail': info.get('thumbnail'),
+                # Свежеизвлеченная информация возвращается для кэша
+                'info': extracted_info
+            }
+    except yt_dlp.utils.DownloadCancelled as e:
+        logger.info(f"Загрузка {url} прервана: {e}")
+        if cancel_event.is_set():
+            return {'status': 'cancelled'}
+        return {'status': 'timeout'}
+    except Exception as e:
+        # Исключения yt-dlp не всегда переживают передачу между процессами, поэтому передаем текст
+        logger.error(f"Ошибка при скачивании видео {url}: {e}")
+        return {'status': 'error', 'error': str(e)}
@@ -1,19 +1,24 @@
 import os
+import signal
 import logging
 import yt_dlp
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import config
-from database import Database
+from database import Database, AsyncDatabase
+from download_worker import run_download_job, init_worker_process, QueueChannel
+from canonical_url import canonical_key
+from split_planner import plan_split, CUT_EPSILON
+from format_selector import format_options, best_fitting
 import uuid
-import subprocess
-import math
 import json
+import copy
 import threading
+from collections import OrderedDict
 import time
 import aiofiles
 import aiofiles.os
-from urllib.parse import urlparse, urlunparse
 import aiohttp
 
 # Настройка логирования
@@ -23,31 +28,372 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Пул для асинхронных задач
-executor = ThreadPoolExecutor(max_workers=config.MAX_CONCURRENT_DOWNLOADS)
-
 # Инициализация базы данных
-db = Database()
+db = AsyncDatabase(Database())
 
-# Активные загрузки (для отслеживания прогресса)
+# Активные загрузки (для отслеживания прогресса), ключ - download_key()
 active_downloads = {}
-# Словарь для сопоставления НОРМАЛИЗОВАННЫХ канонических URL с исходными URL
+# Словарь для сопоставления канонических ключей (экстрактор:id видео) с ключами запросов загрузки
 canonical_url_map = {}
 # Блокировка для потокобезопасного доступа к словарям выше
 data_lock = threading.Lock()
 
-# --- Добавлено: Функция нормализации URL (дублируем из bot.py для автономности модуля) ---
-def normalize_url(url):
-    """Removes query parameters and fragments from a URL."""
-    if not url: return None
-    try:
-        parsed = urlparse(url)
-        # Reconstruct URL without query and fragment
-        return urlunparse((parsed.scheme, parsed.netloc, parsed.path, '', '', ''))
-    except Exception as e:
-        logger.warning(f"(Downloader) Не удалось нормализовать URL '{url}': {e}")
-        return url # Возвращаем исходный URL в случае ошибки
-# --- Конец добавления ---
+def download_key(user_id, chat_id, url):
+    """
+    Ключ запроса загрузки в active_downloads.
+
+    Одно и то же видео могут одновременно скачивать разные пользователи (и один
+    пользователь в разных чатах), поэтому состояние хранится по запросу, а не по URL.
+    """
+    return (user_id, chat_id, url)
+
+
+class ExtractionEngine:
+    """
+    Ограниченный пул потоков для блокирующих вызовов yt-dlp extract_info.
+
+    Извлечение выполняется вне event loop, поэтому медленный экстрактор не блокирует
+    обработку сообщений других пользователей. Очередь ожидающих запросов ограничена,
+    у каждого запроса есть таймаут, а ожидающие в очереди запросы снимаются при отмене.
+    """
+
+    def __init__(self, max_workers=config.EXTRACT_WORKERS, max_queue=config.EXTRACT_QUEUE_SIZE,
+                 timeout=config.EXTRACT_TIMEOUT):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='extract')
+        self._capacity = max_workers + max_queue
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.timeout = timeout
+
+    async def run(self, func, *args, timeout=None):
+        """Выполняет func(*args) в пуле и ждет результат не дольше timeout секунд."""
+        with self._lock:
+            if self._pending >= self._capacity:
+                raise RuntimeError("Очередь извлечения информации переполнена, попробуйте позже")
+            self._pending += 1
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(func, *args)
+        # Освобождаем место в очереди, только когда поток действительно завершил работу
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут извлечения информации ({timeout or self.timeout} сек) для {func.__name__}")
+            raise
+        finally:
+            # Запрос, еще не взятый потоком, просто снимается с очереди
+            future.cancel()
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+# Общий пул извлечения информации для всех загрузчиков
+extraction_engine = ExtractionEngine()
+
+class InfoCache:
+    """
+    In-memory TTL+LRU кэш словарей информации о видео, ключ - канонический ID видео.
+
+    Позволяет выбору качества и скачиванию использовать одну и ту же извлеченную
+    информацию вместо повторного запроса страницы. Хранятся очищенные копии
+    (sanitize_info), которые можно передавать в процессы пула загрузок.
+    """
+
+    def __init__(self, max_entries=config.INFO_CACHE_SIZE, ttl=config.INFO_CACHE_TTL):
+        self._entries = OrderedDict()  # ключ видео -> (время истечения, info)
+        self._aliases = {}  # канонический ключ URL -> ключ видео
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def video_key(info):
+        """Канонический ключ видео: экстрактор + ID."""
+        if not info or not info.get('id'):
+            return None
+        extractor = info.get('extractor_key') or info.get('extractor') or 'generic'
+        return f"{extractor.lower()}:{info['id']}"
+
+    def put(self, url, info):
+        key = self.video_key(info)
+        if not key:
+            return None
+        info = yt_dlp.YoutubeDL.sanitize_info(info)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, info)
+            self._entries.move_to_end(key)
+            for alias in (url, info.get('webpage_url'), info.get('original_url')):
+                if alias:
+                    self._aliases[canonical_key(alias)] = key
+            while len(self._entries) > self._max_entries:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._drop_aliases(evicted_key)
+        return key
+
+    def get(self, url):
+        """Возвращает копию информации о видео по URL (или ключу видео) либо None."""
+        alias = canonical_key(url)
+        with self._lock:
+            key = self._aliases.get(alias, url)
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            expires_at, info = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                self._drop_aliases(key)
+                return None
+            self._entries.move_to_end(key)
+        # Копия: вызывающий код может изменять словарь (сортировка форматов, process_ie_result)
+        return copy.deepcopy(info)
+
+    def key_for(self, url):
+        """Возвращает ключ видео для URL, если информация о нем уже извлекалась."""
+        alias = canonical_key(url)
+        with self._lock:
+            return self._aliases.get(alias)
+
+    def _drop_aliases(self, key):
+        for alias in [alias for alias, value in self._aliases.items() if value == key]:
+            del self._aliases[alias]
+
+# Общий кэш информации о видео
+info_cache = InfoCache()
+
+class _LoopChannel:
+    """Потокобезопасный канал: передает события из рабочего потока в обработчик в event loop."""
+
+    def __init__(self, loop, handler):
+        self._loop = loop
+        self._handler = handler
+
+    def put(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._handler, event)
+        except RuntimeError:
+            # Event loop уже закрыт (остановка бота) - событие прогресса можно потерять
+            pass
+
+class DownloadExecutor:
+    """
+    Выделенный пул для полного цикла загрузки (извлечение, скачивание, слияние).
+
+    Слот пула занят, пока рабочий поток (или процесс) действительно выполняет загрузку,
+    и освобождается при выходе из run_download_job, поэтому MAX_CONCURRENT_DOWNLOADS
+    означает ровно столько параллельных скачиваний.
+
+    Режим 'thread': загрузки выполняются в потоках, прогресс передается через
+    call_soon_threadsafe. Режим 'process': загрузки выполняются в дочерних процессах
+    (не конкурируют с ботом за GIL), события прогресса приходят через общую очередь
+    multiprocessing и пересылаются в event loop отдельным потоком-насосом.
+
+    Воркер проверяет срок загрузки только в progress hook, поэтому run() ограничивает
+    выполнение и снаружи: по истечении срока загрузка отменяется, а процесс, который не
+    остановился за DOWNLOAD_STOP_GRACE, завершается. Поток завершить нельзя: в режиме
+    'thread' ожидание прекращается, а поток выходит при следующем событии прогресса.
+    """
+
+    def __init__(self, max_workers=config.MAX_CONCURRENT_DOWNLOADS, timeout=config.DOWNLOAD_TIMEOUT,
+                 mode=config.DOWNLOAD_WORKER_MODE):
+        self.timeout = timeout
+        self.mode = mode
+        if mode == 'process':
+            self._max_workers = max_workers
+            self._mp_context = multiprocessing.get_context('spawn')
+            self._executor = self._new_process_pool()
+            # Менеджер, очередь прогресса и поток-насос создаются при первой загрузке
+            self._manager = None
+            self._progress_queue = None
+            self._pump_thread = None
+            self._handlers = {}
+            self._handlers_lock = threading.Lock()
+            # Выполняющиеся загрузки по пулам и зависшие загрузки выведенных из работы пулов
+            self._running_jobs = {}
+            self._stuck_jobs = {}
+            self._jobs_lock = threading.Lock()
+        elif mode == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        else:
+            raise ValueError(f"Неизвестный режим пула загрузок: {mode}")
+
+    def new_cancel_event(self):
+        """Создает событие отмены, доступное рабочему потоку или процессу."""
+        if self.mode == 'process':
+            self._ensure_process_channel()
+            return self._manager.Event()
+        return threading.Event()
+
+    def _new_process_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=self._mp_context,
+            initializer=init_worker_process
+        )
+
+    async def run(self, url, ydl_opts, on_progress, cancel_event, timeout=None, info=None):
+        """Запускает загрузку в пуле; on_progress вызывается в event loop для каждого события."""
+        loop = asyncio.get_running_loop()
+        timeout = timeout or self.timeout
+        started = asyncio.Event()
+        worker = {}
+
+        def handle_event(event):
+            # Начало выполнения: отсюда отсчитывается срок, PID нужен, чтобы завершить зависший процесс
+            if event.get('status') == 'started':
+                worker['pid'] = event.get('pid')
+                started.set()
+                return
+            on_progress(event)
+
+        job_id = None
+        if self.mode == 'process':
+            self._ensure_process_channel()
+            job_id = uuid.uuid4().hex
+            with self._handlers_lock:
+                self._handlers[job_id] = (loop, handle_event)
+            channel = QueueChannel(self._progress_queue, job_id)
+        else:
+            channel = _LoopChannel(loop, handle_event)
+
+        executor = self._executor
+        future = executor.submit(
+            run_download_job, url, ydl_opts, channel, cancel_event, timeout, info
+        )
+        if self.mode == 'process':
+            self._track_job(executor, future)
+        job = asyncio.wrap_future(future, loop=loop)
+        try:
+            # Ожидание свободного слота пула в срок загрузки не входит
+            started_wait = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait({job, started_wait}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started_wait.cancel()
+            try:
+                result = await asyncio.wait_for(asyncio.shield(job), timeout + config.DOWNLOAD_STOP_GRACE)
+            except asyncio.TimeoutError:
+                # Срок истек вне progress hook (извлечение, зависание, слияние ffmpeg)
+                logger.warning(f"Загрузка {url} не завершилась за {timeout} с, отменяем")
+                cancel_event.set()
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(job), config.DOWNLOAD_STOP_GRACE)
+                except asyncio.TimeoutError:
+                    job.cancel()
+                    logger.error(f"Загрузка {url} не остановилась после отмены")
+                    if self.mode == 'process':
+                        self._retire_stuck_worker(executor, future, worker.get('pid'))
+                    raise asyncio.TimeoutError(f"Превышено время ожидания загрузки {url}")
+        except asyncio.CancelledError:
+            # Задача-владелец отменена: прерываем загрузку, слот освободится при выходе воркера
+            cancel_event.set()
+            raise
+        finally:
+            if job_id:
+                with self._handlers_lock:
+                    self._handlers.pop(job_id, None)
+
+        if result['status'] == 'timeout':
+            raise asyncio.TimeoutError(f"Превышено время ожидания загрузки {url}")
+        if result['status'] == 'error':
+            raise RuntimeError(result['error'])
+        return result
+
+    def _track_job(self, executor, future):
+        with self._jobs_lock:
+            self._running_jobs.setdefault(executor, set()).add(future)
+        future.add_done_callback(lambda f: self._job_done(executor, f))
+
+    def _job_done(self, executor, future):
+        with self._jobs_lock:
+            self._running_jobs.get(executor, set()).discard(future)
+            self._terminate_if_drained(executor)
+
+    def _retire_stuck_worker(self, executor, future, pid):
+        """
+        Выводит из работы пул с зависшим процессом загрузки.
+
+        Новые загрузки сразу уходят в новый пул. Завершение процесса ломает весь
+        ProcessPoolExecutor, поэтому зависший процесс завершается, когда остальные
+        загрузки старого пула закончатся.
+        """
+        with self._jobs_lock:
+            if executor is self._executor:
+                self._executor = self._new_process_pool()
+                executor.shutdown(wait=False)
+            self._stuck_jobs.setdefault(executor, {})[future] = pid
+            self._terminate_if_drained(executor)
+
+    def _terminate_if_drained(self, executor):
+        """Завершает зависшие процессы пула, если других загрузок в нем не осталось (под _jobs_lock)."""
+        stuck = self._stuck_jobs.get(executor)
+        if not stuck or self._running_jobs.get(executor, set()) - stuck.keys():
+            return
+        for future, pid in stuck.items():
+            if future.done() or not pid:
+                continue
+            logger.warning(f"Завершение зависшего процесса загрузки {pid}")
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        del self._stuck_jobs[executor]
+        self._running_jobs.pop(executor, None)
+
+    def _ensure_process_channel(self):
+        """Запускает менеджер multiprocessing и поток, пересылающий прогресс в event loop."""
+        with self._handlers_lock:
+            if self._manager is not None:
+                return
+            self._manager = self._mp_context.Manager()
+            self._progress_queue = self._manager.Queue()
+            self._pump_thread = threading.Thread(
+                target=self._pump_progress, name='download-progress-pump', daemon=True
+            )
+            self._pump_thread.start()
+
+    def _pump_progress(self):
+        """Читает события из очереди процессов и передает их обработчикам в event loop."""
+        while True:
+            try:
+                item = self._progress_queue.get()
+            except (EOFError, OSError):
+                # Менеджер остановлен
+                return
+            if item is None:
+                return
+            job_id, event = item
+            with self._handlers_lock:
+                handler = self._handlers.get(job_id)
+            if not handler:
+                continue
+            loop, on_progress = handler
+            try:
+                loop.call_soon_threadsafe(on_progress, event)
+            except RuntimeError:
+                pass
+
+    def shutdown(self):
+        """Останавливает пул загрузок (и вспомогательные процессы в режиме 'process')."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.mode == 'process' and self._manager is not None:
+            try:
+                self._progress_queue.put(None)
+            except Exception:
+                pass
+            self._manager.shutdown()
+
+# Общий пул загрузок
+download_executor = DownloadExecutor()
+
+class _DownloadFlight:
+    """Общая загрузка (single-flight), к которой присоединяются одинаковые запросы."""
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+        self.subscribers = {}  # ключ запроса -> событие его отмены; запросы получают прогресс и результат
+        self.task = None
 
 class VideoDownloader:
     def __init__(self):
@@ -56,9 +402,34 @@ class VideoDownloader:
             os.makedirs(config.DOWNLOAD_DIR)
         # Добавляем ссылку на объект базы данных
         self.db = db
+        # Выполняющиеся загрузки: (ключ видео, формат, постобработка) -> общая загрузка
+        self._inflight = {}
+        # Ключ запроса -> общая загрузка, к которой он присоединен
+        self._flights_by_key = {}
     
     async def get_video_info(self, url: str, ydl_opts: dict = None) -> dict:
-        """Получает информацию о видео со всеми доступными форматами."""
+        """Получает информацию о видео со всеми доступными форматами (в пуле извлечения)."""
+        # Информация, извлеченная без особых опций, переиспользуется из кэша
+        if not ydl_opts:
+            cached_info = info_cache.get(url)
+            if cached_info:
+                logger.info(f"Информация о видео {url} взята из кэша")
+                return cached_info
+
+        cancel_event = threading.Event()
+        try:
+            info = await extraction_engine.run(self._extract_video_info, url, ydl_opts, cancel_event)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Сообщаем потоку, что результат больше не нужен (оставшиеся попытки будут пропущены)
+            cancel_event.set()
+            raise
+
+        if info and info.get('formats'):
+            info_cache.put(url, info)
+        return info
+
+    def _extract_video_info(self, url: str, ydl_opts: dict = None, cancel_event: threading.Event = None) -> dict:
+        """Синхронное извлечение информации о видео (выполняется в потоке пула извлечения)."""
         try:
             # Базовые опции для надежного получения информации о видео
             base_opts = {
@@ -101,6 +472,10 @@ class VideoDownloader:
                 # Логируем ошибку первого метода, но не выходим из функции
                 logger.warning(f"Ошибка при стандартном методе получения форматов: {e}")
             
+            if cancel_event and cancel_event.is_set():
+                logger.info(f"Извлечение информации о видео {url} отменено")
+                return {}
+
             # Попытка 2: Используем другие параметры
             try:
                 alt_opts = {
@@ -129,6 +504,10 @@ class VideoDownloader:
             except Exception as e:
                 logger.warning(f"Ошибка при альтернативном методе получения форматов: {e}")
                 
+            if cancel_event and cancel_event.is_set():
+                logger.info(f"Извлечение информации о видео {url} отменено")
+                return {}
+
             # Попытка 3: Используем YouTube DL Raw
             try:
                 raw_opts = {
@@ -171,7 +550,7 @@ class VideoDownloader:
                 return
             
             # --- Изменено: Ищем исходный URL по НОРМАЛИЗОВАННОМУ каноническому --- 
-            normalized_canonical_hook_url = normalize_url(url)
+            normalized_canonical_hook_url = canonical_key(url)
             if not normalized_canonical_hook_url:
                  logger.warning(f"Progress hook: Failed to normalize canonical URL '{url}'. Skipping update.")
                  return
@@ -220,7 +599,7 @@ class VideoDownloader:
             url = d.get('info_dict', {}).get('webpage_url')
             if url:
                 # --- Изменено: Используем блокировку и НОРМАЛИЗОВАННЫЙ URL ---
-                normalized_canonical_hook_url = normalize_url(url)
+                normalized_canonical_hook_url = canonical_key(url)
                 if not normalized_canonical_hook_url:
                      logger.warning(f"Progress hook (finished): Failed to normalize canonical URL '{url}'. Skipping final update.")
                      return
@@ -235,26 +614,23 @@ class VideoDownloader:
                         logger.debug(f"Progress hook marked finished for URL '{original_url}' (canonical: '{url}'). Filename: {d.get('filename')}")
                 # --- Конец изменений ---
 
-    async def download_video(self, url, format_id, user_id, chat_id=None, message_id=None, ydl_opts=None):
-        """Скачивает видео с указанным форматом."""
+    async def download_video(self, url, format_id, user_id, chat_id=None, message_id=None, ydl_opts=None, timeout=None):
+        """Скачивает видео с указанным форматом (в пуле загрузок, вне event loop)."""
         try:
             # Создаем директорию для пользователя, если она не существует
             user_dir = os.path.join(config.DOWNLOAD_DIR, f"user_{user_id}")
             os.makedirs(user_dir, exist_ok=True)
             
-            # Базовые опции для yt-dlp
+            # Базовые опции для yt-dlp (progress hook добавляется в рабочем потоке)
             base_opts = {
                 'outtmpl': os.path.join(user_dir, '%(title)s-%(id)s.%(ext)s'),
                 'quiet': True,
                 'no_warnings': True,
-                'progress_hooks': [lambda d: self._progress_hook(d, url)],
                 'restrictfilenames': True,
-                'no_color': True
+                'no_color': True,
+                'socket_timeout': 30
             }
             
-            # Добавляем ID пользователя в опции
-            base_opts['user_id'] = user_id
-            
             # Опции для формата (если не переданы в ydl_opts)
             if not ydl_opts or 'format' not in ydl_opts:
                 if format_id == 'audio':
@@ -275,9 +651,10 @@ class VideoDownloader:
             logger.info(f"Опции для yt-dlp: {final_opts}")
             
             # Добавляем информацию о загрузке в активные загрузки
+            key = download_key(user_id, chat_id, url)
             with data_lock:
-                if url not in active_downloads:
-                    active_downloads[url] = {
+                if key not in active_downloads:
+                    active_downloads[key] = {
                         'status': 'initializing',
                         'percent': 0,
                         'percent_rounded': 0,
@@ -293,314 +670,256 @@ class VideoDownloader:
                         'chat_id': chat_id,
                         'message_id': message_id
                     }
+                elif active_downloads[key]['cancelled']:
+                    logger.info(f"Загрузка для {url} была отменена перед началом скачивания")
+                    return {
+                        'success': False,
+                        'error': 'Загрузка была отменена пользователем'
+                    }
             
-            # Скачиваем видео
-            with yt_dlp.YoutubeDL(final_opts) as ydl:
-                # Получаем информацию о видео
-                info = ydl.extract_info(url, download=False)
-                
-                # Сохраняем канонический URL
-                with data_lock:
-                    if url in active_downloads and 'webpage_url' in info:
-                        # Преобразуем канонический URL в ключ для карты
-                        canonical_url = info['webpage_url']
-                        normalized_canonical = normalize_url(canonical_url)
-                        if normalized_canonical:
-                            # Сохраняем соответствие нормализованного канонического URL оригинальному
-                            canonical_url_map[normalized_canonical] = url
-                            # Сохраняем канонический URL в информации о загрузке
-                            active_downloads[url]['canonical_url'] = canonical_url
-                
-                # Скачиваем видео
-                if 'webpage_url' in info:
-                    logger.info(f"Начинаем загрузку видео с URL {info['webpage_url']}")
-                    # Сначала проверяем, не отменена ли загрузка
-                    with data_lock:
-                        if url in active_downloads and active_downloads[url]['cancelled']:
-                            logger.info(f"Загрузка для {url} была отменена перед началом скачивания")
-                            return {
-                                'success': False,
-                                'error': 'Загрузка была отменена пользователем'
-                            }
-                
-                # Начинаем загрузку
-                ydl.download([url])
-                
-                # Получаем имя файла
-                filename = ydl.prepare_filename(info)
-                
-                # Скачиваем превью, если оно доступно
-                thumbnail_path = None
-                if 'thumbnail' in info:
-                    try:
-                        thumbnail_url = info['thumbnail']
-                        thumbnail_path = os.path.join(user_dir, f"{os.path.basename(filename)}.jpg")
-                        
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(thumbnail_url) as response:
-                                if response.status == 200:
-                                    with open(thumbnail_path, 'wb') as f:
-                                        f.write(await response.read())
-                    except Exception as e:
-                        logger.error(f"Ошибка при скачивании превью: {e}")
-                
-                # Удаляем информацию о загрузке
+            # Одинаковые одновременные запросы (то же видео и формат) используют одну загрузку
+            flight_key = (
+                info_cache.key_for(url) or canonical_key(url),
+                final_opts.get('format'),
+                json.dumps(final_opts.get('postprocessors'), sort_keys=True, default=str)
+            )
+            flight = self._inflight.get(flight_key)
+            if flight:
+                logger.info(f"Загрузка {url} присоединена к выполняющейся загрузке {flight_key[0]} ({flight_key[1]})")
+            else:
+                flight = _DownloadFlight(download_executor.new_cancel_event())
+                self._inflight[flight_key] = flight
+                flight.task = asyncio.ensure_future(
+                    self._run_flight(flight_key, flight, url, final_opts, user_dir, timeout)
+                )
+            cancelled = asyncio.Event()
+            flight.subscribers[key] = cancelled
+            self._flights_by_key[key] = flight
+            cancel_wait = asyncio.ensure_future(cancelled.wait())
+            try:
+                # Отмененный запрос выходит сразу, общая загрузка продолжается для остальных
+                await asyncio.wait({flight.task, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                # Задача запроса отменена: общая загрузка прерывается, только если она больше никому не нужна
+                self._detach_from_flight(flight, key)
+                if not flight.subscribers:
+                    flight.cancel_event.set()
+                raise
+            finally:
+                cancel_wait.cancel()
+                self._detach_from_flight(flight, key)
+            
+            with data_lock:
+                cancelled_by_user = cancelled.is_set() or active_downloads.get(key, {}).get('cancelled', False)
+            job = None if cancelled_by_user else flight.task.result()
+            if cancelled_by_user or job['status'] == 'cancelled':
+                logger.info(f"Загрузка для {url} была отменена")
                 with data_lock:
-                    if url in active_downloads:
-                        del active_downloads[url]
-                
+                    active_downloads.pop(key, None)
                 return {
-                    'success': True,
-                    'filename': filename,
-                    'thumbnail': thumbnail_path,
-                    'title': info.get('title', ''),
-                    'duration': info.get('duration', 0),
-                    'format': format_id
+                    'success': False,
+                    'error': 'Загрузка была отменена пользователем'
                 }
+            
+            filename = job['filename']
+            thumbnail_path = job.get('thumbnail_path')
+            
+            # Удаляем информацию о загрузке
+            with data_lock:
+                active_downloads.pop(key, None)
+            
+            return {
+                'success': True,
+                'filename': filename,
+                'thumbnail': thumbnail_path,
+                'title': job.get('title', ''),
+                'duration': job.get('duration', 0),
+                'format': format_id
+            }
+        
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут при скачивании видео {url}")
+            with data_lock:
+                active_downloads.pop(download_key(user_id, chat_id, url), None)
+            raise
         
         except Exception as e:
             logger.error(f"Ошибка при скачивании видео {url}: {e}")
             
             # Удаляем информацию о загрузке
             with data_lock:
-                if url in active_downloads:
-                    del active_downloads[url]
+                active_downloads.pop(download_key(user_id, chat_id, url), None)
             
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    def get_download_progress(self, url):
-        """Возвращает прогресс загрузки для указанного URL"""
-        progress_data = active_downloads.get(url)
-        logger.debug(f"get_download_progress called for URL '{url}'. Returning: {progress_data}")
+    async def _run_flight(self, flight_key, flight, url, final_opts, user_dir, timeout):
+        """Выполняет общую загрузку для всех присоединившихся запросов."""
+        try:
+            # Информация, полученная при выборе качества, избавляет от повторного извлечения
+            cached_info = info_cache.get(url)
+            if cached_info:
+                logger.info(f"Скачивание {url} по кэшированной информации о видео")
+            job = await download_executor.run(
+                url, final_opts, lambda d: self._dispatch_progress(flight, d), flight.cancel_event,
+                timeout=timeout, info=cached_info
+            )
+            if job.get('info'):
+                info_cache.put(url, job['info'])
+            if job['status'] == 'finished':
+                job['thumbnail_path'] = await self._download_thumbnail(job.get('thumbnail'), job['filename'], user_dir)
+            return job
+        finally:
+            if self._inflight.get(flight_key) is flight:
+                del self._inflight[flight_key]
+
+    def _dispatch_progress(self, flight, d):
+        """Передает событие прогресса общей загрузки всем присоединившимся запросам."""
+        for subscriber_key in list(flight.subscribers):
+            self._progress_hook(d, subscriber_key)
+
+    def _detach_from_flight(self, flight, key):
+        flight.subscribers.pop(key, None)
+        if self._flights_by_key.get(key) is flight:
+            del self._flights_by_key[key]
+
+    async def _download_thumbnail(self, thumbnail_url, filename, user_dir):
+        """Скачивает превью видео рядом с файлом, возвращает путь или None."""
+        if not thumbnail_url:
+            return None
+        try:
+            thumbnail_path = os.path.join(user_dir, f"{os.path.basename(filename)}.jpg")
+            async with aiohttp.ClientSession() as session:
+                async with session.get(thumbnail_url) as response:
+                    if response.status != 200:
+                        return None
+                    async with aiofiles.open(thumbnail_path, 'wb') as f:
+                        await f.write(await response.read())
+            return thumbnail_path
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании превью: {e}")
+            return None
+
+    def get_download_progress(self, key):
+        """Возвращает прогресс загрузки для ключа запроса (download_key)"""
+        progress_data = active_downloads.get(key)
+        logger.debug(f"get_download_progress called for '{key}'. Returning: {progress_data}")
         return progress_data
 
-    def cancel_download(self, url):
-        """Отменяет загрузку для указанного URL."""
+    def cancel_download(self, key):
+        """Отменяет загрузку для ключа запроса (download_key): другие запросы того же видео продолжаются."""
         try:
             with data_lock:
-                if url in active_downloads:
+                if key in active_downloads:
                     # Помечаем загрузку как отмененную
-                    active_downloads[url]['cancelled'] = True
-                    active_downloads[url]['status'] = 'cancelled'
-                    logger.info(f"Загрузка {url} помечена как отмененная")
+                    active_downloads[key]['cancelled'] = True
+                    active_downloads[key]['status'] = 'cancelled'
+                    flight = self._flights_by_key.get(key)
+                    if flight:
+                        # Запрос выходит из общей загрузки; скачивание прерывается, только если других запросов не осталось
+                        cancelled = flight.subscribers.pop(key, None)
+                        if cancelled:
+                            cancelled.set()
+                        if not flight.subscribers:
+                            flight.cancel_event.set()
+                    logger.info(f"Загрузка {key} помечена как отмененная")
                     return True
                 else:
-                    logger.warning(f"URL {url} не найден в активных загрузках")
+                    logger.warning(f"Загрузка {key} не найдена в активных загрузках")
                     return False
         except Exception as e:
-            logger.error(f"Ошибка при отмене загрузки {url}: {e}")
+            logger.error(f"Ошибка при отмене загрузки {key}: {e}")
             return False
 
-    async def split_large_video(self, file_path, max_segment_size=35):
+    async def _run_tool(self, cmd):
+        """Запускает ffmpeg/ffprobe без блокировки event loop, возвращает (код, stdout, stderr)."""
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        return process.returncode, stdout.decode('utf-8', 'ignore'), stderr.decode('utf-8', 'ignore')
+
+    async def iter_split_parts(self, file_path, max_part_size=config.SPLIT_PART_TARGET, first_part=1):
         """
-        Разделяет большие видео на части с использованием FFmpeg (асинхронные операции с файлами).
-        Удален аварийный режим разделения по байтам.
-        
-        Args:
-            file_path: Путь к исходному видео
-            max_segment_size: Максимальный размер сегмента в MB (по умолчанию 35MB)
-            
-        Returns:
-            list: Список путей к созданным файлам частей
+        Асинхронный генератор частей большого видео: (номер, всего частей, путь).
+        Части до first_part не нарезаются (они уже отправлены ранее).
+
+        Каждая часть нарезается только когда ее запрашивают (ffmpeg с поиском по входу,
+        без перекодирования), поэтому вызывающий код может отправлять часть i, пока
+        нарезается часть i+1, и удалять отправленные части сразу.
         """
-        output_files = []
-        temp_files = []
+        plan = await plan_split(file_path, max_part_size)
+        boundaries = [0.0] + plan['cut_times'] + [None]
+        total_parts = len(boundaries) - 1
+        base_name, ext = os.path.splitext(file_path)
 
-        # --- Изменено: Асинхронная проверка файла --- 
-        if not await aiofiles.os.path.exists(file_path):
-            logger.error(f"Файл для разделения не найден: {file_path}")
-            return []
+        for i in range(first_part - 1, total_parts):
+            start, end = boundaries[i], boundaries[i + 1]
+            part_path = f"{base_name}_part{i + 1}{ext}"
+            # Поиск чуть позже ключевого кадра: ffmpeg начинает копирование с него же
+            seek_point = start + CUT_EPSILON if start > 0 else 0.0
+            cmd_ffmpeg = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+            if seek_point > 0:
+                cmd_ffmpeg += ['-ss', f"{seek_point:.6f}"]
+            cmd_ffmpeg += ['-i', file_path]
+            if end is not None:
+                # Часть заканчивается перед следующим ключевым кадром разреза
+                cmd_ffmpeg += ['-t', f"{end - seek_point:.6f}"]
+            cmd_ffmpeg += ['-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero', '-y', part_path]
 
-        try:
-            # 1. Получаем информацию о видео (длительность) через ffprobe
-            cmd_probe = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                '-show_format', '-show_streams', file_path
-            ]
             try:
-                result = subprocess.run(
-                    cmd_probe, capture_output=True, text=True,
-                    encoding='utf-8', errors='ignore', check=True
-                )
-                ffprobe_output = result.stdout
-            except (subprocess.CalledProcessError, FileNotFoundError) as ff_err:
-                logger.error(f"Ошибка при выполнении ffprobe для {file_path}: {ff_err}")
-                raise ValueError(f"Не удалось получить информацию о видео {file_path}") from ff_err
-            except Exception as ff_generic_err:
-                logger.error(f"Неожиданная ошибка при вызове ffprobe для {file_path}: {ff_generic_err}")
-                raise ValueError(f"Не удалось получить информацию о видео {file_path}") from ff_generic_err
-
-            duration_seconds = None
-            if ffprobe_output:
-                try:
-                    info = json.loads(ffprobe_output)
-                    if 'format' in info and 'duration' in info['format']:
-                        duration_seconds = float(info['format']['duration'])
-                    elif 'streams' in info and len(info['streams']) > 0 and 'duration' in info['streams'][0]:
-                        duration_seconds = float(info['streams'][0]['duration'])
-                except (json.JSONDecodeError, KeyError, TypeError, ValueError) as json_err:
-                    logger.error(f"Ошибка при разборе JSON от ffprobe для {file_path}: {json_err}")
-                    # Ошибка разбора JSON не критична, если можем получить длительность иначе
-
-            # Если из JSON не вышло, пробуем напрямую
-            if not duration_seconds:
-                cmd_duration = [
-                    'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1', file_path
-                ]
-                try:
-                    result_duration = subprocess.run(
-                        cmd_duration, capture_output=True, text=True,
-                        encoding='utf-8', errors='ignore', check=True
-                    )
-                    if result_duration.stdout:
-                        duration_seconds = float(result_duration.stdout.strip())
-                except Exception as dur_err:
-                    logger.warning(f"Не удалось получить длительность через format=duration для {file_path}: {dur_err}")
-
-            # Если длительность все еще неизвестна, разделение невозможно
-            if not duration_seconds or duration_seconds <= 0:
-                logger.error(f"Не удалось определить валидную продолжительность для {file_path}. Разделение невозможно.")
-                raise ValueError(f"Не удалось определить продолжительность видео {file_path}")
-
-            # --- Изменено: Асинхронное получение размера --- 
-            stat_result = await aiofiles.os.stat(file_path)
-            file_size_mb = stat_result.st_size / (1024 * 1024)
-            if file_size_mb <= max_segment_size:
-                logger.info(f"Файл {file_path} ({file_size_mb:.2f}MB) не требует разделения.")
-                return [file_path]
-
-            logger.info(f"Начинаем разделение файла {file_path} ({file_size_mb:.2f}MB)")
-
-            # 3. Вычисляем параметры разделения
-            segment_count = math.ceil(file_size_mb / max_segment_size)
-            # Убедимся, что segment_duration не слишком мало
-            segment_duration = max(1.0, duration_seconds / segment_count)
-
-            base_name, ext = os.path.splitext(file_path)
-            temp_base = os.path.join(os.path.dirname(file_path), str(uuid.uuid4()))
-
-            # 4. Создаем каждый сегмент с помощью ffmpeg
-            for i in range(segment_count):
-                start_time = i * segment_duration
-                # Для последнего сегмента можно не указывать -t, чтобы захватить остаток
-                duration_arg = ['-t', str(segment_duration)]
-                if i == segment_count - 1:
-                    duration_arg = []
-
-                segment_temp_file = f"{temp_base}_part{i+1}{ext}"
-                original_segment_file = f"{base_name}_part{i+1}{ext}"
-                temp_files.append(segment_temp_file)
-
-                cmd_ffmpeg = [
-                    'ffmpeg', '-hide_banner', '-loglevel', 'error',
-                    '-i', file_path,
-                    '-ss', str(start_time),
-                ] + duration_arg + [
-                    '-c', 'copy',
-                    '-avoid_negative_ts', 'make_zero',
-                    '-y',
-                    segment_temp_file
-                ]
-
-                try:
-                    logger.info(f"Создание сегмента {i+1}/{segment_count}...")
-                    subprocess.run(cmd_ffmpeg, check=True, capture_output=True)
-
-                    # --- Изменено: Асинхронные операции с файлами --- 
-                    segment_exists = await aiofiles.os.path.exists(segment_temp_file)
-                    segment_size = 0
-                    if segment_exists:
-                         segment_stat = await aiofiles.os.stat(segment_temp_file)
-                         segment_size = segment_stat.st_size
-                         
-                    if segment_exists and segment_size > 0:
-                        if await aiofiles.os.path.exists(original_segment_file):
-                            await aiofiles.os.remove(original_segment_file)
-                        await aiofiles.os.rename(segment_temp_file, original_segment_file)
-                        output_files.append(original_segment_file)
-                        if segment_temp_file in temp_files: temp_files.remove(segment_temp_file) # Удаление из списка - синхронное
-                        logger.info(f"Сегмент {i+1} успешно создан: {original_segment_file}")
-                    else:
-                        logger.error(f"FFmpeg завершился, но сегмент {segment_temp_file} не создан или пуст.")
-                    # --- Конец изменений --- 
-
-                except subprocess.CalledProcessError as ffmpeg_err:
-                    logger.error(f"Ошибка FFmpeg при создании сегмента {i+1}: {ffmpeg_err}")
-                    logger.error(f"FFmpeg stderr: {ffmpeg_err.stderr.decode('utf-8', 'ignore')}")
-                except Exception as rename_err:
-                    logger.error(f"Ошибка при переименовании сегмента {i+1}: {rename_err}")
-
-            # Проверяем, созданы ли какие-либо файлы
-            if not output_files:
-                logger.error(f"Не удалось создать ни одного сегмента для {file_path}.")
-                raise RuntimeError(f"Не удалось разделить видео {file_path}")
-
-            return output_files
-
-        except Exception as e:
-            logger.error(f"Общая ошибка при разделении видео {file_path}: {e}")
-            # Удаляем все успешно созданные выходные файлы, так как процесс не завершился полностью
-            for f in output_files:
-                try:
-                    if await aiofiles.os.path.exists(f): await aiofiles.os.remove(f)
-                except OSError: pass
-            return []
-
-        finally:
-            # --- Изменено: Асинхронное удаление файлов --- 
-            for temp_f in temp_files:
-                try:
-                    if await aiofiles.os.path.exists(temp_f):
-                        await aiofiles.os.remove(temp_f)
-                        logger.debug(f"Удален временный файл сегмента: {temp_f}")
-                except OSError as rm_err:
-                    logger.warning(f"Не удалось удалить временный файл сегмента {temp_f}: {rm_err}")
-            # --- Конец изменений --- 
+                logger.info(f"Создание сегмента {i + 1}/{total_parts}...")
+                returncode, _, stderr = await self._run_tool(cmd_ffmpeg)
+                if returncode != 0:
+                    logger.error(f"FFmpeg stderr: {stderr}")
+                    raise RuntimeError(f"Ошибка FFmpeg при создании сегмента {i + 1} (код {returncode})")
+                if not await aiofiles.os.path.exists(part_path) or (await aiofiles.os.stat(part_path)).st_size == 0:
+                    raise RuntimeError(f"FFmpeg завершился, но сегмент {part_path} не создан или пуст")
+            except BaseException:
+                # Недорезанная часть не должна оставаться на диске (в том числе при отмене)
+                if await aiofiles.os.path.exists(part_path):
+                    await aiofiles.os.remove(part_path)
+                raise
+            yield i + 1, total_parts, part_path
 
     async def get_optimal_quality(self, url, user_id=None):
-        """Определяет оптимальное качество видео на основе доступных форматов и ограничений"""
+        """
+        Определяет оптимальный формат видео с учетом настроек пользователя и лимита Telegram.
+
+        Возвращает спецификацию формата для yt-dlp: лучший вариант не выше разрешения
+        из настроек пользователя, который поместится в одно сообщение, а если размеры
+        оценить нельзя - формат из пресета настроек.
+        """
+        user_format = "high"
         try:
-            info = await self.get_video_info(url)
-            formats = info.get('formats', [])
-            
-            if not formats:
-                return "high"  # Возвращаем высокое качество по умолчанию
-            
-            # Сортируем форматы по качеству, безопасно обрабатывая None
-            formats.sort(key=lambda x: x.get('quality') or 0, reverse=True)
-            
             # Получаем настройки пользователя
             if user_id:
-                user_format = db.get_user_settings(user_id)
-            else:
-                user_format = "high"
+                user_format = await db.get_user_settings(user_id)
+            preset = config.VIDEO_FORMATS.get(user_format, config.DEFAULT_VIDEO_FORMAT)
+            if user_format == 'audio':
+                return preset
             
-            # Определяем оптимальное качество
-            if user_format == "low":
-                return "low"
-            elif user_format == "medium":
-                return "medium"
-            elif user_format == "high":
-                # Проверяем, есть ли формат с разрешением 1080p или выше
-                for f in formats:
-                    if '1080' in f.get('resolution', ''):
-                        return "high"
-                return "medium"  # Если нет 1080p, возвращаем среднее качество
-            else:
-                return "high"
+            info = await self.get_video_info(url)
+            if not info or not info.get('formats'):
+                return preset
+            
+            # Максимальное разрешение из настроек ('1080p' -> 1080)
+            max_height = int(config.DEFAULT_QUALITY.get(user_format, '1080p').rstrip('p'))
+            option = best_fitting(format_options(info), max_height=max_height)
+            if option:
+                logger.info(f"Оптимальный формат для {url}: {option['format_id']} ({option['height']}p, ~{option['size']} байт)")
+                return option['format_id']
+            return preset
                 
         except Exception as e:
             logger.error(f"Ошибка при определении оптимального качества: {e}")
-            return "high"  # Возвращаем высокое качество по умолчанию в случае ошибки 
+            return config.VIDEO_FORMATS.get(user_format, config.DEFAULT_VIDEO_FORMAT)
 
     async def get_playlist_info(self, playlist_url):
         """Получение информации о плейлисте (название, список видео URL)."""
         try:
-            loop = asyncio.get_event_loop()
             ydl_opts = {
                 'quiet': True,
                 'extract_flat': 'in_playlist', # Получаем только базовую информацию о видео в плейлисте
@@ -669,7 +988,7 @@ class VideoDownloader:
                 logger.error(f"Все методы получения информации о плейлисте {playlist_url} не сработали")
                 raise ValueError(f"Failed to extract playlist info after multiple attempts for {playlist_url}")
             
-            info = await loop.run_in_executor(executor, _extract_playlist_info)
+            info = await extraction_engine.run(_extract_playlist_info, timeout=config.PLAYLIST_EXTRACT_TIMEOUT)
             
             # Проверка на None
             if info is None:
@@ -703,34 +1022,43 @@ class VideoDownloader:
             logger.error(f"Неожиданная ошибка при получении информации о плейлисте {playlist_url}: {e}")
             raise 
 
-    def _progress_hook(self, d, url):
-        """Хук для отслеживания прогресса загрузки."""
+    def _progress_hook(self, d, key):
+        """Применяет событие прогресса из рабочего потока загрузки к запросу key (вызывается в event loop)."""
         try:
             # Получаем информацию о загрузке
             with data_lock:
-                if url not in active_downloads:
-                    logger.warning(f"URL {url} не найден в активных загрузках")
+                if key not in active_downloads:
+                    logger.warning(f"Загрузка {key} не найдена в активных загрузках")
                     return
                 
-                download_info = active_downloads[url]
+                download_info = active_downloads[key]
                 
                 # Проверяем, не отменена ли загрузка
                 if download_info.get('cancelled', False):
-                    logger.info(f"Загрузка {url} была отменена")
+                    logger.info(f"Загрузка {key} была отменена")
                     return
                 
+                # Информация о видео получена: сохраняем канонический URL
+                if d['status'] == 'extracted':
+                    canonical_url = d.get('webpage_url')
+                    normalized_canonical = canonical_key(canonical_url)
+                    if normalized_canonical:
+                        # Сохраняем соответствие нормализованного канонического URL запросу
+                        canonical_url_map[normalized_canonical] = key
+                        download_info['canonical_url'] = canonical_url
+                
                 # Обновляем данные о прогрессе
-                if d['status'] == 'downloading':
-                    if 'downloaded_bytes' in d:
+                elif d['status'] == 'downloading':
+                    if d.get('downloaded_bytes'):
                         download_info['downloaded_bytes'] = d['downloaded_bytes']
-                    if 'total_bytes' in d:
+                    if d.get('total_bytes'):
                         download_info['total_bytes'] = d['total_bytes']
-                    elif 'total_bytes_estimate' in d:
+                    elif d.get('total_bytes_estimate'):
                         download_info['total_bytes'] = d['total_bytes_estimate']
                     
-                    if 'speed' in d and d['speed']:
+                    if d.get('speed'):
                         download_info['speed'] = d['speed']
-                    if 'eta' in d:
+                    if d.get('eta') is not None:
                         download_info['eta'] = d['eta']
                     
                     if download_info['total_bytes'] > 0:
@@ -739,10 +1067,6 @@ class VideoDownloader:
                     
                     download_info['status'] = 'downloading'
                     download_info['filename'] = d.get('filename')
-                    
-                    # Сохраняем ID пользователя, если он есть в данных
-                    if 'user_id' in d:
-                        download_info['user_id'] = d['user_id']
                 
                 elif d['status'] == 'finished':
                     download_info['status'] = 'finished'
@@ -750,16 +1074,16 @@ class VideoDownloader:
                     download_info['percent_rounded'] = 100
                     
                     # Сохраняем имя файла
-                    if 'filename' in d:
+                    if d.get('filename'):
                         download_info['filename'] = d['filename']
                 
-                active_downloads[url] = download_info
+                active_downloads[key] = download_info
                 
                 # Логируем прогресс
-                logger.debug(f"Прогресс загрузки {url}: {download_info['percent_rounded']}% ({download_info['downloaded_bytes']}/{download_info['total_bytes']})")
+                logger.debug(f"Прогресс загрузки {key}: {download_info['percent_rounded']}% ({download_info['downloaded_bytes']}/{download_info['total_bytes']})")
         
         except Exception as e:
-            logger.error(f"Ошибка в _progress_hook для {url}: {e}")
+            logger.error(f"Ошибка в _progress_hook для {key}: {e}")
 
     def get_ydl_options(self, format_id, output_dir, url):
         """Создает словарь с настройками для yt-dlp на основе запрошенного формата"""
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from urllib.parse import quote
+
+from aiohttp import web
+
+import config
+from database import Database, AsyncDatabase
+from url_signing import verify
+
+logger = logging.getLogger(__name__)
+
+db = AsyncDatabase(Database())
+
+# Размер блока при передаче с лимитом скорости
+THROTTLED_CHUNK_SIZE = 256 * 1024
+
+class LinkFileServer:
+    """
+    Встроенный файловый сервер прямых ссылок (aiohttp) для развертывания без nginx.
+
+    Отдает файлы DIRECT_LINK_STORAGE по имени из индекса прямых ссылок и файлы кэша
+    загрузок по подписанным ссылкам. Поддерживает Range (докачка, перемотка), передает
+    файл через sendfile без копирования в память процесса, ограничивает скорость
+    на соединение и число одновременных скачиваний. Срок действия ссылки проверяется
+    при каждом запросе.
+    """
+    def __init__(self, max_connections=None, rate_limit_kbps=None):
+        self.max_connections = max_connections or config.DIRECT_LINK_SERVER_MAX_CONNECTIONS
+        if rate_limit_kbps is None:
+            rate_limit_kbps = config.DIRECT_LINK_SERVER_RATE_LIMIT_KBPS
+        self.rate_limit = rate_limit_kbps * 1024  # байт в секунду, 0 - без лимита
+        self._semaphore = None
+        self._runner = None
+
+    def create_app(self):
+        """Приложение aiohttp с маршрутами прямых и подписанных ссылок."""
+        app = web.Application()
+        app.router.add_get(config.DIRECT_LINK_SIGNED_PREFIX.rstrip('/') + '/{path:.+}', self.handle_signed)
+        app.router.add_get('/{file_name}', self.handle_link)
+        return app
+
+    async def start(self, host=None, port=None):
+        """Запуск сервера в текущем event loop (вместе с ботом)."""
+        host = host or config.DIRECT_LINK_SERVER_HOST
+        port = port or config.DIRECT_LINK_SERVER_PORT
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Файловый сервер прямых ссылок запущен на {host}:{port}")
+
+    async def stop(self):
+        """Остановка сервера."""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_link(self, request):
+        """Файл из хранилища прямых ссылок: проверка по индексу и срока действия."""
+        file_name = request.match_info['file_name']
+        row = await db.get_direct_link(file_name)
+        if not row:
+            raise web.HTTPNotFound()
+        file_path, original_filename, _, expires_at = row
+        now = datetime.now()
+        if expires_at and expires_at <= now:
+            raise web.HTTPGone()
+        await db.mark_direct_link_served(file_name, now)
+        return await self._serve_file(request, file_path, original_filename or file_name)
+
+    async def handle_signed(self, request):
+        """Файл кэша загрузок по подписанной ссылке (та же проверка, что у nginx secure_link)."""
+        if not config.DIRECT_LINK_SECRET:
+            raise web.HTTPNotFound()
+        token = request.query.get('md5')
+        expires = request.query.get('expires')
+        # now=0: проверяется только подпись, чтобы отличить подделку от истекшей ссылки
+        if not verify(request.path, token, expires, config.DIRECT_LINK_SECRET, now=0):
+            raise web.HTTPForbidden()
+        if not verify(request.path, token, expires, config.DIRECT_LINK_SECRET):
+            raise web.HTTPGone()
+
+        cache_root = os.path.realpath(config.DOWNLOAD_DIR)
+        file_path = os.path.realpath(os.path.join(cache_root, request.match_info['path']))
+        if os.path.commonpath([cache_root, file_path]) != cache_root:
+            raise web.HTTPForbidden()
+        return await self._serve_file(request, file_path, os.path.basename(file_path))
+
+    async def _serve_file(self, request, file_path, download_name):
+        if not os.path.isfile(file_path):
+            raise web.HTTPNotFound()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        if self._semaphore.locked():
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '10'})
+
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+        }
+        async with self._semaphore:
+            if not self.rate_limit:
+                # FileResponse сам обрабатывает Range и передает файл через sendfile.
+                # prepare() выполняет передачу, поэтому слот занят до ее окончания
+                response = web.FileResponse(file_path, headers=headers)
+                await response.prepare(request)
+                return response
+            return await self._serve_throttled(request, file_path, headers)
+
+    async def _serve_throttled(self, request, file_path, headers):
+        """Передача с лимитом скорости на соединение и поддержкой Range."""
+        file_size = os.path.getsize(file_path)
+        try:
+            requested = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f"bytes */{file_size}"})
+
+        status = 200
+        start, stop = 0, file_size
+        if requested.start is not None or requested.stop is not None:
+            start = requested.start or 0
+            if start < 0:
+                # bytes=-N: последние N байт
+                start = max(0, file_size + start)
+            stop = file_size if requested.stop is None else min(requested.stop, file_size)
+            if start >= stop:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f"bytes */{file_size}"})
+            status = 206
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+        headers['Accept-Ranges'] = 'bytes'
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = stop - start
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        sent = 0
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            while sent < stop - start:
+                chunk = await asyncio.to_thread(f.read, min(THROTTLED_CHUNK_SIZE, stop - start - sent))
+                if not chunk:
+                    break
+                await response.write(chunk)
+                sent += len(chunk)
+                # Держим среднюю скорость не выше лимита
+                delay = sent / self.rate_limit - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+if __name__ == '__main__':
+    # Отдельный запуск сервера (локальная проверка, замер скорости отдачи)
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(LinkFileServer().create_app(), host=config.DIRECT_LINK_SERVER_HOST, port=config.DIRECT_LINK_SERVER_PORT)
@@ -0,0 +1,77 @@
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+# Совместимые контейнеры для слияния видео и аудио без перекодирования
+_AUDIO_EXT_FOR_VIDEO = {'mp4': 'm4a', 'webm': 'webm'}
+
+def estimate_size(fmt, duration):
+    """Оценка размера формата в байтах: filesize, filesize_approx или tbr * длительность."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def _pick_audio(audio_formats, video_ext):
+    """Лучшее аудио для слияния: сначала совместимый контейнер, затем максимальный битрейт."""
+    if not audio_formats:
+        return None
+    preferred_ext = _AUDIO_EXT_FOR_VIDEO.get(video_ext)
+    return max(
+        audio_formats,
+        key=lambda a: (a.get('ext') == preferred_ext, a.get('abr') or a.get('tbr') or 0)
+    )
+
+def format_options(info, limit=config.SPLIT_PART_TARGET):
+    """
+    Варианты качества видео с оценкой итогового размера после слияния видео и аудио.
+
+    Для каждого разрешения перебираются комбинации видео(+лучшее аудио) и выбирается
+    лучшая по битрейту из тех, что помещаются в limit, а если не помещается ни одна -
+    просто лучшая. Возвращает список словарей (по убыванию разрешения):
+    height, format_id (спецификация для yt-dlp), size (байты или None), fits (True/False/None).
+    """
+    duration = info.get('duration')
+    formats = info.get('formats') or []
+    audio_formats = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+
+    combos_by_height = {}
+    for fmt in formats:
+        height = fmt.get('height') or 0
+        if fmt.get('vcodec') == 'none' or height <= 0:
+            continue
+        size = estimate_size(fmt, duration)
+        format_id = fmt.get('format_id')
+        if fmt.get('acodec') in (None, 'none'):
+            # Видео без звука: добавляем аудио, размер - сумма обоих потоков
+            audio = _pick_audio(audio_formats, fmt.get('ext'))
+            if audio:
+                audio_size = estimate_size(audio, duration)
+                format_id = f"{format_id}+{audio.get('format_id')}"
+                size = size + audio_size if size and audio_size else None
+        combos_by_height.setdefault(height, []).append({
+            'height': height,
+            'format_id': format_id,
+            'size': size,
+            'fits': size <= limit if size else None,
+            'tbr': fmt.get('tbr') or 0
+        })
+
+    options = []
+    for height in sorted(combos_by_height, reverse=True):
+        combos = combos_by_height[height]
+        fitting = [c for c in combos if c['fits']]
+        options.append(max(fitting or combos, key=lambda c: (c['tbr'], c['size'] or 0)))
+    return options
+
+def best_fitting(options, max_height=None):
+    """Вариант с максимальным разрешением, который помещается в одно сообщение Telegram."""
+    for option in options:
+        if max_height and option['height'] > max_height:
+            continue
+        if option['fits']:
+            return option
+    return None
@@ -1,15 +1,192 @@
 import os
+import errno
 import uuid
-import time
+import asyncio
+import heapq
 import hashlib
 import json
 from datetime import datetime, timedelta
-import aiofiles
 import config
 import logging
+from database import Database, AsyncDatabase
+from url_signing import signed_url
 
 logger = logging.getLogger(__name__)
 
+# Индекс прямых ссылок хранится в общей базе данных (запись - в общем потоке-писателе)
+db = AsyncDatabase(Database())
+
+# ioctl FICLONE (Linux): клонирование файла на CoW-файловых системах (btrfs, xfs)
+FICLONE = 0x40049409
+# Размер блока копирования, если клонирование невозможно
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+def _reflink(src_fd, dst_fd):
+    import fcntl
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_chunked(src_fd, dst_fd, size):
+    """Копирование внутри ядра блоками: память не зависит от размера файла."""
+    offset = 0
+    copy_range = getattr(os, 'copy_file_range', None)
+    while offset < size:
+        count = min(COPY_CHUNK_SIZE, size - offset)
+        if copy_range:
+            try:
+                copied = copy_range(src_fd, dst_fd, count, offset_src=offset, offset_dst=offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copy_range = None
+                continue
+        else:
+            copied = os.sendfile(dst_fd, src_fd, offset, count)
+        if copied == 0:
+            break
+        offset += copied
+
+def publish_file(source_path, dest_path):
+    """
+    Публикует файл в хранилище прямых ссылок без чтения его в память.
+
+    Сначала жесткая ссылка (мгновенно, если файлы на одной файловой системе), затем
+    reflink-клон, затем поблочное копирование в ядре (copy_file_range/sendfile).
+    Возвращает использованный способ.
+    """
+    try:
+        os.link(source_path, dest_path)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+
+    try:
+        with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            try:
+                _reflink(src.fileno(), dst.fileno())
+                return 'reflink'
+            except (OSError, ImportError):
+                pass
+            _copy_chunked(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+        return 'copy'
+    except BaseException:
+        # Недописанный файл не должен попасть в хранилище
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+def _remove_link_files(rows):
+    """
+    Удаляет файлы ссылок с диска. Возвращает (имена удаленных, освобожденные байты).
+
+    Записи индекса удаленных файлов вызывающий код удаляет через db.remove_direct_links.
+    """
+    removed_names = []
+    freed = 0
+    for file_name, file_path, size in rows:
+        if file_path and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+                logger.debug(f"Удален файл прямой ссылки: {file_path}")
+            except OSError as os_err:
+                logger.error(f"Ошибка удаления файла {file_path}: {os_err}")
+                continue
+        removed_names.append(file_name)
+        freed += size or 0
+    return removed_names, freed
+
+class StorageQuota:
+    """
+    Ограничение суммарного размера хранилища прямых ссылок (DIRECT_LINK_MAX_SIZE_GB).
+
+    Занятый объем загружается из индекса один раз и дальше учитывается при публикации
+    и удалении файлов. Если новый файл не помещается, вытесняются ссылки, истекающие
+    раньше всех (а при равном сроке - дольше всех не выдававшиеся).
+    """
+    # Сколько кандидатов на вытеснение читать из индекса за один запрос
+    EVICTION_BATCH = 16
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._used = None
+        self._lock = None
+
+    async def _ensure_loaded(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._used is None:
+            _, self._used = await db.get_direct_links_stats()
+
+    async def admit(self, size):
+        """Резервирует место под файл, при необходимости вытесняя старые ссылки. Возвращает True/False."""
+        await self._ensure_loaded()
+        async with self._lock:
+            if size > self.max_bytes:
+                logger.warning(f"Файл размером {size} байт больше всего хранилища прямых ссылок ({self.max_bytes} байт)")
+                return False
+            while self._used + size > self.max_bytes:
+                candidates = await db.get_direct_link_eviction_candidates(self.EVICTION_BATCH)
+                if not candidates:
+                    logger.warning(f"Недостаточно места для прямой ссылки: занято {self._used}, нужно еще {size} байт")
+                    return False
+                # Вытесняем ровно столько ссылок, сколько нужно для нового файла
+                to_evict = []
+                projected = self._used
+                for row in candidates:
+                    if projected + size <= self.max_bytes:
+                        break
+                    to_evict.append(row)
+                    projected -= row[2] or 0
+                removed_names, freed = await asyncio.to_thread(_remove_link_files, to_evict)
+                if removed_names:
+                    await db.remove_direct_links(removed_names)
+                else:
+                    logger.error("Не удалось вытеснить ни одной прямой ссылки")
+                    return False
+                self._used -= freed
+                logger.info(f"Вытеснено {len(removed_names)} прямых ссылок, освобождено {round(freed / (1024 * 1024), 2)} МБ")
+            self._used += size
+            return True
+
+    async def reuse(self, content_key, expires_at, now):
+        """
+        Продлевает уже опубликованный файл с тем же ключом содержимого.
+
+        Выполняется под тем же замком, что и удаление, поэтому найденный файл не будет
+        удален между проверкой и продлением. Возвращает (file_name, file_path, size, expires_at) или None.
+        """
+        await self._ensure_loaded()
+        async with self._lock:
+            row = await db.get_direct_link_by_key(content_key)
+            if not row or not row[1] or not os.path.exists(row[1]):
+                return None
+            file_name, file_path, size, current_expires = row
+            await db.extend_direct_link(file_name, expires_at, now)
+            return file_name, file_path, size or 0, max(current_expires, expires_at) if current_expires else expires_at
+
+    def release(self, size):
+        """Возвращает зарезервированное место (файл не был опубликован)."""
+        if self._used is not None:
+            self._used = max(0, self._used - size)
+
+    async def expire(self, now):
+        """Удаляет просроченные ссылки и учитывает освобожденное место. Возвращает их количество."""
+        await self._ensure_loaded()
+        async with self._lock:
+            expired = await db.get_expired_direct_links(now)
+            if not expired:
+                return 0
+            removed_names, freed = await asyncio.to_thread(_remove_link_files, expired)
+            if removed_names:
+                await db.remove_direct_links(removed_names)
+            self._used = max(0, self._used - freed)
+            return len(removed_names)
+
+storage_quota = StorageQuota(int(config.DIRECT_LINK_MAX_SIZE_GB * 1024 ** 3))
+
+# Замки публикации по ключу содержимого: ключ -> [asyncio.Lock, число ожидающих]
+_publish_locks = {}
+
 class LinkGenerator:
     def __init__(self):
         # Используем путь из конфига
@@ -18,8 +195,14 @@ class LinkGenerator:
         if not os.path.exists(self.storage_path):
             os.makedirs(self.storage_path, exist_ok=True)
             
-    async def generate_link(self, source_file_path, filename=None):
-        """Создает прямую ссылку для скачивания файла"""
+    async def generate_link(self, source_file_path, filename=None, content_key=None):
+        """
+        Создает прямую ссылку для скачивания файла.
+
+        content_key - ключ содержимого (канонический id видео + формат). Если файл с тем же
+        содержимым уже опубликован, его срок действия продлевается и возвращается та же
+        ссылка без повторной записи файла. Без content_key ключом служит хеш исходного файла.
+        """
         try:
             # Проверка существования исходного файла
             if not os.path.exists(source_file_path):
@@ -30,76 +213,34 @@ class LinkGenerator:
             if not filename:
                 filename = os.path.basename(source_file_path)
                 
-            # Получаем расширение файла
-            _, file_ext = os.path.splitext(filename)
-            if not file_ext:
-                # Если расширение не найдено, добавим .mp4 по умолчанию для видеофайлов
-                file_ext = '.mp4'
-            
-            # Получаем название файла без расширения для использования в URL
-            name_without_ext = os.path.splitext(filename)[0]
-            
-            # Создаем безопасное URL-friendly название (транслитерация и замена специальных символов)
-            import re
-            from transliterate import translit
-            
-            # Попытка транслитерации с русского на английский
-            try:
-                safe_name = translit(name_without_ext, 'ru', reversed=True)
-            except:
-                # Если не получилось (не русский или ошибка), используем оригинал
-                safe_name = name_without_ext
-                
-            # Заменяем все недопустимые символы на дефисы
-            safe_name = re.sub(r'[^a-zA-Z0-9-]', '-', safe_name)
-            # Заменяем множественные дефисы на один
-            safe_name = re.sub(r'-+', '-', safe_name)
-            # Обрезаем до 50 символов для предотвращения слишком длинных URL
-            safe_name = safe_name[:50].strip('-')
-            
-            # Создаем короткий хеш (8 символов) для уникальности
-            short_hash = hashlib.md5(f"{source_file_path}_{time.time()}".encode()).hexdigest()[:8]
-            
-            # Формируем итоговое имя файла: название-хеш.расширение
-            safe_filename = f"{safe_name}-{short_hash}{file_ext}"
-            dest_path = os.path.join(self.storage_path, safe_filename)
-            
-            logger.debug(f"Генерация ссылки: исходный={filename}, безопасное имя={safe_name}, результат={safe_filename}")
-            
-            # Копируем файл (асинхронно)
-            async with aiofiles.open(source_file_path, 'rb') as src_file:
-                file_content = await src_file.read()
-                
-            async with aiofiles.open(dest_path, 'wb') as dest_file:
-                await dest_file.write(file_content)
-                
-            logger.info(f"Файл скопирован: {dest_path}")
-            
-            # Записываем метаданные с информацией о сроке действия и оригинальном имени
-            expire_time = datetime.now() + timedelta(hours=config.DIRECT_LINK_EXPIRE_HOURS)
-            meta_data = {
-                "original_filename": filename,
-                "expires": expire_time.isoformat(),
-                "source_path": source_file_path,
-                "created": datetime.now().isoformat()
-            }
-            
-            # Сохраняем метаданные
-            async with aiofiles.open(f"{dest_path}.meta", "w", encoding='utf-8') as meta_file:
-                await meta_file.write(json.dumps(meta_data, ensure_ascii=False))
+            # Файл из кэша загрузок отдается nginx по подписанной ссылке, без копирования
+            if config.DIRECT_LINK_SECRET and config.CACHE_ENABLED:
+                link_info = self._signed_link(source_file_path, filename)
+                if link_info:
+                    logger.info(f"Создана подписанная ссылка на файл кэша: {source_file_path}")
+                    return link_info
                 
-            # Формируем URL для доступа к файлу
-            download_url = f"https://{config.DIRECT_LINK_DOMAIN}/{safe_filename}"
-            size_mb = round(os.path.getsize(dest_path) / (1024 * 1024), 2)
+            source_hash = await asyncio.to_thread(self._source_hash, source_file_path)
+            dedup_key = content_key or source_hash
             
-            # Возвращаем информацию о ссылке
-            return {
-                "url": download_url,
-                "filename": filename,
-                "expires": expire_time,
-                "size_mb": size_mb,
-                "file_path": dest_path
-            }
+            # Одновременные запросы одного содержимого публикуют файл один раз
+            entry = _publish_locks.setdefault(dedup_key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    created = datetime.now()
+                    expire_time = created + timedelta(hours=config.DIRECT_LINK_EXPIRE_HOURS)
+                    existing = await storage_quota.reuse(dedup_key, expire_time, created)
+                    if existing:
+                        file_name, file_path, file_size, expires_at = existing
+                        expiry_scheduler.schedule(file_name, expires_at)
+                        logger.info(f"Повторно выдана прямая ссылка {file_name} (срок продлен до {expires_at})")
+                        return self._link_info(file_name, file_path, filename, file_size, expires_at)
+                    return await self._publish(source_file_path, filename, dedup_key, source_hash)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    _publish_locks.pop(dedup_key, None)
             
         except Exception as e:
             logger.error(f"Ошибка при создании прямой ссылки: {e}")
@@ -107,68 +248,121 @@ class LinkGenerator:
             logger.error(traceback.format_exc())
             return None
             
-    async def cleanup_expired_links(self):
-        """Удаляет просроченные файлы"""
+    async def _publish(self, source_file_path, filename, dedup_key, source_hash):
+        """Публикует новый файл в хранилище и записывает его в индекс"""
+        # Получаем расширение файла
+        _, file_ext = os.path.splitext(filename)
+        if not file_ext:
+            # Если расширение не найдено, добавим .mp4 по умолчанию для видеофайлов
+            file_ext = '.mp4'
+        
+        # Получаем название файла без расширения для использования в URL
+        name_without_ext = os.path.splitext(filename)[0]
+        
+        # Создаем безопасное URL-friendly название (транслитерация и замена специальных символов)
+        import re
+        from transliterate import translit
+        
+        # Попытка транслитерации с русского на английский
+        try:
+            safe_name = translit(name_without_ext, 'ru', reversed=True)
+        except:
+            # Если не получилось (не русский или ошибка), используем оригинал
+            safe_name = name_without_ext
+            
+        # Заменяем все недопустимые символы на дефисы
+        safe_name = re.sub(r'[^a-zA-Z0-9-]', '-', safe_name)
+        # Заменяем множественные дефисы на один
+        safe_name = re.sub(r'-+', '-', safe_name)
+        # Обрезаем до 50 символов для предотвращения слишком длинных URL
+        safe_name = safe_name[:50].strip('-')
+        
+        # Короткий хеш (8 символов) от ключа содержимого: одно видео - одно имя файла
+        short_hash = hashlib.md5(dedup_key.encode()).hexdigest()[:8]
+        
+        # Формируем итоговое имя файла: название-хеш.расширение
+        safe_filename = f"{safe_name}-{short_hash}{file_ext}"
+        dest_path = os.path.join(self.storage_path, safe_filename)
+        
+        logger.debug(f"Генерация ссылки: исходный={filename}, безопасное имя={safe_name}, результат={safe_filename}")
+        
+        # Файл с тем же именем без записи в индексе - остаток прерванной публикации
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        
+        # Резервируем место в хранилище (с вытеснением старых ссылок при нехватке)
+        file_size = os.path.getsize(source_file_path)
+        if not await storage_quota.admit(file_size):
+            logger.error(f"Нет места в хранилище прямых ссылок для {source_file_path}")
+            return None
+        
+        # Публикуем файл (жесткая ссылка / клон / копирование в ядре) вне event loop
+        # и записываем его в индекс прямых ссылок со сроком действия. Файл без записи
+        # в индексе не удалит ни вытеснение, ни планировщик, поэтому при ошибке записи
+        # он удаляется, а место в хранилище возвращается
+        created = datetime.now()
+        expire_time = created + timedelta(hours=config.DIRECT_LINK_EXPIRE_HOURS)
         try:
-            now = datetime.now()
-            count_removed = 0
+            method = await asyncio.to_thread(publish_file, source_file_path, dest_path)
+            logger.info(f"Файл опубликован ({method}): {dest_path}")
+            await db.add_direct_link(
+                safe_filename, dest_path, filename, file_size,
+                created, expire_time, source_hash, dedup_key
+            )
+        except BaseException:
+            storage_quota.release(file_size)
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            raise
             
-            # Получаем список всех метафайлов
-            files = os.listdir(self.storage_path)
-            meta_files = [f for f in files if f.endswith('.meta')]
+        expiry_scheduler.schedule(safe_filename, expire_time)
             
-            for meta_filename in meta_files:
-                meta_path = os.path.join(self.storage_path, meta_filename)
-                
-                # Получаем данные метафайла
-                try:
-                    logger.debug(f"Обработка метафайла: {meta_path}")
-                    async with aiofiles.open(meta_path, 'r', encoding='utf-8') as f:
-                        content = await f.read()
-                        
-                    try:
-                        meta_data = json.loads(content)
-                    except json.JSONDecodeError as json_err:
-                        logger.error(f"Ошибка разбора JSON в метафайле {meta_path}: {json_err}")
-                        continue
-                        
-                    # Проверяем срок действия
-                    expires_str = meta_data.get('expires')
-                    if not expires_str:
-                        logger.warning(f"Метафайл {meta_path} не содержит даты истечения. Пропускаем.")
-                        continue
-                    
-                    try:
-                        expire_time = datetime.fromisoformat(expires_str)
-                    except ValueError as val_err:
-                        logger.error(f"Некорректный формат даты истечения в {meta_path}: {val_err}")
-                        continue
-                    
-                    if now > expire_time:
-                        # Удаляем метафайл и соответствующий файл
-                        file_path = meta_path[:-5]  # убираем .meta
-                        
-                        if os.path.exists(file_path):
-                            try:
-                                os.remove(file_path)
-                                logger.debug(f"Удален просроченный файл: {file_path}")
-                            except OSError as os_err:
-                                logger.error(f"Ошибка удаления файла {file_path}: {os_err}")
-                            
-                        try:
-                            os.remove(meta_path)
-                            logger.debug(f"Удален метафайл: {meta_path}")
-                            count_removed += 1
-                        except OSError as os_err:
-                            logger.error(f"Ошибка удаления метафайла {meta_path}: {os_err}")
-                        
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке метафайла {meta_path}: {e}")
-                    continue
-                    
-            if count_removed > 0:
-                logger.info(f"Удалено {count_removed} просроченных файлов при очистке")
-            return count_removed
+        return self._link_info(safe_filename, dest_path, filename, file_size, expire_time)
+
+    @staticmethod
+    def _signed_link(source_file_path, filename):
+        """Подписанная ссылка nginx secure_link на файл внутри кэша загрузок или None"""
+        cache_root = os.path.realpath(config.DOWNLOAD_DIR)
+        real_path = os.path.realpath(source_file_path)
+        if os.path.commonpath([cache_root, real_path]) != cache_root:
+            return None
+        relative_path = os.path.relpath(real_path, cache_root).replace(os.sep, '/')
+        uri = config.DIRECT_LINK_SIGNED_PREFIX.rstrip('/') + '/' + relative_path
+        expires_at = datetime.now().replace(microsecond=0) + timedelta(hours=config.DIRECT_LINK_EXPIRE_HOURS)
+        url = signed_url(config.DIRECT_LINK_BASE_URL, uri, expires_at.timestamp(), config.DIRECT_LINK_SECRET)
+        return {
+            "url": url,
+            "filename": filename,
+            "expires": expires_at,
+            "size_mb": round(os.path.getsize(real_path) / (1024 * 1024), 2),
+            "file_path": real_path
+        }
+
+    @staticmethod
+    def _link_info(file_name, file_path, filename, file_size, expires_at):
+        """Информация о ссылке для ответа пользователю"""
+        return {
+            "url": f"{config.DIRECT_LINK_BASE_URL.rstrip('/')}/{file_name}",
+            "filename": filename,
+            "expires": expires_at,
+            "size_mb": round(file_size / (1024 * 1024), 2),
+            "file_path": file_path
+        }
+
+    @staticmethod
+    def _source_hash(source_file_path):
+        """Хеш исходного файла по пути, размеру и времени изменения (без чтения содержимого)."""
+        stat_result = os.stat(source_file_path)
+        identity = f"{os.path.realpath(source_file_path)}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+        return hashlib.md5(identity.encode()).hexdigest()
+
+    async def cleanup_expired_links(self):
+        """Удаляет просроченные файлы"""
+        try:
+            count = await storage_quota.expire(datetime.now())
+            if count:
+                logger.info(f"Удалено {count} просроченных файлов при очистке")
+            return count
             
         except Exception as e:
             logger.error(f"Ошибка при очистке просроченных ссылок: {e}")
@@ -179,48 +373,7 @@ class LinkGenerator:
     async def get_links_stats(self):
         """Возвращает статистику по активным ссылкам"""
         try:
-            total_size = 0
-            active_links = 0
-            now = datetime.now()
-            
-            files = os.listdir(self.storage_path)
-            meta_files = [f for f in files if f.endswith('.meta')]
-            
-            for meta_filename in meta_files:
-                meta_path = os.path.join(self.storage_path, meta_filename)
-                file_path = meta_path[:-5]  # убираем .meta
-                
-                if not os.path.exists(file_path):
-                    continue
-                
-                # Получаем размер файла
-                file_size = os.path.getsize(file_path)
-                total_size += file_size
-                
-                # Проверяем, активна ли ссылка
-                try:
-                    async with aiofiles.open(meta_path, 'r', encoding='utf-8') as f:
-                        content = await f.read()
-                        
-                    try:
-                        meta_data = json.loads(content)
-                    except json.JSONDecodeError:
-                        logger.warning(f"Пропущен некорректный JSON в {meta_path}")
-                        continue
-                    
-                    expires_str = meta_data.get('expires')
-                    if not expires_str:
-                        continue
-                        
-                    try:
-                        expire_time = datetime.fromisoformat(expires_str)
-                        if now < expire_time:
-                            active_links += 1
-                    except ValueError:
-                        logger.warning(f"Некорректный формат даты в {meta_path}")
-                except Exception as e:
-                    logger.warning(f"Ошибка при чтении метафайла {meta_path}: {e}")
-            
+            active_links, total_size = await db.get_direct_links_stats(datetime.now())
             return {
                 "active_links": active_links,
                 "total_size_mb": round(total_size / (1024 * 1024), 2),
@@ -234,4 +387,116 @@ class LinkGenerator:
                 "active_links": 0,
                 "total_size_mb": 0,
                 "error": str(e)
-            } 
\ No newline at end of file
+            }
+
+    async def import_meta_files(self):
+        """
+        Однократный перенос метаданных из старых .meta файлов в индекс прямых ссылок.
+
+        Выполняется при запуске бота (метафайлы небольшие, читаются в event loop).
+        Импортированные .meta файлы удаляются, поэтому повторный запуск ничего не делает.
+        Возвращает количество импортированных ссылок.
+        """
+        imported = 0
+        meta_files = [f for f in os.listdir(self.storage_path) if f.endswith('.meta')]
+        for meta_filename in meta_files:
+            meta_path = os.path.join(self.storage_path, meta_filename)
+            file_path = meta_path[:-5]  # убираем .meta
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta_data = json.load(f)
+                expire_time = datetime.fromisoformat(meta_data['expires'])
+                created = datetime.fromisoformat(meta_data['created']) if meta_data.get('created') else expire_time - timedelta(hours=config.DIRECT_LINK_EXPIRE_HOURS)
+            except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                logger.error(f"Не удалось импортировать метафайл {meta_path}: {e}")
+                continue
+
+            if os.path.exists(file_path):
+                source_path = meta_data.get('source_path')
+                source_hash = self._source_hash(source_path) if source_path and os.path.exists(source_path) else None
+                await db.add_direct_link(
+                    os.path.basename(file_path), file_path,
+                    meta_data.get('original_filename') or os.path.basename(file_path),
+                    os.path.getsize(file_path), created, expire_time, source_hash
+                )
+                imported += 1
+            try:
+                os.remove(meta_path)
+            except OSError as os_err:
+                logger.error(f"Ошибка удаления метафайла {meta_path}: {os_err}")
+
+        if imported:
+            logger.info(f"Импортировано {imported} прямых ссылок из .meta файлов")
+        return imported
+
+
+class ExpiryScheduler:
+    """
+    Удаление прямых ссылок точно в момент истечения срока.
+
+    Сроки хранятся в min-куче, и взведен ровно один таймер event loop - на ближайший срок.
+    Между сроками планировщик не выполняет никакой работы.
+    """
+    def __init__(self):
+        self._heap = []
+        self._timer = None
+        self._timer_deadline = None
+        self._loop = None
+        self._cleanup_task = None
+
+    async def start(self):
+        """Загружает сроки истечения из индекса и взводит таймер на ближайший."""
+        self._loop = asyncio.get_running_loop()
+        expirations = await db.get_direct_link_expirations()
+        self._heap = [(expires_at, file_name) for file_name, expires_at in expirations if expires_at]
+        heapq.heapify(self._heap)
+        logger.info(f"Планировщик истечения прямых ссылок запущен: {len(self._heap)} ссылок в очереди")
+        self._arm()
+
+    def stop(self):
+        """Снимает таймер (при остановке бота)."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+
+    def schedule(self, file_name, expires_at):
+        """Добавляет срок истечения ссылки; перевзводит таймер, если этот срок раньше текущего."""
+        heapq.heappush(self._heap, (expires_at, file_name))
+        if self._loop and (self._timer_deadline is None or expires_at < self._timer_deadline):
+            self._arm()
+
+    def _arm(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+        if not self._heap or (self._cleanup_task and not self._cleanup_task.done()):
+            # Таймер будет взведен по завершении текущей очистки
+            return
+        deadline = self._heap[0][0]
+        delay = max(0.0, (deadline - datetime.now()).total_seconds())
+        self._timer_deadline = deadline
+        self._timer = self._loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._timer_deadline = None
+        self._cleanup_task = self._loop.create_task(self._expire_due())
+
+    async def _expire_due(self):
+        now = datetime.now()
+        due = 0
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+            due += 1
+        try:
+            if due:
+                # Удаляем по индексу только действительно просроченные ссылки:
+                # продленные ссылки останутся, их новый срок уже в куче
+                await LinkGenerator().cleanup_expired_links()
+        finally:
+            self._cleanup_task = None
+            self._arm()
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,122 @@
+import asyncio
+import bisect
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+# Запас для поиска чуть позже ключевого кадра разреза: ffmpeg с -ss начинает
+# копирование с ключевого кадра не позже указанного времени
+CUT_EPSILON = 0.001
+
+async def read_packet_index(file_path):
+    """
+    Читает индекс пакетов файла одним вызовом ffprobe.
+
+    Возвращает (start_time, packets, keyframes): packets - отсортированный по времени
+    список (время, размер) пакетов всех потоков, keyframes - отсортированные времена
+    ключевых кадров видеопотока. Времена отсчитываются от начала файла.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=start_time:stream=index,codec_type:packet=stream_index,pts_time,dts_time,size,flags',
+        '-of', 'compact=p=0',
+        file_path
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise ValueError(f"ffprobe не смог прочитать пакеты {file_path}: {stderr.decode('utf-8', 'ignore').strip()}")
+
+    start_time = 0.0
+    video_streams = set()
+    raw_packets = []
+    for line in stdout.decode('utf-8', 'ignore').splitlines():
+        fields = dict(item.split('=', 1) for item in line.split('|') if '=' in item)
+        if 'stream_index' in fields:
+            # Время пакета: pts, а при его отсутствии (B-кадры в некоторых контейнерах) - dts
+            packet_time = fields.get('pts_time')
+            if not packet_time or packet_time == 'N/A':
+                packet_time = fields.get('dts_time')
+            try:
+                raw_packets.append((float(packet_time), int(fields['size']), fields['stream_index'], 'K' in fields.get('flags', '')))
+            except (TypeError, ValueError):
+                continue
+        elif 'codec_type' in fields:
+            if fields['codec_type'] == 'video':
+                video_streams.add(fields.get('index'))
+        elif 'start_time' in fields:
+            try:
+                start_time = float(fields['start_time'])
+            except ValueError:
+                pass
+
+    packets = sorted((packet_time - start_time, size) for packet_time, size, _, _ in raw_packets)
+    keyframes = sorted({
+        packet_time - start_time for packet_time, _, stream_index, is_key in raw_packets
+        if is_key and stream_index in video_streams
+    })
+    return start_time, packets, keyframes
+
+def plan_cuts(packets, keyframes, target_size):
+    """
+    Выбирает точки разреза на ключевых кадрах так, чтобы каждая часть была не больше target_size.
+
+    Жадно берет самый дальний ключевой кадр, до которого часть еще помещается в лимит,
+    что дает минимальное число частей. Возвращает (времена разрезов, размеры частей в байтах).
+    """
+    times = [packet_time for packet_time, _ in packets]
+    # prefix[i] - суммарный размер первых i пакетов
+    prefix = [0]
+    for _, size in packets:
+        prefix.append(prefix[-1] + size)
+
+    def bytes_before(moment):
+        return prefix[bisect.bisect_left(times, moment)]
+
+    candidates = [moment for moment in keyframes if moment > 0]
+    candidate_bytes = [bytes_before(moment) for moment in candidates]
+    total_size = prefix[-1]
+    cuts = []
+    part_sizes = []
+    part_start = 0
+    position = 0
+    while total_size - part_start > target_size and position < len(candidates):
+        # Самый дальний ключевой кадр, до которого часть помещается в лимит
+        furthest = bisect.bisect_right(candidate_bytes, part_start + target_size, lo=position) - 1
+        if furthest < position or candidate_bytes[furthest] <= part_start:
+            # Одна группа кадров больше лимита: режем на ближайшем следующем ключевом кадре
+            furthest = bisect.bisect_right(candidate_bytes, part_start, lo=position)
+            if furthest >= len(candidates):
+                break
+            logger.warning(f"Группа кадров до {candidates[furthest]:.2f} с превышает целевой размер части")
+        cuts.append(candidates[furthest])
+        part_sizes.append(candidate_bytes[furthest] - part_start)
+        part_start = candidate_bytes[furthest]
+        position = furthest + 1
+    part_sizes.append(total_size - part_start)
+    return cuts, part_sizes
+
+async def plan_split(file_path, target_size=None):
+    """
+    План разделения видео на минимальное число частей, каждая из которых не больше target_size.
+
+    Возвращает словарь с временами ключевых кадров разрезов (cut_times) и оценкой
+    размеров частей.
+    """
+    target_size = target_size or config.SPLIT_PART_TARGET
+    _, packets, keyframes = await read_packet_index(file_path)
+    if not packets or not keyframes:
+        raise ValueError(f"Не удалось получить индекс ключевых кадров {file_path}")
+
+    cuts, part_sizes = plan_cuts(packets, keyframes, target_size)
+    oversized = [i + 1 for i, size in enumerate(part_sizes) if size > config.MAX_TELEGRAM_SIZE]
+    if oversized:
+        logger.warning(f"Части {oversized} файла {file_path} больше лимита Telegram: слишком редкие ключевые кадры")
+    logger.info(f"План разделения {file_path}: {len(part_sizes)} частей, размеры {[round(size / (1024 * 1024), 1) for size in part_sizes]} МБ")
+    return {
+        'cut_times': cuts,
+        'part_sizes': part_sizes
+    }
@@ -0,0 +1,131 @@
+import os
+import uuid
+import time
+import asyncio
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+class TranscodePool:
+    """
+    Пул перекодирования с ограниченным бюджетом CPU.
+
+    Одновременно выполняется не больше max_workers процессов ffmpeg, каждому выделяется
+    своя доля ядер (-threads), а сами процессы запускаются с пониженным приоритетом (nice),
+    чтобы перекодирование не замедляло скачивание и работу бота.
+    """
+
+    def __init__(self, max_workers=config.TRANSCODE_WORKERS, niceness=config.TRANSCODE_NICE):
+        self._max_workers = max(1, max_workers)
+        self._niceness = niceness
+        self._threads = max(1, (os.cpu_count() or 1) // self._max_workers)
+        self._semaphore = None
+
+    async def fit_to_size(self, source_path, target_size, on_progress=None):
+        """
+        Перекодирует видео в mp4 (H.264 + AAC) так, чтобы файл поместился в target_size байт.
+
+        Битрейт видео рассчитывается по длительности, кодирование двухпроходное.
+        on_progress(percent) - корутина, вызывается по мере выполнения (не чаще раза в 3 секунды).
+        Возвращает путь к готовому файлу.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_workers)
+
+        duration = await self._probe_duration(source_path)
+        if not duration:
+            raise ValueError(f"Не удалось определить длительность видео {source_path}")
+
+        # Битрейт под целевой размер: весь объем делится на длительность, минус аудио
+        video_bitrate = int(target_size * 8 / duration / 1000) - config.TRANSCODE_AUDIO_BITRATE
+        if video_bitrate < config.TRANSCODE_MIN_VIDEO_BITRATE:
+            raise ValueError(f"Видео слишком длинное для сжатия до лимита (битрейт {video_bitrate} кбит/с)")
+
+        # Уникальное имя: один и тот же файл может сжиматься по нескольким запросам сразу
+        base_name = os.path.splitext(source_path)[0]
+        output_path = f"{base_name}_fit_{uuid.uuid4().hex[:8]}.mp4"
+        passlog = os.path.join(os.path.dirname(source_path), f"passlog-{uuid.uuid4()}")
+        common = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1', '-y',
+            '-i', source_path,
+            '-c:v', 'libx264', '-preset', 'medium', '-b:v', f"{video_bitrate}k",
+            '-threads', str(self._threads), '-passlogfile', passlog
+        ]
+        first_pass = common + ['-pass', '1', '-an', '-f', 'null', os.devnull]
+        second_pass = common + [
+            '-pass', '2', '-c:a', 'aac', '-b:a', f"{config.TRANSCODE_AUDIO_BITRATE}k",
+            '-movflags', '+faststart', output_path
+        ]
+
+        async with self._semaphore:
+            logger.info(f"Сжатие {source_path} до {target_size} байт (видео {video_bitrate} кбит/с)")
+            try:
+                for pass_number, cmd in enumerate((first_pass, second_pass)):
+                    await self._run_pass(cmd, duration, pass_number, on_progress)
+            except BaseException:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise
+            finally:
+                for suffix in ('-0.log', '-0.log.mbtree', '-0.log.temp', '-0.log.mbtree.temp'):
+                    if os.path.exists(passlog + suffix):
+                        os.remove(passlog + suffix)
+
+        output_size = os.path.getsize(output_path)
+        if output_size > config.MAX_TELEGRAM_SIZE:
+            os.remove(output_path)
+            raise ValueError(f"Сжатый файл ({output_size} байт) все еще больше лимита Telegram")
+        logger.info(f"Видео сжато: {output_path} ({output_size} байт)")
+        return output_path
+
+    async def _run_pass(self, cmd, duration, pass_number, on_progress):
+        """Выполняет один проход ffmpeg, передавая прогресс (оба прохода - по 50%)."""
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            preexec_fn=(lambda: os.nice(self._niceness)) if os.name == 'posix' else None
+        )
+        stderr_task = asyncio.create_task(process.stderr.read())
+        last_report = 0
+        try:
+            # ffmpeg -progress пишет блоки key=value, out_time_us - обработанная позиция
+            async for raw_line in process.stdout:
+                line = raw_line.decode('utf-8', 'ignore').strip()
+                if not on_progress or not line.startswith('out_time_us='):
+                    continue
+                try:
+                    position = int(line.split('=', 1)[1]) / 1_000_000
+                except ValueError:
+                    continue
+                now = time.monotonic()
+                if now - last_report >= 3:
+                    last_report = now
+                    fraction = min(1.0, max(0.0, position / duration))
+                    await on_progress(int((pass_number + fraction) * 50))
+            returncode = await process.wait()
+        except BaseException:
+            # Отмена или ошибка: не оставляем ffmpeg работать в фоне
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+            raise
+        stderr = (await stderr_task).decode('utf-8', 'ignore')
+        if returncode != 0:
+            logger.error(f"FFmpeg stderr: {stderr}")
+            raise RuntimeError(f"Ошибка FFmpeg при сжатии видео (проход {pass_number + 1}, код {returncode})")
+
+    async def _probe_duration(self, file_path):
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', file_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await process.communicate()
+        try:
+            return float(stdout.decode('utf-8', 'ignore').strip())
+        except ValueError:
+            return None
+
+# Общий пул перекодирования
+transcode_pool = TranscodePool()
@@ -0,0 +1,30 @@
+import base64
+import hashlib
+import hmac
+import time
+from urllib.parse import quote, urlencode
+
+# Подпись совместима с модулем nginx secure_link:
+#   secure_link $arg_md5,$arg_expires;
+#   secure_link_md5 "$secure_link_expires$uri <секрет>";
+# nginx сравнивает подпись с декодированным $uri, поэтому подписывается путь без URL-кодирования.
+
+def sign(uri, expires, secret):
+    """Подпись пути до момента expires (unix-время): base64url от md5 без '='."""
+    digest = hashlib.md5(f"{int(expires)}{uri} {secret}".encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+def signed_url(base_url, uri, expires, secret):
+    """Полная подписанная ссылка вида base_url/uri?md5=...&expires=..."""
+    query = urlencode({'md5': sign(uri, expires, secret), 'expires': int(expires)})
+    return f"{base_url.rstrip('/')}{quote(uri)}?{query}"
+
+def verify(uri, token, expires, secret, now=None):
+    """Проверка подписи и срока действия, как в nginx secure_link."""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < (now if now is not None else time.time()):
+        return False
+    return hmac.compare_digest(sign(uri, expires, secret), token or '')